@@ -0,0 +1,294 @@
+import os, errno, threading, collections, concurrent.futures
+
+# A cache of the contents of a block device's backing file, held as aligned
+# chunks of CHUNK_SIZE bytes in an LRU with a cap on its total size.
+#
+# Sequential streams of reads are detected and read ahead asynchronously on a
+# background thread: a read which starts where a recent read ended extends
+# that stream, and each extension doubles the readahead window of the stream
+# up to maxReadahead.
+#
+# Writes are either write-through, in which case they are written to the file
+# before they complete and cached chunks are updated to match, or write-back,
+# in which case they are written to cached chunks only and reach the file when
+# the chunk is evicted or when flush() is called. Writes to chunks which are
+# not cached and which do not cover a whole chunk are always written through.
+#
+# Commands may be executed concurrently, so all cache state is protected by
+# _lock. Reads of the file are done without holding it; a chunk which is
+# written while it is being read from the file is not cached, as the data read
+# may predate the write. Dirty chunks are written back with _lock held, so
+# that a chunk can never be read from the file while a newer version of it is
+# on its way there. Writes through to the file are also done without holding
+# _lock, so a write waits for any write through to the same chunks to finish
+# first; otherwise overlapping writes could reach the cache and the file in
+# different orders.
+#
+# A write to the file which transfers fewer bytes than requested raises
+# OSError, as does a failing one.
+
+CHUNK_SIZE = 64*1024
+
+CACHE_MODES = ('none', 'writethrough', 'writeback')
+
+# A chunk being read from the file.
+class _Load:
+  __slots__ = ('done', 'data', 'stale')
+
+  def __init__(self):
+    self.done   = threading.Event()
+    self.data   = None
+    self.stale  = False   # the chunk was written during the load
+
+def _checkWritten(n, L):
+  if n != L:
+    raise OSError(errno.EIO, "short write: %d of %d bytes" % (n, L))
+
+class BlockCacheStats:
+  __slots__ = ('hits', 'misses', 'prefetches', 'prefetchHits', 'evictions', 'writebacks', 'flushes')
+
+  def __init__(self):
+    for k in self.__slots__:
+      setattr(self, k, 0)
+
+  def __str__(self):
+    lookups = self.hits + self.misses
+    return 'hits=%d misses=%d (%.1f%% hit) prefetches=%d prefetchHits=%d evictions=%d writebacks=%d flushes=%d' % (
+      self.hits, self.misses, 100*self.hits/lookups if lookups else 0,
+      self.prefetches, self.prefetchHits, self.evictions, self.writebacks, self.flushes)
+
+class BlockCache:
+  MAX_STREAMS = 8
+
+  # fd is the backing file, of size bytes. At most maxSize bytes of chunks are
+  # cached. maxReadahead is the largest readahead window in bytes, or 0 to
+  # disable readahead.
+  def __init__(self, fd, size, *, maxSize=64*1024*1024, writeBack=False, maxReadahead=1024*1024):
+    self._fd            = fd
+    self._size          = size
+    self._maxChunks     = max(1, maxSize//CHUNK_SIZE)
+    self._maxReadahead  = maxReadahead
+    self.writeBack      = writeBack
+    self.stats          = BlockCacheStats()
+
+    self._lock          = threading.Lock()
+    self._chunks        = collections.OrderedDict()  # chunkNo → bytearray, least recently used first
+    self._dirty         = set()                      # chunkNos
+    self._prefetched    = set()                      # chunkNos prefetched and not yet read
+    self._loads         = {}                         # chunkNo → _Load
+    self._writing       = collections.Counter()      # chunkNo → number of write-throughs in progress
+    self._writeDone     = threading.Condition(self._lock)
+    self._streams       = collections.OrderedDict()  # end offset of last read → readahead window
+    self._executor      = None
+    if maxReadahead:
+      self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='BlockCache')
+
+  # Writes back all dirty chunks and stops readahead. The cache must not be
+  # used afterwards.
+  def teardown(self):
+    if self._executor:
+      self._executor.shutdown(wait=True, cancel_futures=True)
+      self._executor = None
+    self.flush(sync=False)
+
+  # Reads L bytes at offset, passing the data to sink(b) in order as one or
+  # more bytes-like objects. Returns the number of bytes read, which is less
+  # than L only at the end of the file, or if the file has become shorter than
+  # its original size.
+  def read(self, offset, L, sink):
+    L = max(0, min(L, self._size - offset))
+    self._readahead(offset, L)
+
+    n   = 0
+    end = offset + L
+    while offset < end:
+      chunkNo = offset // CHUNK_SIZE
+      data    = self._getChunk(chunkNo)
+      start   = offset - chunkNo*CHUNK_SIZE
+      piece   = memoryview(data)[start:min(len(data), start + end - offset)]
+      if not piece:
+        break
+      sink(piece)
+      offset += len(piece)
+      n      += len(piece)
+
+    return n
+
+  # Writes the bytes-like objects in views at offset.
+  def write(self, offset, views):
+    L = sum(len(v) for v in views)
+    if L == 0:
+      return
+
+    data = memoryview(b''.join(views))
+    first, last = offset // CHUNK_SIZE, (offset + L - 1) // CHUNK_SIZE
+
+    with self._lock:
+      while any(self._writing[chunkNo] for chunkNo in range(first, last+1)):
+        self._writeDone.wait()
+
+      throughNos = []
+      for chunkNo in range(first, last+1):
+        chunkStart  = chunkNo*CHUNK_SIZE
+        lo          = max(offset, chunkStart)
+        hi          = min(offset + L, chunkStart + CHUNK_SIZE)
+        piece       = data[lo - offset:hi - offset]
+        chunk       = self._chunks.get(chunkNo)
+
+        if chunk is None and self.writeBack and lo == chunkStart and hi == min(chunkStart + CHUNK_SIZE, self._size):
+          chunk = self._insert(chunkNo, bytearray(piece))
+        elif chunk is not None:
+          chunk[lo - chunkStart:hi - chunkStart] = piece
+          self._chunks.move_to_end(chunkNo)
+
+        if chunk is not None and self.writeBack:
+          self._dirty.add(chunkNo)
+        else:
+          throughNos.append(chunkNo)
+
+        load = self._loads.get(chunkNo)
+        if load:
+          load.stale = True
+
+      for chunkNo in throughNos:
+        self._writing[chunkNo] += 1
+
+    if not throughNos:
+      return
+
+    try:
+      # Only the chunks counted in _writing are written to the file. The others
+      # are dirty in the cache, and writing them here could overwrite a newer
+      # version of them written back in the meantime.
+      for lo, hi in self._runs(throughNos, offset, L):
+        _checkWritten(os.pwrite(self._fd, data[lo - offset:hi - offset], lo), hi - lo)
+    finally:
+      with self._lock:
+        for chunkNo in throughNos:
+          self._writing[chunkNo] -= 1
+          if not self._writing[chunkNo]:
+            del self._writing[chunkNo]
+          load = self._loads.get(chunkNo)
+          if load:
+            load.stale = True
+        self._writeDone.notify_all()
+
+  # Returns the byte ranges [lo, hi) within [offset, offset+L) covered by runs
+  # of consecutive chunkNos, which are in ascending order.
+  @staticmethod
+  def _runs(chunkNos, offset, L):
+    runs = []
+    for chunkNo in chunkNos:
+      lo = max(offset, chunkNo*CHUNK_SIZE)
+      hi = min(offset + L, (chunkNo+1)*CHUNK_SIZE)
+      if runs and runs[-1][1] == lo:
+        runs[-1][1] = hi
+      else:
+        runs.append([lo, hi])
+    return runs
+
+  # Writes back all dirty chunks, and then if sync is set, flushes the file to
+  # stable storage.
+  def flush(self, sync=True):
+    with self._lock:
+      self.stats.flushes += 1
+      for chunkNo in sorted(self._dirty):
+        self._writeBack(chunkNo)
+
+    if sync:
+      os.fdatasync(self._fd)
+
+  # Returns the chunk, reading it from the file if necessary.
+  def _getChunk(self, chunkNo):
+    while True:
+      with self._lock:
+        chunk = self._chunks.get(chunkNo)
+        if chunk is not None:
+          self._chunks.move_to_end(chunkNo)
+          self.stats.hits += 1
+          if chunkNo in self._prefetched:
+            self._prefetched.discard(chunkNo)
+            self.stats.prefetchHits += 1
+          return chunk
+
+        self.stats.misses += 1
+        load = self._loads.get(chunkNo)
+        if load is None:
+          load = self._loads[chunkNo] = _Load()
+          owner = True
+        else:
+          owner = False
+
+      if owner:
+        self._load(chunkNo, load)
+      else:
+        load.done.wait()
+
+      # If the load raced with a write, or another thread's load failed, try
+      # again.
+      if load.data is not None and not load.stale:
+        return load.data
+
+  def _load(self, chunkNo, load, prefetch=False):
+    try:
+      load.data = self._readChunk(chunkNo)
+    finally:
+      with self._lock:
+        del self._loads[chunkNo]
+        if load.data is not None and not load.stale and chunkNo not in self._writing and chunkNo not in self._chunks:
+          self._insert(chunkNo, load.data)
+          if prefetch:
+            self._prefetched.add(chunkNo)
+            self.stats.prefetches += 1
+      load.done.set()
+
+  def _readChunk(self, chunkNo):
+    start = chunkNo*CHUNK_SIZE
+    return bytearray(os.pread(self._fd, min(CHUNK_SIZE, self._size - start), start))
+
+  # Must be called with _lock held.
+  def _insert(self, chunkNo, chunk):
+    self._chunks[chunkNo] = chunk
+    while len(self._chunks) > self._maxChunks:
+      oldNo = next(iter(self._chunks))
+      if oldNo in self._dirty:
+        self._writeBack(oldNo)
+      del self._chunks[oldNo]
+      self._prefetched.discard(oldNo)
+      self.stats.evictions += 1
+    return chunk
+
+  # Must be called with _lock held.
+  def _writeBack(self, chunkNo):
+    chunk = self._chunks[chunkNo]
+    _checkWritten(os.pwrite(self._fd, chunk, chunkNo*CHUNK_SIZE), len(chunk))
+    self._dirty.discard(chunkNo)
+    self.stats.writebacks += 1
+
+  # Updates the stream detector for a read of [offset, offset+L) and starts
+  # reading ahead of it if it continues a stream.
+  def _readahead(self, offset, L):
+    if not self._executor or L == 0:
+      return
+
+    with self._lock:
+      window = self._streams.pop(offset, None)
+      if window is None:
+        self._streams[offset + L] = 0
+        if len(self._streams) > self.MAX_STREAMS:
+          self._streams.popitem(last=False)
+        return
+
+      window = min(max(2*window, 2*L, CHUNK_SIZE), self._maxReadahead)
+      self._streams[offset + L] = window
+
+      first = (offset + L) // CHUNK_SIZE
+      last  = (min(offset + L + window, self._size) - 1) // CHUNK_SIZE
+      loads = []
+      for chunkNo in range(first, last+1):
+        if chunkNo not in self._chunks and chunkNo not in self._loads:
+          load = self._loads[chunkNo] = _Load()
+          loads.append((chunkNo, load))
+
+    for chunkNo, load in loads:
+      self._executor.submit(self._load, chunkNo, load, True)
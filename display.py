@@ -0,0 +1,327 @@
+import os, socket, struct, threading, zlib
+from memmgr import *
+
+# Display backends. A display backend presents the framebuffer of a Qxl device
+# and feeds keyboard input back to it. The platform creates a new Qxl device on
+# every system reset, so a backend outlives the devices it is attached to:
+#
+#   attach(qxl)     called when a Qxl device is created
+#   detach(qxl)     called when it is torn down
+#   onModeChange()  called, on a vCPU thread, whenever the guest changes a
+#                   display mode register
+#
+# While attached, the backend may call qxl.keyEventHandler(down, scancode) with
+# a USB HID usage code to deliver key presses to the guest.
+#
+# All backends can take screenshots of the current framebuffer on demand.
+class DisplayBackend:
+  def __init__(self):
+    self._qxl = None
+
+  def attach(self, qxl):
+    self._qxl = qxl
+
+  def detach(self, qxl):
+    if self._qxl is qxl:
+      self._qxl = None
+
+  def onModeChange(self):
+    pass
+
+  # Writes the current framebuffer to path. The format is PNG if path ends in
+  # .png, and PPM otherwise.
+  def screenshot(self, path):
+    qxl = self._qxl
+    if qxl is None:
+      raise Exception("no display device attached")
+
+    with qxl.fbLock:
+      mode = qxl.framebufferMode()
+      if mode is None:
+        raise Exception("display is not in a graphics mode")
+
+      slot, width, height, bpp, pitch = mode
+      data = bytes(ramView(slot.userspaceAddr, pitch*height))
+
+    rgb = toRgb(data, width, height, bpp, pitch)
+    if path.endswith('.png'):
+      img = encodePng(rgb, width, height)
+    else:
+      img = encodePpm(rgb, width, height)
+
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'wb') as f:
+      f.write(img)
+    os.replace(tmpPath, path)
+
+# A backend which presents nothing. The framebuffer is only read when a
+# screenshot is requested, so an idle headless VM does no display work at all.
+class HeadlessDisplay(DisplayBackend):
+  pass
+
+# A backend which shows the framebuffer in an SDL window and takes keyboard
+# input from it. Requires PySDL2, which is only imported when this backend is
+# used.
+class SdlDisplay(DisplayBackend):
+  def __init__(self):
+    super().__init__()
+    import sdl2
+    self._sdl2        = sdl2
+    self._syncEventNo = None
+    self._run         = False
+    self._exitLock    = None
+
+  def attach(self, qxl):
+    super().attach(qxl)
+    self._startVisualizer(qxl)
+
+  def detach(self, qxl):
+    if self._qxl is not qxl:
+      return
+
+    self._run = False
+    self._exitLock.acquire()
+    super().detach(qxl)
+
+  def onModeChange(self):
+    sdl2 = self._sdl2
+    e = sdl2.SDL_Event()
+    e.type = self._getSyncEventNo()
+    print('@ModeChange:Event 0x%x' % e.type)
+    sdl2.SDL_PushEvent(e)
+
+  def _getSyncEventNo(self):
+    if self._syncEventNo is None:
+      self._syncEventNo = self._sdl2.SDL_RegisterEvents(1)
+    return self._syncEventNo
+
+  def _startVisualizer(self, qxl):
+    import ctypes
+    sdl2 = self._sdl2
+
+    self._run = True
+
+    lock = qxl.fbLock
+
+    exitLock = threading.Lock()
+    exitLock.acquire()
+    self._exitLock = exitLock
+
+    def f():
+      sdl2.SDL_Init(sdl2.SDL_INIT_VIDEO)
+
+      w = sdl2.SDL_CreateWindow(b"Framebuffer", sdl2.SDL_WINDOWPOS_UNDEFINED, sdl2.SDL_WINDOWPOS_UNDEFINED, 800, 600, sdl2.SDL_WINDOW_SHOWN)
+      s = None
+      curUserspaceAddr = None
+      geom = None         # (width, height, pitch) of s
+      fullRedraw = False  # redraw everything rather than just dirty rows
+
+      def onModeChange():
+        nonlocal s, curUserspaceAddr, geom, fullRedraw
+        fullRedraw = True
+        if s is not None:
+          sdl2.SDL_FreeSurface(s)
+          s = None
+
+        mode = qxl.framebufferMode()
+        if mode is None:
+          print('@Mode Change: None (%s, %s, %s)' % (qxl.b0h._slot, qxl._regs.virtWidth.value, qxl._regs.virtHeight.value))
+          sdl2.SDL_SetWindowTitle(w, b'Framebuffer')
+          curUserspaceAddr = None
+          return
+
+        slot, width, height, bpp, pitch = mode
+        print('@Mode Change: w=%s, h=%s, bpp=%s' % (width, height, bpp))
+
+        sdl2.SDL_SetWindowSize(w, width, height)
+        sdl2.SDL_SetWindowTitle(w, ("Framebuffer (%sx%sx%s)" % (width, height, bpp)).encode('utf-8'))
+        curUserspaceAddr = slot.userspaceAddr
+        geom = (width, height, pitch)
+        s = sdl2.SDL_CreateRGBSurfaceFrom(curUserspaceAddr,
+            width, height, bpp, pitch,
+            0x00FF_0000, 0x0000_FF00, 0x0000_00FF, 0x0000_0000)
+
+      lock.acquire()
+      onModeChange()
+      lock.release()
+
+      e = sdl2.SDL_Event()
+      def handleEvent():
+        nonlocal fullRedraw
+        if e.type == self._getSyncEventNo():
+          lock.acquire()
+          onModeChange()
+          lock.release()
+        elif e.type == sdl2.SDL_WINDOWEVENT:
+          fullRedraw = True
+        elif e.type == sdl2.SDL_KEYDOWN or e.type == sdl2.SDL_KEYUP:
+          if qxl.keyEventHandler:
+            qxl.keyEventHandler(e.type == sdl2.SDL_KEYDOWN, e.key.keysym.scancode)
+
+      while self._run:
+        if sdl2.SDL_WaitEventTimeout(ctypes.byref(e), 16) != 0:
+          handleEvent()
+          while sdl2.SDL_PollEvent(ctypes.byref(e)) != 0:
+            handleEvent()
+
+        # Only rows whose pages the guest has written since the last frame are
+        # blitted, and frames in which nothing was written are skipped, so an
+        # idle display costs a dirty log query per frame and nothing else.
+        lock.acquire()
+        if (curUserspaceAddr and qxl.b0h._slot is None) or (qxl.b0h._slot and curUserspaceAddr != qxl.b0h._slot.userspaceAddr):
+          onModeChange()
+
+        spans = None
+        slot  = qxl.b0h._slot
+        if s is not None and slot is not None:
+          width, height, pitch = geom
+          bitmap = slot.getDirtyLog()
+          if fullRedraw:
+            spans = [(0, height)]
+            fullRedraw = False
+          else:
+            spans = dirtyRowSpans(bitmap, pitch, height)
+
+          dsts = sdl2.SDL_GetWindowSurface(w)
+          if dsts is None:
+            spans = None
+          for y0, y1 in spans or ():
+            sdl2.SDL_BlitSurface(s, sdl2.SDL_Rect(0, y0, width, y1-y0), dsts, sdl2.SDL_Rect(0, y0, width, y1-y0))
+
+        lock.release()
+        if spans:
+          rects = (sdl2.SDL_Rect*len(spans))(*(sdl2.SDL_Rect(0, y0, width, y1-y0) for y0, y1 in spans))
+          sdl2.SDL_UpdateWindowSurfaceRects(w, rects, len(spans))
+
+      if s:
+        sdl2.SDL_FreeSurface(s)
+        s = None
+
+      sdl2.SDL_DestroyWindow(w)
+      sdl2.SDL_Quit()
+      exitLock.release()
+
+    t = threading.Thread(target=f, name='QxlVis')
+    t.daemon = True
+    t.start()
+
+displayBackends = {
+  'headless': HeadlessDisplay,
+  'sdl':      SdlDisplay,
+}
+
+# Converts a dirty page bitmap for a framebuffer starting at offset 0 of a slot
+# into a list of [y0, y1) row spans which need to be redrawn. Adjacent spans are
+# merged.
+#
+# (bitmap: bytes, pitch: int, height: int) → [(y0, y1)]
+def dirtyRowSpans(bitmap, pitch, height):
+  x = int.from_bytes(bitmap, 'little')
+  x &= (1 << ((pitch*height + PAGE_SIZE - 1)//PAGE_SIZE)) - 1
+
+  spans = []
+  while x:
+    i = (x & -x).bit_length() - 1     # first dirty page
+    y = x >> i
+    n = (~y & (y+1)).bit_length() - 1 # number of consecutive dirty pages
+    x &= ~(((1<<n) - 1) << i)
+
+    y0 = (i*PAGE_SIZE) // pitch
+    y1 = min(height, ((i+n)*PAGE_SIZE + pitch - 1) // pitch)
+    if spans and y0 <= spans[-1][1]:
+      spans[-1] = (spans[-1][0], y1)
+    else:
+      spans.append((y0, y1))
+
+  return spans
+
+# Converts framebuffer contents to packed 24-bit RGB. 32 bpp framebuffers are
+# XRGB and 24 bpp framebuffers are RGB, both stored little endian (so B, G, R in
+# memory order).
+#
+# (data: bytes, width: int, height: int, bpp: int, pitch: int) → bytearray
+def toRgb(data, width, height, bpp, pitch):
+  if bpp not in (24, 32):
+    raise Exception("unsupported framebuffer depth: %s bpp" % bpp)
+
+  bytesPerPixel = bpp//8
+  if pitch != width*bytesPerPixel:
+    data = b''.join(data[y*pitch:y*pitch + width*bytesPerPixel] for y in range(height))
+
+  rgb = bytearray(width*height*3)
+  rgb[0::3] = data[2::bytesPerPixel]
+  rgb[1::3] = data[1::bytesPerPixel]
+  rgb[2::3] = data[0::bytesPerPixel]
+  return rgb
+
+# (rgb: bytes, width: int, height: int) → bytes
+def encodePpm(rgb, width, height):
+  return b'P6\n%d %d\n255\n' % (width, height) + bytes(rgb)
+
+# (rgb: bytes, width: int, height: int) → bytes
+def encodePng(rgb, width, height):
+  def chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+  stride = width*3
+  raw = b''.join(b'\x00' + rgb[y*stride:(y+1)*stride] for y in range(height)) # filter type 0 (none) per row
+  return (b'\x89PNG\r\n\x1a\n'
+    + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) # 8-bit RGB
+    + chunk(b'IDAT', zlib.compress(raw, 6))
+    + chunk(b'IEND', b''))
+
+# A line-oriented control server listening on a Unix socket. Each line received
+# is split into words; the first word names a command in commands, which is
+# called with the remaining words as arguments. The reply is 'ok', followed by
+# the command's result if it is not None, or 'error: ' and the exception
+# message.
+#
+#   $ echo screenshot /tmp/screen.png | socat - UNIX-CONNECT:kvmtest.sock
+#   ok /tmp/screen.png
+class ControlServer:
+  def __init__(self, path, commands):
+    self._path      = path
+    self._commands  = commands
+
+    if os.path.exists(path):
+      os.unlink(path)
+
+    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._sock.bind(path)
+    self._sock.listen()
+
+    t = threading.Thread(target=self._acceptLoop, name='Control', daemon=True)
+    t.start()
+
+  def teardown(self):
+    self._sock.close()
+    try:
+      os.unlink(self._path)
+    except FileNotFoundError:
+      pass
+
+  def _acceptLoop(self):
+    while True:
+      try:
+        conn, _ = self._sock.accept()
+      except OSError:
+        return
+
+      threading.Thread(target=self._serve, args=(conn,), name='Control', daemon=True).start()
+
+  def _serve(self, conn):
+    with conn, conn.makefile('rw', encoding='utf-8', newline='\n') as f:
+      for line in f:
+        words = line.split()
+        if not words:
+          continue
+
+        cmd = self._commands.get(words[0])
+        try:
+          if cmd is None:
+            raise Exception("unknown command: %s (commands: %s)" % (words[0], ', '.join(sorted(self._commands))))
+          result = cmd(*words[1:])
+          f.write('ok\n' if result is None else 'ok %s\n' % result)
+        except Exception as e:
+          f.write('error: %s\n' % e)
+        f.flush()
@@ -1,3 +1,5 @@
+import bisect, struct, threading
+
 # Abstract interface for objects which can handle memory accesses. "Memory" in
 # this context can also mean e.g. I/O ports and the scope being accessed must
 # be understood from the context.
@@ -22,26 +24,117 @@ class MemoryHandler:
   def write64(self, addr, v):
     raise NotImplementedError("%s: write u64(0x%x): 0x%x" % (self, addr, v))
 
+  # String I/O (rep ins/outs), which may transfer many elements of the same
+  # width to or from the same address in a single exit.
+  #
+  # (addr: u64, width: int, count: int) → bytes (count*width)
+  # (addr: u64, width: int, data: bytes-like (n*width)) → ()
+  #
+  # The default implementations perform the accesses one element at a time.
+  # Devices which can consume or produce a whole string more cheaply, such as
+  # FIFOs, can override them.
+  def readBlock(self, addr, width, count):
+    st  = _blockStructs[width]
+    f   = getattr(self, 'read%d' % (width*8))
+    buf = bytearray(count*width)
+    for i in range(count):
+      st.pack_into(buf, i*width, f(addr))
+    return buf
+
+  def writeBlock(self, addr, width, data):
+    st = _blockStructs[width]
+    f  = getattr(self, 'write%d' % (width*8))
+    for v, in st.iter_unpack(data):
+      f(addr, v)
+
+  # Ranges of this handler, as (offset, len) tuples relative to .base, which
+  # only have write side effects that can tolerate being deferred. Writes to
+  # these ranges may be buffered by the kernel and delivered in a batch at the
+  # next exit rather than causing an exit each. Reads still exit as usual.
+  coalescedRanges = ()
+
+_blockStructs = {1: struct.Struct('<B'), 2: struct.Struct('<H'), 4: struct.Struct('<I'), 8: struct.Struct('<Q')}
+
 # MemoryHandler which can dispatch to other MemoryHandlers by range.
 class AddressSpace(MemoryHandler):
   def __init__(self):
     self.mappings = []
+    self._parents = []
 
   # Mount a new memory handler. The handler should contain attributes .base and
   # .len, which should designate the range of addresses handled [base,
   # base+len). Also returns the handler.
+  #
+  # The handler is given a .deviceLock, unless it already has one, which is
+  # held while dispatching accesses to it, so that accesses to different
+  # devices from different vCPUs can proceed in parallel. Handlers which share
+  # state with other handlers should set a common .deviceLock before being
+  # mounted.
+  #
+  # The handler is also given .readers and .writers, which map access widths
+  # in bytes to its bound read/write methods, so that dispatchers can call the
+  # right method for an access without testing the width.
   def mount(self, handler):
     self.mappings.append(handler)
+    if isinstance(handler, AddressSpace):
+      handler._parents.append(self)
+    else:
+      if not hasattr(handler, 'deviceLock'):
+        handler.deviceLock = threading.RLock()
+      handler.readers = {1: handler.read8, 2: handler.read16, 4: handler.read32, 8: handler.read64}
+      handler.writers = {1: handler.write8, 2: handler.write16, 4: handler.write32, 8: handler.write64}
+      if not hasattr(handler, '_addressSpaces'):
+        handler._addressSpaces = []
+      handler._addressSpaces.append(self)
+
+    self.invalidate()
     return handler
 
-  # Determines the memory handler which handles the given address and returns it.
-  # Throws an exception if no memory handler for the address can be found.
-  def resolve(self, addr):
+  # Called whenever the set of mappings or the range of any mapping changes.
+  # Subclasses which maintain an index drop it here; nested address spaces
+  # propagate the change to the spaces they are mounted on.
+  def invalidate(self):
+    for p in self._parents:
+      p.invalidate()
+
+  # Returns a list of (addr, len) tuples designating the coalescible ranges of
+  # all handlers mounted on this address space, including nested ones.
+  def coalescedZones(self):
+    zones = []
+    for handler in self.mappings:
+      if isinstance(handler, AddressSpace):
+        zones += handler.coalescedZones()
+        continue
+      for offset, L in getattr(handler, 'coalescedRanges', ()):
+        zones.append((handler.base + offset, L))
+
+    return zones
+
+  # Returns the handler for the given address, or None.
+  def lookup(self, addr):
     for handler in self.mappings:
       if addr >= handler.base and addr < (handler.base + handler.len):
         return handler
 
-    raise Exception("%s: no mapping found for address 0x%x" % (self, addr))
+    return None
+
+  # Determines the memory handler which handles the given address and returns it.
+  # Throws an exception if no memory handler for the address can be found.
+  def resolve(self, addr):
+    handler = self.lookup(addr)
+    if handler is None:
+      raise Exception("%s: no mapping found for address 0x%x" % (self, addr))
+
+    return handler
+
+  # Like resolve(), but descends into nested address spaces, so that the
+  # handler returned is the one which actually implements the address.
+  def resolveLeaf(self, addr):
+    handler = self.resolve(addr)
+    while isinstance(handler, AddressSpace):
+      handler = handler.resolve(addr)
+
+    return handler
 
   def read8(self, addr):
     return self.resolve(addr).read8(addr)
@@ -60,6 +153,117 @@ class AddressSpace(MemoryHandler):
   def write64(self, addr, v):
     return self.resolve(addr).write64(addr, v)
 
+# Must be called after the .base or .len of a mounted handler has been changed
+# (for example, because a PCI BAR was moved), so that any address space the
+# handler is mounted on can rebuild its index.
+def handlerMoved(handler):
+  for space in getattr(handler, '_addressSpaces', ()):
+    space.invalidate()
+
+# An address space for the 16-bit I/O port space which dispatches via a flat
+# table with one entry per port. Nested address spaces are flattened into the
+# table, so that a port access always resolves to the handler which actually
+# implements it in a single lookup.
+class IoPortAddressSpace(AddressSpace):
+  numPorts = 0x1_0000
+
+  def __init__(self):
+    super().__init__()
+    self._table = None
+
+  def invalidate(self):
+    self._table = None
+    super().invalidate()
+
+  def _buildTable(self):
+    table = [None]*self.numPorts
+
+    # Earlier mounts take precedence, as with a linear scan.
+    for handler in reversed(self.mappings):
+      start = max(handler.base, 0)
+      end   = min(handler.base + handler.len, self.numPorts)
+      if isinstance(handler, AddressSpace):
+        for port in range(start, end):
+          table[port] = handler.lookup(port)
+      else:
+        for port in range(start, end):
+          table[port] = handler
+
+    self._table = table
+    return table
+
+  def lookup(self, addr):
+    table = self._table
+    if table is None:
+      table = self._buildTable()
+
+    if addr >= self.numPorts:
+      return None
+
+    return table[addr]
+
+# An address space which dispatches via a sorted index of non-overlapping
+# intervals, with a cache of the last interval hit. Suitable for sparse,
+# potentially large address spaces such as the physical memory address space.
+class IndexedAddressSpace(AddressSpace):
+  def __init__(self):
+    super().__init__()
+    self._index   = None                  # ([start...], [end...], [handler...])
+    self._lastHit = (0, 0, None, None)    # (start, end, handler, index)
+
+  def invalidate(self):
+    self._index   = None
+    self._lastHit = (0, 0, None, None)
+    super().invalidate()
+
+  def _buildIndex(self):
+    bounds = set()
+    for handler in self.mappings:
+      if handler.len > 0:
+        bounds.add(handler.base)
+        bounds.add(handler.base + handler.len)
+
+    # Split the address space into elementary intervals and assign each the
+    # first mounted handler covering it, coalescing neighbours with the same
+    # handler. This preserves the precedence of a linear scan for overlapping
+    # mappings.
+    starts, ends, targets = [], [], []
+    bounds = sorted(bounds)
+    for lo, hi in zip(bounds, bounds[1:]):
+      target = AddressSpace.lookup(self, lo)
+      if target is None:
+        continue
+      if targets and targets[-1] is target and ends[-1] == lo:
+        ends[-1] = hi
+        continue
+      starts.append(lo)
+      ends.append(hi)
+      targets.append(target)
+
+    self._index = (starts, ends, targets)
+    return self._index
+
+  # The cached hit records the index it was derived from and is only used while
+  # that index is current, so a hit cached by one vCPU thread racing with an
+  # invalidation on another is never returned.
+  def lookup(self, addr):
+    start, end, target, hitIndex = self._lastHit
+    if addr >= start and addr < end and hitIndex is self._index:
+      return target
+
+    index = self._index
+    if index is None:
+      index = self._buildIndex()
+
+    starts, ends, targets = index
+    i = bisect.bisect_right(starts, addr) - 1
+    if i < 0 or addr >= ends[i]:
+      return None
+
+    target = targets[i]
+    self._lastHit = (starts[i], ends[i], target, index)
+    return target
+
 #
 def registerDevice():
   def f(cls):
@@ -99,6 +303,7 @@ def registerDevice():
 
         self.__registers__ = rs
         self.__registersByOffset__ = rbo
+        self.__readers__, self.__writers__ = compileAccessors(rs)
         self.__registerInitDone__ = True
 
       if oldInit is not None:
@@ -177,22 +382,48 @@ def registerDevice():
       if not oneSuccess:
         raise Exception("%s: all registers written were read-only: 0x%x (+0x%x) u%s = 0x%x" % (self, addr, addr-self.base, width, v))
 
+    # Accesses which fall entirely within a single register use the accessors
+    # compiled for it; anything else goes through the generic path above.
     def read8(self, addr):
+      f = self.__readers__[0].get(addr - self.base)
+      if f is not None:
+        return f()
       return read(self, addr, 8)
     def read16(self, addr):
+      f = self.__readers__[1].get(addr - self.base)
+      if f is not None:
+        return f()
       return read(self, addr, 16)
     def read32(self, addr):
+      f = self.__readers__[2].get(addr - self.base)
+      if f is not None:
+        return f()
       return read(self, addr, 32)
     def read64(self, addr):
+      f = self.__readers__[3].get(addr - self.base)
+      if f is not None:
+        return f()
       return read(self, addr, 64)
 
     def write8(self, addr, v):
+      f = self.__writers__[0].get(addr - self.base)
+      if f is not None:
+        return f(v)
       return write(self, addr, v, 8)
     def write16(self, addr, v):
+      f = self.__writers__[1].get(addr - self.base)
+      if f is not None:
+        return f(v)
       return write(self, addr, v, 16)
     def write32(self, addr, v):
+      f = self.__writers__[2].get(addr - self.base)
+      if f is not None:
+        return f(v)
       return write(self, addr, v, 32)
     def write64(self, addr, v):
+      f = self.__writers__[3].get(addr - self.base)
+      if f is not None:
+        return f(v)
       return write(self, addr, v, 64)
 
     if not hasattr(cls, '__init__') or not hasattr(cls.__init__, 'isRegisterDeviceInit'):
@@ -210,6 +441,68 @@ def registerDevice():
 
   return f
 
+ACCESS_WIDTHS = (8, 16, 32, 64)
+
+# ([RegisterInstance...]) → (readers, writers)
+#
+# Builds, for each access width, a table mapping each offset at which an
+# access of that width falls entirely within one register to a function
+# performing that access. readers[i] and writers[i] are the tables for
+# ACCESS_WIDTHS[i]; readers take no arguments and writers take the value.
+# Writes to read-only registers are omitted, so that they take the generic
+# path and fail as usual.
+def compileAccessors(registerInstances):
+  readers = tuple({} for w in ACCESS_WIDTHS)
+  writers = tuple({} for w in ACCESS_WIDTHS)
+  for ri in registerInstances:
+    for i, width in enumerate(ACCESS_WIDTHS):
+      for relOffset in range(ri.mapWidth//8):
+        if relOffset*8 + width > ri.width:
+          break
+        readers[i].setdefault(ri.offset + relOffset, _compileReader(ri, relOffset, width))
+        if not ri.reg.ro:
+          writers[i].setdefault(ri.offset + relOffset, _compileWriter(ri, relOffset, width))
+
+  return readers, writers
+
+def _compileReader(ri, relOffset, width):
+  get   = ri.reg.get
+  obj   = ri.obj
+  shift = relOffset*8
+  mask  = bits0(width-1)
+  if get is not None:
+    if shift == 0:
+      return lambda: get(obj) & mask
+    return lambda: (get(obj) >> shift) & mask
+  if shift == 0:
+    return lambda: ri.value & mask
+  return lambda: (ri.value >> shift) & mask
+
+def _compileWriter(ri, relOffset, width):
+  if relOffset != 0 or width != ri.width:
+    return lambda v: ri.write(relOffset, v, width)
+
+  set       = ri.reg.set
+  afterSet  = ri.reg.afterSet
+  obj       = ri.obj
+  mask      = bits0(width-1)
+  if set is None and afterSet is None:
+    def f(v):
+      ri.value = v & mask
+  elif afterSet is None:
+    def f(v):
+      set(obj, v & mask)
+  else:
+    def f(v):
+      v = v & mask
+      if set is not None:
+        set(obj, v)
+      else:
+        ri.value = v
+      afterSet(obj, v)
+
+  return f
+
 class Register:
   def __init__(self, offset, abbr=None, *, set=None, get=None, afterSet=None, title=None, initial=0, ro=False, noOffset=False):
     self.offset = offset
@@ -14,6 +14,7 @@ class Port92(MemoryHandler):
 class Port80(MemoryHandler):
   base = 0x80
   len  = 16
+  coalescedRanges = ((0x00, 1),) # POST codes
 
   r00 = Register8(0x00, set=lambda self, v: ()) # Linux io_delay.c
   r07 = Register8(0x07, ro=True, initial=0xFF)  # Linux i8237.c
@@ -26,8 +27,8 @@ class Rtc(MemoryHandler):
   addr = Register8(0, title='Address Port')
   data = Register8(1, title='Data Port')
 
-  def __init__(self):
-    self.actual = RtcActual(self)
+  def __init__(self, numCpus=1, lowMemSize=1*1024*1024*1024, highMemSize=0):
+    self.actual = RtcActual(self, numCpus, lowMemSize, highMemSize)
 
   @data.getter
   def _(self):
@@ -42,14 +43,23 @@ class RtcActual(MemoryHandler):
   base = 0
   len  = 0xFF
 
-  def __init__(self, rtc):
+  # lowMemSize is the size of RAM at 0 (below the PCI hole) and highMemSize the
+  # size of RAM at 4 GiB, in bytes.
+  def __init__(self, rtc, numCpus=1, lowMemSize=1*1024*1024*1024, highMemSize=0):
     self.rtc = rtc
-    self.totalMem = (1*1024*1024*1024 - 16*1024*1024)//(64*1024)
+    self.extMem   = min((lowMemSize - 1*1024*1024)//1024, 0xFFFF)                 # KiB above 1 MiB
+    self.totalMem = min((lowMemSize - 16*1024*1024)//(64*1024), 0xFFFF)         # 64 KiB units above 16 MiB
+    self.highMem  = min(highMemSize//(64*1024), 0xFF_FFFF)                      # 64 KiB units above 4 GiB
+    self.numCpus = numCpus
 
   reg0B = Register8(0x0B, initial=2)
   reg0C = Register8(0x0C, initial=0, ro=True)
   reg0D = Register8(0x0D, initial=0x80, set=lambda self, v: ())
+  reg30 = Register16(0x30, ro=True, get=lambda self: self.extMem)
   reg34 = Register16(0x34, ro=True, get=lambda self: self.totalMem)
+  reg5B = Register16(0x5B, ro=True, get=lambda self: self.highMem & 0xFFFF)
+  reg5D = Register8(0x5D, ro=True, get=lambda self: self.highMem >> 16)
+  reg5F = Register8(0x5F, ro=True, get=lambda self: self.numCpus - 1) # QEMU convention
 
   def onUnknownRead(self, addr, width):
     print('RTC get: 0x%x u%s' % (addr, width))
@@ -116,12 +126,28 @@ class SerialIo(MemoryHandler):
     else:
       self.ier.value = v
 
+  # Handles a PIO exit with a count greater than one on the data register by
+  # outputting the string in one go rather than a character at a time. KVM
+  # normally exits once per element for rep outsb, so this is a fallback.
+  def writeBlock(self, addr, width, data):
+    if addr != self.base or width != 1 or self.lcr.value & 0x80:
+      return super().writeBlock(addr, width, data)
+
+    self._outputChars(data)
+
   def _outputChar(self, v):
-    self._buf.append(v)
-    if v == 10:
-      sys.stdout.write('COM%s: %s' % (self._n+1, re_ansiEsc.sub('', bytes(self._buf).decode('ascii', errors='ignore'))))
-      sys.stdout.flush()
-      self._buf = []
+    self._outputChars((v,))
+
+  def _outputChars(self, data):
+    self._buf.extend(data)
+    if 10 not in data:
+      return
+
+    i = len(self._buf) - self._buf[::-1].index(10)
+    lines, self._buf = self._buf[:i], self._buf[i:]
+    for line in bytes(lines).splitlines(keepends=True):
+      sys.stdout.write('COM%s: %s' % (self._n+1, re_ansiEsc.sub('', line.decode('ascii', errors='ignore'))))
+    sys.stdout.flush()
 
 class PS2Device:
   def reset(self):
@@ -387,8 +413,12 @@ class PS2Io(MemoryHandler):
     self._device                = PS2Keyboard()
     self._device.notifyFunc     = self._onNotify
     self._lastIntrStatus        = False
+    self._irq                   = vm.createIrqLine(1)
     self.sysResetFunc           = sysResetFunc
 
+  def teardown(self):
+    self._irq.teardown()
+
   @property
   def keyboard(self):
     return self._device
@@ -519,6 +549,4 @@ class PS2Io(MemoryHandler):
     newIntrStatus = bool(self._ctlCfgRam[0] & 1) and (len(self._inputBuf) > 0 or self._device.poll())
     #if self._lastIntrStatus != newIntrStatus:
     self._lastIntrStatus = newIntrStatus
-    self._vm.setIrqLine(1, False)
-    if newIntrStatus:
-      self._vm.setIrqLine(1, newIntrStatus)
+    self._irq.set(newIntrStatus)
@@ -1,3 +1,4 @@
+import threading
 from iodev import *
 
 # A PCI bus-device-function value. This is a 16-bit integer of a format
@@ -74,6 +75,7 @@ class BDF:
 class PciSubsystem:
   def __init__(self):
     self.bdfs = {}
+    self.lock = threading.RLock() # serialises configuration space accesses
 
   def insert(self, dev, bdf=None):
     if bdf is None:
@@ -119,6 +121,8 @@ class PciFunctionBase:
   def cfgWrite(self, reg, v):
     raise NotImplementedError("%s does not support writing configuration register 0x%x (0x%x)" % (reg, v))
 
+PCI_COMMAND_MEMORY = (1<<1)  # memory space decoding enabled
+
 @registerDevice()
 class PciConfig:
   base = 0
@@ -129,7 +133,7 @@ class PciConfig:
 
   vendorID              = Register16(0x00, get=lambda self: self.device.vendorID, ro=True)
   deviceID              = Register16(0x02, get=lambda self: self.device.deviceID, ro=True)
-  command               = Register16(0x04)
+  command               = Register16(0x04, afterSet=lambda self, v: self.device.cfgCommandChanged())
   status                = Register16(0x06, ro=True)
   revision              = Register8 (0x08, get=lambda self: self.device.rev, ro=True)
   progIf                = Register8 (0x09, get=lambda self: self.device.progIf, ro=True)
@@ -184,22 +188,149 @@ class PciBar(MemoryHandler):
   base = 0xFFFFFFFF
 
 class PciRamBar(PciBar):
+  logDirty = False # track pages written by the guest; see MemorySlot.getDirtyLog
+
   def __init__(self, device):
     self._device = device
     self._slot = None
     self._lock = None
 
+  # The RAM is only mapped while the BAR is decoded (see
+  # PciFunction.barDecoded), and is reallocated whenever the BAR moves.
   def onBarUpdate(self):
+    base = self.base if self._device.barDecoded(self) else None
+    if (self._slot.guestPhysAddr if self._slot else None) == base:
+      return
+
     if self._lock:
       self._lock.acquire()
 
     if self._slot:
       self._slot.teardown()
-    self._slot = self._device._memoryManager.mapNew(self.base, self.len)
+      self._slot = None
+    if base is not None:
+      self._slot = self._device._memoryManager.mapNew(base, self.len, logDirty=self.logDirty)
 
     if self._lock:
       self._lock.release()
 
+  def onCommandUpdate(self):
+    self.onBarUpdate()
+
+MSIX_CTRL_FUNCTION_MASK = (1<<14)
+MSIX_CTRL_ENABLE        = (1<<15)
+MSIX_ENTRY_CTRL_MASKED  = (1<<0)
+MSIX_PBA_OFFSET         = 0x800
+
+# The MSI-X table and pending bit array of a PCI function, for use as a memory
+# BAR. The table is at offset 0 of the BAR and the PBA at MSIX_PBA_OFFSET. The
+# function's configuration space must have an MSI-X capability whose Message
+# Control register is backed by ctrl and setCtrl, with Table BIR/Offset and PBA
+# BIR/Offset pointing at this BAR.
+#
+# Devices call fire(vector) to send an interrupt, which may be done from any
+# thread. MSIs are delivered via VM.createMsiLine.
+class MsixTable(PciBar):
+  len = 4*1024
+
+  def __init__(self, device, numVectors):
+    assert numVectors <= 0x800 and numVectors*16 <= MSIX_PBA_OFFSET
+    self._device      = device
+    self.numVectors   = numVectors
+    self.entries      = [[0, 0, 0, MSIX_ENTRY_CTRL_MASKED] for i in range(numVectors)] # [addrLo, addrHi, data, ctrl]
+    self.pending      = 0     # bit n set if vector n is pending
+    self.enabled      = False
+    self.functionMask = False
+    self._lines       = {}    # vector → line
+    self.deviceLock   = threading.RLock()
+
+  @property
+  def ctrl(self):
+    return (self.numVectors-1) | (MSIX_CTRL_FUNCTION_MASK if self.functionMask else 0) | (MSIX_CTRL_ENABLE if self.enabled else 0)
+
+  def setCtrl(self, v):
+    with self.deviceLock:
+      self.enabled      = bool(v & MSIX_CTRL_ENABLE)
+      self.functionMask = bool(v & MSIX_CTRL_FUNCTION_MASK)
+      self._deliverPending()
+
+  # Sends an interrupt on the given vector, or sets its pending bit if it is
+  # masked. Returns False if MSI-X is disabled, in which case the device
+  # should use INTx instead.
+  def fire(self, vector):
+    with self.deviceLock:
+      if not self.enabled:
+        return False
+      if vector >= self.numVectors:
+        return True
+
+      if self.functionMask or self.entries[vector][3] & MSIX_ENTRY_CTRL_MASKED:
+        self.pending |= 1<<vector
+        return True
+
+      line = self._getLine(vector)
+
+    line.fire()
+    return True
+
+  def teardown(self):
+    with self.deviceLock:
+      for line in self._lines.values():
+        line.teardown()
+      self._lines = {}
+
+  # Must be called with deviceLock held.
+  def _getLine(self, vector):
+    addrLo, addrHi, data, ctrl = self.entries[vector]
+    addr = (addrHi<<32) | addrLo
+    line = self._lines.get(vector)
+    if line is None:
+      line = self._lines[vector] = self._device.pciSubsystem._vm.createMsiLine(addr, data)
+    else:
+      line.set(addr, data)
+    return line
+
+  # Must be called with deviceLock held.
+  def _deliverPending(self):
+    if not self.enabled or self.functionMask:
+      return
+
+    for vector in range(self.numVectors):
+      if self.pending & (1<<vector) and not self.entries[vector][3] & MSIX_ENTRY_CTRL_MASKED:
+        self.pending &= ~(1<<vector)
+        self._getLine(vector).fire()
+
+  def read32(self, addr):
+    offset = addr - self.base
+    if offset >= MSIX_PBA_OFFSET:
+      i = (offset - MSIX_PBA_OFFSET)*8
+      return (self.pending >> i) & 0xFFFF_FFFF
+
+    vector, field = divmod(offset, 16)
+    if vector >= self.numVectors:
+      return 0
+    return self.entries[vector][field//4]
+
+  def write32(self, addr, v):
+    offset = addr - self.base
+    if offset >= MSIX_PBA_OFFSET:
+      return # the PBA is read-only
+
+    vector, field = divmod(offset, 16)
+    if vector >= self.numVectors:
+      return
+
+    self.entries[vector][field//4] = v
+    if field//4 == 3:
+      self._deliverPending()
+
+  def read64(self, addr):
+    return self.read32(addr) | (self.read32(addr+4) << 32)
+
+  def write64(self, addr, v):
+    self.write32(addr, v & 0xFFFF_FFFF)
+    self.write32(addr+4, v >> 32)
+
 # A PCI function with a Type 0 header which implements basic functionality for
 # standard configuration registers.
 class PciFunction(PciFunctionBase):
@@ -221,9 +352,23 @@ class PciFunction(PciFunctionBase):
   def cfgBarChanged(self, barNo, v):
     if self.barHandlers[barNo]:
       self.barHandlers[barNo].base = v
+      handlerMoved(self.barHandlers[barNo])
       if hasattr(self.barHandlers[barNo], 'onBarUpdate'):
         self.barHandlers[barNo].onBarUpdate()
 
+  # Called after the command register is written. BAR handlers which depend on
+  # whether decoding is enabled can define onCommandUpdate to be notified.
+  def cfgCommandChanged(self):
+    for handler in self.barHandlers:
+      if handler is not None and hasattr(handler, 'onCommandUpdate'):
+        handler.onCommandUpdate()
+
+  # Returns True if the BAR handled by handler holds an address assigned by
+  # the guest and memory decoding is enabled, rather than being unassigned or
+  # holding the all-ones value written to size it.
+  def barDecoded(self, handler):
+    return bool(self.config.command.value & PCI_COMMAND_MEMORY) and handler.base not in (0, 0xFFFF_FFFF, 0xFFFF_FFFF & ~(handler.len-1))
+
   def addBarM32(self, barNo, handler):
     if type(self.bars) == tuple:
       self.bars         = list(self.bars)
@@ -245,6 +390,7 @@ class PciIoCfgDev(MemoryHandler):
 
   def __init__(self, pciSubsystem):
     self.pciSubsystem = pciSubsystem
+    self.deviceLock   = pciSubsystem.lock
 
   @cfc.getter
   def _(self):
@@ -268,6 +414,7 @@ class PciMmioCfgDev(MemoryHandler):
 
   def __init__(self, pciSubsystem):
     self.pciSubsystem = pciSubsystem
+    self.deviceLock   = pciSubsystem.lock
 
   def split(self, addr):
     bdf = (addr>>12) & 0xFFFF
@@ -1,4 +1,4 @@
-import sys, struct
+import sys, struct, threading, vmtrace
 from iodev import *
 from iodev_pci import *
 from iodev_pc import *
@@ -7,12 +7,13 @@ from iodev_tpm import *
 from iodev_virtio import *
 from memmgr import *
 from scsi import *
-import sdl2
+from display import *
 
 @registerDevice()
 class QemuDebugOutputDev(MemoryHandler):
   base = 0x402
   len  = 1
+  coalescedRanges = ((0, 1),)
 
   r402 = Register8(0, initial=0xE9)
 
@@ -21,11 +22,27 @@ class QemuDebugOutputDev(MemoryHandler):
 
   @r402.setter
   def _(self, v):
-    self._dbgStr.append(v & 0xFF)
-    if v == 10: # NL
-      sys.stdout.write('DBG: %s' % bytes(self._dbgStr).decode('utf-8'))
-      sys.stdout.flush()
-      self._dbgStr = []
+    self._output((v & 0xFF,))
+
+  # Handles a PIO exit with a count greater than one by outputting the string
+  # in one go. KVM normally exits once per element for rep outsb, so this is a
+  # fallback.
+  def writeBlock(self, addr, width, data):
+    if width != 1:
+      return super().writeBlock(addr, width, data)
+
+    self._output(data)
+
+  def _output(self, data):
+    self._dbgStr.extend(data)
+    if 10 not in data: # NL
+      return
+
+    i = len(self._dbgStr) - self._dbgStr[::-1].index(10)
+    lines, self._dbgStr = self._dbgStr[:i], self._dbgStr[i:]
+    for line in bytes(lines).splitlines(keepends=True):
+      sys.stdout.write('DBG: %s' % line.decode('utf-8', errors='replace'))
+    sys.stdout.flush()
 
 @registerDevice()
 class QemuFwCfg(MemoryHandler):
@@ -104,15 +121,13 @@ class QxlRegs(MemoryHandler):
     self._qxl = qxl
 
   def onModeChange(self):
-    e = sdl2.SDL_Event()
-    e.type = getSdlSyncEventNo()
-    print('@ModeChange:Event 0x%x' % e.type)
-    sdl2.SDL_PushEvent(e)
+    self._qxl.display.onModeChange()
 
 @registerDevice()
 class QxlIo(MemoryHandler):
   base = 0x1CE
   len  = 4
+  coalescedRanges = ((0, 4),) # VBE index/data; reads exit and see prior writes
 
   addr  = Register16(0)
   data  = Register16(2)
@@ -141,7 +156,8 @@ class QxlVgaIo(MemoryHandler):
   paletteData = Register8(0x9)
 
 class QxlBar0(PciRamBar):
-  len   = 16*1024*1024
+  len       = 16*1024*1024
+  logDirty  = True
 
 @registerDevice()
 class QxlBar2(MemoryHandler):
@@ -155,17 +171,6 @@ class QxlBar2(MemoryHandler):
   drawStart       = Register32(0x24, ro=True)
   availableFBSize = Register32(0x28, ro=True, initial=(16*1024*1024))
 
-def getSdlSyncEventNo():
-  v = None
-  def f():
-    nonlocal v
-    if v is None:
-      v = sdl2.SDL_RegisterEvents(1)
-    return v
-  return f
-
-getSdlSyncEventNo = getSdlSyncEventNo()
-
 class Qxl(PciFunction):
   bdf       = (0,1,0)
   vendorID  = 0x1B36
@@ -175,7 +180,7 @@ class Qxl(PciFunction):
   progIf    = 0x00
   rev       = 0
 
-  def __init__(self, memoryManager):
+  def __init__(self, memoryManager, display):
     super().__init__()
     self._memoryManager = memoryManager
     self._regs   = QxlRegs(self)
@@ -183,117 +188,49 @@ class Qxl(PciFunction):
     self.vgaIo   = QxlVgaIo(self)
     self.b0h     = self.addBarM32(0, QxlBar0(self))
     self.b2h     = self.addBarM32(2, QxlBar2(self))
-    self.keyEventHandler = None
+    self.fbLock  = self.b0h._lock = threading.Lock() # held while BAR0 is remapped
+    self.display = display
+    self.keyEventHandler = None # (down: bool, usbScancode: int) → ()
 
-    self._startVisualizer()
+    self.display.attach(self)
 
   def teardown(self):
-    self._visRun = False
-    self._visExitLock.acquire()
-
-  def _startVisualizer(self):
-    import threading, sdl2, ctypes
-
-    self._visRun = True
-
-    lock = threading.Lock()
-    self.b0h._lock = lock
-
-    exitLock = threading.Lock()
-    exitLock.acquire()
-    self._visExitLock = exitLock
-
-    def f():
-      sdl2.SDL_Init(sdl2.SDL_INIT_VIDEO)
-
-      w = sdl2.SDL_CreateWindow(b"Framebuffer", sdl2.SDL_WINDOWPOS_UNDEFINED, sdl2.SDL_WINDOWPOS_UNDEFINED, 800, 600, sdl2.SDL_WINDOW_SHOWN)
-      s = None
-      curUserspaceAddr = None
-
-      def onModeChange():
-        nonlocal s, curUserspaceAddr
-        if s is not None:
-          sdl2.SDL_FreeSurface(s)
-          s = None
-
-        if self.b0h._slot is None or self._regs.virtWidth.value == 0 or self._regs.virtHeight.value == 0:
-          print('@Mode Change: None (%s, %s, %s)' % (self.b0h._slot, self._regs.virtWidth.value, self._regs.virtHeight.value))
-          sdl2.SDL_SetWindowTitle(w, b'Framebuffer')
-          curUserspaceAddr = None
-          return
-
-        print('@Mode Change: w=%s, h=%s, bpp=%s' % (self._regs.virtWidth.value, self._regs.virtHeight.value, self._regs.bpp.value))
-
-        sdl2.SDL_SetWindowSize(w, self._regs.virtWidth.value, self._regs.virtHeight.value)
-        sdl2.SDL_SetWindowTitle(w, ("Framebuffer (%sx%sx%s)" % (self._regs.virtWidth.value, self._regs.virtHeight.value, self._regs.bpp.value)).encode('utf-8'))
-        curUserspaceAddr = self.b0h._slot.userspaceAddr
-        s = sdl2.SDL_CreateRGBSurfaceFrom(curUserspaceAddr,
-            self._regs.virtWidth.value,
-            self._regs.virtHeight.value,
-            self._regs.bpp.value,
-            (self._regs.virtWidth.value * self._regs.bpp.value) // 8,
-            0x00FF_0000, 0x0000_FF00, 0x0000_00FF, 0x0000_0000)
-
-      lock.acquire()
-      onModeChange()
-      lock.release()
-
-      e = sdl2.SDL_Event()
-      def handleEvent():
-        if e.type == getSdlSyncEventNo():
-          lock.acquire()
-          onModeChange()
-          lock.release()
-        elif e.type == sdl2.SDL_KEYDOWN or e.type == sdl2.SDL_KEYUP:
-          if self.keyEventHandler:
-            self.keyEventHandler(e)
-
-      while self._visRun:
-        if sdl2.SDL_WaitEventTimeout(ctypes.byref(e), 16) != 0:
-          handleEvent()
-          while sdl2.SDL_PollEvent(ctypes.byref(e)) != 0:
-            handleEvent()
-
-        lock.acquire()
-        if (curUserspaceAddr and self.b0h._slot is None) or (self.b0h._slot and curUserspaceAddr != self.b0h._slot.userspaceAddr):
-          onModeChange()
-
-        dsts = sdl2.SDL_GetWindowSurface(w)
-        if s is not None and dsts is not None:
-          sdl2.SDL_BlitSurface(s, None, dsts, None)
-
-        lock.release()
-        sdl2.SDL_UpdateWindowSurface(w)
-
-      if s:
-        sdl2.SDL_FreeSurface(s)
-        s = None
-
-      sdl2.SDL_DestroyWindow(w)
-      sdl2.SDL_Quit()
-      exitLock.release()
-
-    self._visThread = threading.Thread(target=f, name='QxlVis')
-    self._visThread.daemon = True
-    self._visThread.start()
+    self.display.detach(self)
+
+  # Called after the device state has been restored from a snapshot.
+  def onRestore(self):
+    self.display.onModeChange()
+
+  # Returns (slot, width, height, bpp, pitch) describing the framebuffer at the
+  # start of BAR0, or None if BAR0 is not mapped or no mode is set. Must be
+  # called with fbLock held.
+  def framebufferMode(self):
+    slot    = self.b0h._slot
+    width   = self._regs.virtWidth.value
+    height  = self._regs.virtHeight.value
+    bpp     = self._regs.bpp.value
+    if slot is None or width == 0 or height == 0:
+      return None
+
+    return slot, width, height, bpp, (width*bpp)//8
 
 class Q35PciSubsystem(PciSubsystem):
-  def __init__(self, memoryManager, vm, scsiSubsystem):
+  def __init__(self, memoryManager, vm, scsiSubsystem, display, virtioIoeventfd=False, scsiWorkers=0, scsiQueues=1):
     super().__init__()
     self.ich9       = self.insert(Q35PciIch9())
     self.ich9d31f0  = self.insert(Q35PciD31F0())
-    self.qxl        = self.insert(Qxl(memoryManager))
-    self.vioScsi    = self.insert(VirtioScsi(memoryManager, scsiSubsystem))
+    self.qxl        = self.insert(Qxl(memoryManager, display))
+    self.vioScsi    = self.insert(VirtioScsi(memoryManager, scsiSubsystem, ioeventfd=virtioIoeventfd, workers=scsiWorkers, numRequestQueues=scsiQueues))
     self._vm        = vm
 
-class Q35IOAddressSpace(AddressSpace):
-  def __init__(self, platform, pciSubsystem, vm):
+class Q35IOAddressSpace(IoPortAddressSpace):
+  def __init__(self, platform, pciSubsystem, vm, numCpus=1, lowMemSize=1*1024*1024*1024, highMemSize=0):
     super().__init__()
 
     self.qemuDebugOut = self.mount(QemuDebugOutputDev())
     self.qemuFwCfg    = self.mount(QemuFwCfg())
     self.pciCfgAccess = self.mount(PciIoCfgDev(pciSubsystem))
-    self.rtc          = self.mount(Rtc())
+    self.rtc          = self.mount(Rtc(numCpus, lowMemSize, highMemSize))
     self.port92       = self.mount(Port92())
     self.pm           = self.mount(Q35PmIo())
     self.com1         = self.mount(SerialIo(0))
@@ -305,11 +242,29 @@ class Q35IOAddressSpace(AddressSpace):
     self.vga          = self.mount(pciSubsystem.qxl.vgaIo)
     self.port80       = self.mount(Port80())
 
+# Guest RAM below 4 GiB ends at the start of the PCI hole, which on Q35 is where
+# the MMCONFIG window (PciMmioCfgDev) begins. As with QEMU, if RAM would not fit
+# below it, only 2 GiB is placed below 4 GiB, leaving the firmware room for
+# 32-bit BARs, and the remainder is placed at 4 GiB.
+Q35_LOW_MEM_LIMIT = 0xB000_0000
+Q35_LOW_MEM_SPLIT = 0x8000_0000
+HIGH_MEM_BASE     = 4*1024*1024*1024
+MIN_MEM_SIZE      = 64*1024*1024
+
+# (memSize: int) → (lowMemSize, highMemSize)
+def q35MemLayout(memSize):
+  if memSize < MIN_MEM_SIZE or memSize % (1024*1024) != 0:
+    raise Exception("invalid RAM size: 0x%x (must be a multiple of 1 MiB and at least %s MiB)" % (memSize, MIN_MEM_SIZE//(1024*1024)))
+
+  if memSize < Q35_LOW_MEM_LIMIT:
+    return memSize, 0
+  return Q35_LOW_MEM_SPLIT, memSize - Q35_LOW_MEM_SPLIT
+
 class Ram(MemoryHandler):
   base = 0
   len = 0
 
-  def __init__(self, memoryManager, firmwarePath):
+  def __init__(self, memoryManager, firmwarePath, lowMemSize=1*1024*1024*1024, highMemSize=0):
     self._memoryManager = memoryManager
 
     data = open(firmwarePath, 'rb').read()
@@ -317,8 +272,9 @@ class Ram(MemoryHandler):
     assert len(data) <= 4*1024*1024
     assert (len(data) % 4096) == 0
 
-    self._slot    = memoryManager.mapNew(0,                              1*1024*1024*1024)
-    self._fwSlot  = memoryManager.mapNew(4*1024*1024*1024 - len(data), len(data), ro=True)
+    self._slot      = memoryManager.mapNew(0, lowMemSize)
+    self._highSlot  = memoryManager.mapNew(HIGH_MEM_BASE, highMemSize) if highMemSize else None
+    self._fwSlot  = memoryManager.mapNew(4*1024*1024*1024 - len(data), len(data), ro=True, backing='anon')
 
     self._memoryManager.write(0x10_0000 - dataShortLen, data[-dataShortLen:])
     self._memoryManager.write(4*1024*1024*1024 - len(data), data)
@@ -342,7 +298,8 @@ class SysFlash(MemoryHandler):
 
   def read8(self, addr):
     addr -= self.base
-    print('@Flash read u8 0x%x' % addr)
+    if vmtrace.mask & vmtrace.FLASH:
+      vmtrace.emit(vmtrace.EV_FLASH_READ, addr, 1)
     if self._state == SYS_FLASH_STATE__NORMAL:
       return self._data[addr]
     elif self._state == SYS_FLASH_STATE__READ_STATUS_REG:
@@ -352,7 +309,8 @@ class SysFlash(MemoryHandler):
 
   def read16(self, addr):
     addr -= self.base
-    print('@Flash read u16 0x%x' % addr)
+    if vmtrace.mask & vmtrace.FLASH:
+      vmtrace.emit(vmtrace.EV_FLASH_READ, addr, 2)
     if self._state == SYS_FLASH_STATE__NORMAL:
       return struct.unpack('<H', self._data[addr:addr+2])[0]
     else:
@@ -360,7 +318,8 @@ class SysFlash(MemoryHandler):
 
   def read32(self, addr):
     addr -= self.base
-    print('@Flash read u32 0x%x' % addr)
+    if vmtrace.mask & vmtrace.FLASH:
+      vmtrace.emit(vmtrace.EV_FLASH_READ, addr, 4)
     if self._state == SYS_FLASH_STATE__NORMAL:
       return struct.unpack('<I', self._data[addr:addr+4])[0]
     else:
@@ -368,7 +327,8 @@ class SysFlash(MemoryHandler):
 
   def read64(self, addr):
     addr -= self.base
-    print('@Flash read u64 0x%x' % addr)
+    if vmtrace.mask & vmtrace.FLASH:
+      vmtrace.emit(vmtrace.EV_FLASH_READ, addr, 8)
     if self._state == SYS_FLASH_STATE__NORMAL:
       return struct.unpack('<Q', self._data[addr:addr+8])[0]
     else:
@@ -377,7 +337,8 @@ class SysFlash(MemoryHandler):
   # '89AB01234567'
   def write8(self, addr, v):
     addr -= self.base
-    print('@Flash write u8 0x%x = 0x%x' % (addr, v))
+    if vmtrace.mask & vmtrace.FLASH:
+      vmtrace.emit(vmtrace.EV_FLASH_WRITE, addr, v)
     if self._wstate == 0:
       if v == 0x10: # Single byte program
         self._state   = SYS_FLASH_STATE__SINGLE_BYTE_PROGRAM
@@ -403,12 +364,11 @@ class SysFlash(MemoryHandler):
 
   def _setByte(self, addr, v):
     self._data[addr] = v
-    print('@FL [0x%x] = 0x%x' % (addr, v))
     self._f.seek(addr)
     self._f.write(bytes([v]))
 
-class Q35MemoryAddressSpace(AddressSpace):
-  def __init__(self, pciSubsystem, memoryManager, firmwarePath, firmwareVarsPath):
+class Q35MemoryAddressSpace(IndexedAddressSpace):
+  def __init__(self, pciSubsystem, memoryManager, firmwarePath, firmwareVarsPath, lowMemSize=1*1024*1024*1024, highMemSize=0):
     super().__init__()
 
     self.tpmTis       = self.mount(TpmTis())
@@ -416,36 +376,59 @@ class Q35MemoryAddressSpace(AddressSpace):
     self.qxlBar0      = self.mount(pciSubsystem.qxl.b0h)
     self.qxlBar2      = self.mount(pciSubsystem.qxl.b2h)
     self.vioScsiBar0  = self.mount(pciSubsystem.vioScsi.b0h)
-    self.ram          = self.mount(Ram(memoryManager, firmwarePath))
+    self.vioScsiBar1  = self.mount(pciSubsystem.vioScsi.b1h)
+    self.ram          = self.mount(Ram(memoryManager, firmwarePath, lowMemSize, highMemSize))
     self.sysFlash     = self.mount(SysFlash(memoryManager, firmwareVarsPath))
 
 class Q35Platform:
-  def __init__(self, *, memoryManager, firmwarePath, firmwareVarsPath, vm, sysResetFunc, opticalPath=None, diskPath=None):
+  # memSize is the size of guest RAM in bytes; see q35MemLayout. diskCache and
+  # diskCacheSize configure the block cache of the SCSI devices. scsiQueues is
+  # the number of virtio-scsi request queues, by default one per vCPU.
+  def __init__(self, *, memoryManager, firmwarePath, firmwareVarsPath, vm, sysResetFunc, numCpus=1, memSize=1*1024*1024*1024, opticalPath=None, diskPath=None, diskCache='none', diskCacheSize=64*1024*1024, virtioIoeventfd=False, scsiWorkers=0, scsiQueues=None, display=None):
     self.memoryManager    = memoryManager
+    self.numCpus          = numCpus
+    self.lowMemSize, self.highMemSize = q35MemLayout(memSize)
     self.firmwarePath     = firmwarePath
     self.firmwareVarsPath = firmwareVarsPath
     self.vm               = vm
     self._sysResetFunc    = sysResetFunc
     self._opticalPath     = opticalPath
     self._diskPath        = diskPath
+    self._diskCache       = diskCache
+    self._diskCacheSize   = diskCacheSize
+    self._virtioIoeventfd = virtioIoeventfd
+    self._scsiWorkers     = scsiWorkers
+    self._scsiQueues      = scsiQueues or numCpus
+    self.display          = display or HeadlessDisplay()
     self._reset()
 
   def _reset(self):
-    self.scsiSubsystem  = ScsiSubsystem(opticalPath=self._opticalPath, diskPath=self._diskPath)
-    self.pciSubsystem   = Q35PciSubsystem(self.memoryManager, self.vm, self.scsiSubsystem)
-    self.iospace        = Q35IOAddressSpace(self, self.pciSubsystem, self.vm)
-    self.mspace         = Q35MemoryAddressSpace(self.pciSubsystem, self.memoryManager, self.firmwarePath, self.firmwareVarsPath)
-
-    def onKey(e):
-      if e.type == sdl2.SDL_KEYDOWN:
-        self.iospace.ps2.keyboard.keyDown(e.key.keysym.scancode)
-      elif e.type == sdl2.SDL_KEYUP:
-        self.iospace.ps2.keyboard.keyUp(e.key.keysym.scancode)
+    self.scsiSubsystem  = ScsiSubsystem(opticalPath=self._opticalPath, diskPath=self._diskPath, cacheMode=self._diskCache, cacheSize=self._diskCacheSize)
+    self.pciSubsystem   = Q35PciSubsystem(self.memoryManager, self.vm, self.scsiSubsystem, self.display, virtioIoeventfd=self._virtioIoeventfd, scsiWorkers=self._scsiWorkers, scsiQueues=self._scsiQueues)
+    self.iospace        = Q35IOAddressSpace(self, self.pciSubsystem, self.vm, self.numCpus, self.lowMemSize, self.highMemSize)
+    self.mspace         = Q35MemoryAddressSpace(self.pciSubsystem, self.memoryManager, self.firmwarePath, self.firmwareVarsPath, self.lowMemSize, self.highMemSize)
+
+    def onKey(down, scancode):
+      with self.iospace.ps2.deviceLock:
+        if down:
+          self.iospace.ps2.keyboard.keyDown(scancode)
+        else:
+          self.iospace.ps2.keyboard.keyUp(scancode)
 
     self.pciSubsystem.qxl.keyEventHandler = onKey
 
+  # Requests a system reset. The reset is performed by the VMM once all vCPUs
+  # have been stopped, by calling teardown(), resetting memory and vCPUs, and
+  # then calling reset().
   def sysReset(self):
     print('System reset')
-    self.pciSubsystem.qxl.teardown()
     self._sysResetFunc()
+
+  def teardown(self):
+    self.pciSubsystem.qxl.teardown()
+    self.pciSubsystem.vioScsi.teardown()
+    self.scsiSubsystem.teardown()
+    self.iospace.ps2.teardown()
+
+  def reset(self):
     self._reset()
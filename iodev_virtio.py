@@ -1,9 +1,23 @@
-import struct, io
+import struct, os, threading, collections, concurrent.futures, traceback
+import vmtrace
 from iodev import *
 from iodev_pci import *
 from memmgr import *
 from scsi import *
 
+# Virtqueues of a virtio-scsi device. Queues from VIRTIO_SCSI_Q_REQUEST onwards
+# are request queues.
+VIRTIO_SCSI_Q_CONTROL   = 0
+VIRTIO_SCSI_Q_EVENT     = 1
+VIRTIO_SCSI_Q_REQUEST   = 2
+
+# Offset of the queue notification registers in BAR 0. Each queue has its own
+# 16-bit register, at VIRTIO_NOTIFY_OFFSET + VIRTIO_NOTIFY_MUL*queueNo, so that
+# the notifications of each queue can be bound to their own ioeventfd and
+# backend thread.
+VIRTIO_NOTIFY_OFFSET    = 0x70
+VIRTIO_NOTIFY_MUL       = 2
+
 @registerDevice()
 class VirtioScsiConfig(PciConfig):
   capCommon_id     = Register8 (0x40, ro=True, initial=0x09)
@@ -19,9 +33,9 @@ class VirtioScsiConfig(PciConfig):
   capNotify_clen   = Register8 (0x52, ro=True, initial=20)
   capNotify_type   = Register8 (0x53, ro=True, initial=2)
   capNotify_bar    = Register32(0x54, ro=True, initial=0) # low 8 bits are BAR index
-  capNotify_offset = Register32(0x58, ro=True, initial=0x70)
-  capNotify_len    = Register32(0x5C, ro=True, initial=2)
-  capNotify_mul    = Register32(0x60, ro=True, initial=2)
+  capNotify_offset = Register32(0x58, ro=True, initial=VIRTIO_NOTIFY_OFFSET)
+  capNotify_len    = Register32(0x5C, ro=True, get=lambda self: VIRTIO_NOTIFY_MUL*self.device.b0h.numQueues)
+  capNotify_mul    = Register32(0x60, ro=True, initial=VIRTIO_NOTIFY_MUL)
 
   capIsr_id     = Register8 (0x64, ro=True, initial=0x09)
   capIsr_next   = Register8 (0x65, ro=True, initial=0x74)
@@ -40,7 +54,7 @@ class VirtioScsiConfig(PciConfig):
   capDevice_len    = Register32(0x80, ro=True, initial=0x24)
 
   capPci_id     = Register8 (0x84, ro=True, initial=0x09)
-  capPci_next   = Register8 (0x85, ro=True, initial=0)
+  capPci_next   = Register8 (0x85, ro=True, initial=0x98)
   capPci_clen   = Register8 (0x86, ro=True, initial=20)
   capPci_type   = Register8 (0x87, ro=True, initial=5)
   capPci_bar    = Register32(0x88, ro=True, initial=0) # low 8 bits are BAR index
@@ -48,20 +62,56 @@ class VirtioScsiConfig(PciConfig):
   capPci_len    = Register32(0x90, ro=True, initial=0)
   capPci_data   = Register32(0x94, ro=True, initial=0)
 
+  # MSI-X, with the table and PBA in BAR 1.
+  capMsix_id    = Register8 (0x98, ro=True, initial=0x11)
+  capMsix_next  = Register8 (0x99, ro=True, initial=0)
+  capMsix_ctrl  = Register16(0x9A, get=lambda self: self.device.msix.ctrl, set=lambda self, v: self.device.msix.setCtrl(v))
+  capMsix_table = Register32(0x9C, ro=True, initial=1)                   # low 3 bits are BAR index
+  capMsix_pba   = Register32(0xA0, ro=True, initial=MSIX_PBA_OFFSET | 1) # low 3 bits are BAR index
+
   def __init__(self, device):
     super().__init__(device)
     self.capPtr.value = 0x40
     self.status.value = self.status.value | (1<<4)
     self.intrPin.value = 1
 
+VIRTIO_MSI_NO_VECTOR    = 0xFFFF
+
+VIRTIO_F_INDIRECT_DESC  = 28
 VIRTIO_F_RING_EVENT_IDX = 29
 VIRTIO_F_VERSION_1      = 32
+VIRTIO_F_RING_PACKED    = 34
 
 VIRTIO_SCSI_F_INOUT     = 0
 VIRTIO_SCSI_F_HOTPLUG   = 1
 VIRTIO_SCSI_F_CHANGE    = 2
 VIRTIO_SCSI_F_T10_PI    = 3
 
+VIRTQ_DESC_F_NEXT       = 1
+VIRTQ_DESC_F_WRITE      = 2
+VIRTQ_DESC_F_INDIRECT   = 4
+VIRTQ_DESC_F_AVAIL      = 1<<7  # packed rings only
+VIRTQ_DESC_F_USED       = 1<<15 # packed rings only
+
+VIRTQ_AVAIL_F_NO_INTERRUPT = 1
+
+# Event suppression flags of packed rings.
+RING_EVENT_FLAGS_ENABLE   = 0
+RING_EVENT_FLAGS_DISABLE  = 1
+RING_EVENT_FLAGS_DESC     = 2
+
+# Returns True if moving an index from oldIdx to newIdx passes eventIdx, that
+# is, if the other side asked to be notified once the entry at eventIdx has
+# been made available or used.
+def vringNeedEvent(eventIdx, newIdx, oldIdx):
+  return ((newIdx - eventIdx - 1) & 0xFFFF) < ((newIdx - oldIdx) & 0xFFFF)
+
+# Sizes of the virtqueues offered to the driver. Requests can use indirect
+# descriptor tables, so a request of any size takes one entry of a request
+# queue; the queue size bounds the number of requests in flight.
+VIRTIO_SCSI_CTRL_QUEUE_LEN      = 64
+VIRTIO_SCSI_REQUEST_QUEUE_LEN   = 1024
+
 VIRTIO_SCSI_S_OK                = 0
 VIRTIO_SCSI_S_OVERRUN           = 1
 VIRTIO_SCSI_S_ABORTED           = 2
@@ -73,6 +123,61 @@ VIRTIO_SCSI_S_TARGET_FAILURE    = 7
 VIRTIO_SCSI_S_NEXUS_FAILURE     = 8
 VIRTIO_SCSI_S_FAILURE           = 9
 
+# Binds the notification address of a virtqueue to an eventfd using
+# KVM_IOEVENTFD, so that guest kicks are absorbed by the kernel without an
+# exit, and services the eventfd on a dedicated thread which calls
+# func(queueNo) for each batch of kicks.
+class VirtioIoeventfdWorker:
+  def __init__(self, vm, queueNo, func):
+    self._vm      = vm
+    self._queueNo = queueNo
+    self._func    = func
+    self._fd      = os.eventfd(0, os.EFD_CLOEXEC)
+    self._addr    = None
+    self._run     = True
+    self._thread  = threading.Thread(target=self._loop, name='VirtioQ%s' % queueNo, daemon=True)
+    self._thread.start()
+
+  # Moves the binding to a new notification address.
+  def bind(self, addr):
+    if addr == self._addr:
+      return
+
+    self.unbind()
+    try:
+      self._vm.assignIoeventfd(self._fd, addr, 2, datamatch=self._queueNo)
+      self._addr = addr
+    except OSError as e:
+      print('@Virtio: warning: cannot assign ioeventfd for queue %s at 0x%x: %s' % (self._queueNo, addr, e))
+
+  def unbind(self):
+    if self._addr is None:
+      return
+
+    self._vm.deassignIoeventfd(self._fd, self._addr, 2, datamatch=self._queueNo)
+    self._addr = None
+
+  def teardown(self):
+    self.unbind()
+    self._run = False
+    os.eventfd_write(self._fd, 1)
+    self._thread.join()
+    os.close(self._fd)
+
+  # An exception raised while processing a queue is logged and the worker
+  # keeps going, as otherwise the queue would never be serviced again.
+  def _loop(self):
+    while True:
+      os.eventfd_read(self._fd)
+      if not self._run:
+        break
+
+      try:
+        self._func(self._queueNo)
+      except Exception as e:
+        print('@Virtio: exception while processing queue %s: %s' % (self._queueNo, e))
+        traceback.print_exc()
+
 @registerDevice()
 class VirtioScsiBar0(PciBar):
   len = 4*1024
@@ -81,8 +186,8 @@ class VirtioScsiBar0(PciBar):
   comDevFeat    = Register32(0x04, ro=True)
   comDrvFeatSel = Register32(0x08)
   comDrvFeat    = Register32(0x0C)
-  comMsixCfg    = Register16(0x10)
-  comNumQueue   = Register16(0x12, ro=True, initial=3)
+  comMsixCfg    = Register16(0x10, get=lambda self: self._msixConfigVector)
+  comNumQueue   = Register16(0x12, ro=True, get=lambda self: self.numQueues)
   comDevStatus  = Register8 (0x14, afterSet=lambda self, v: self._onDevStatusChange(v))
   comCfgGen     = Register8 (0x15, ro=True)
 
@@ -90,16 +195,18 @@ class VirtioScsiBar0(PciBar):
   comQueueLen         = Register16(0x18)
   comQueueMsixVector  = Register16(0x1A)
   comQueueEnable      = Register16(0x1C)
-  comQueueNotifyOff   = Register16(0x1E, ro=True)
+  comQueueNotifyOff   = Register16(0x1E, ro=True, get=lambda self: self.comQueueSel.value if self.comQueueSel.value < self.numQueues else 0)
   comQueueDesc        = Register64(0x20)
   comQueueDrv         = Register64(0x28)
   comQueueDev         = Register64(0x30)
 
   isrStatus           = Register8 (0x40, ro=True)
 
-  scsiNumQueue        = Register32(0x44, ro=True, initial=1)
-  scsiSegMax          = Register32(0x48, ro=True, initial=4)
-  scsiMaxSectors      = Register32(0x4C, ro=True, initial=128*1024)
+  scsiNumQueue        = Register32(0x44, ro=True, get=lambda self: self.numQueues - VIRTIO_SCSI_Q_REQUEST)
+  scsiSegMax          = Register32(0x48, ro=True, get=lambda self: self._maxQueueLens[VIRTIO_SCSI_Q_REQUEST] - 2)
+  # The largest transfer length of READ (10) and WRITE (10), as the 16-byte
+  # CDBs are not implemented.
+  scsiMaxSectors      = Register32(0x4C, ro=True, initial=0xFFFF)
   scsiCmdPerLun       = Register32(0x50, ro=True, initial=16)
   scsiEventInfoLen    = Register32(0x54, ro=True)
   scsiSenseLen        = Register32(0x58, initial=96)
@@ -108,7 +215,21 @@ class VirtioScsiBar0(PciBar):
   scsiMaxTarget       = Register16(0x62, ro=True, initial=1)
   scsiMaxLun          = Register32(0x64, ro=True, initial=1)
 
-  notify0             = Register16(0x70, set=lambda self, v: self._onNotify(v))
+  # Queue notification registers, which are not declared as registers as their
+  # number depends on the number of queues.
+  def onUnknownWrite(self, addr, v, width):
+    off = addr - self.base - VIRTIO_NOTIFY_OFFSET
+    if width != 16 or off < 0 or off % VIRTIO_NOTIFY_MUL or off // VIRTIO_NOTIFY_MUL >= self.numQueues:
+      raise Exception("%s: unknown register write: 0x%x (+0x%x) u%s = 0x%x" % (self, addr, addr-self.base, width, v))
+
+    self._onNotify(off // VIRTIO_NOTIFY_MUL)
+
+  def onUnknownRead(self, addr, width):
+    off = addr - self.base - VIRTIO_NOTIFY_OFFSET
+    if off < 0 or off >= VIRTIO_NOTIFY_MUL*self.numQueues:
+      raise Exception("%s: unknown register read: 0x%x (+0x%x) u%s" % (self, addr, addr-self.base, width))
+
+    return 0
 
   @comDevFeat.getter
   def _(self):
@@ -123,6 +244,7 @@ class VirtioScsiBar0(PciBar):
   @comDrvFeat.getter
   def _(self):
     pageNo = self.comDrvFeatSel.value
+    v = 0
     for i in range(32):
       if self._getDrvFeature(pageNo*32 + i):
         v = v|(1<<i)
@@ -136,19 +258,32 @@ class VirtioScsiBar0(PciBar):
       self._setDrvFeature(pageNo*32 + i, bool(v & (1<<i)))
 
   def _getDevFeature(self, n):
-    return n in (VIRTIO_F_VERSION_1, VIRTIO_SCSI_F_INOUT)
+    return n in (VIRTIO_F_VERSION_1, VIRTIO_F_INDIRECT_DESC, VIRTIO_F_RING_EVENT_IDX, VIRTIO_F_RING_PACKED, VIRTIO_SCSI_F_INOUT)
 
   def _getDrvFeature(self, n):
-    return False
+    return bool(self._drvFeatures & (1<<n))
 
   def _setDrvFeature(self, n, on):
-    print('@Virtio: feature %s on=%s' % (n, on))
+    if on and not self._getDevFeature(n):
+      print('@Virtio: driver accepted unoffered feature %s' % n)
+      return
+
+    if on != self._getDrvFeature(n):
+      print('@Virtio: feature %s on=%s' % (n, on))
+    self._drvFeatures = (self._drvFeatures | (1<<n)) if on else (self._drvFeatures & ~(1<<n))
 
   def _onDevStatusChange(self, v):
     print('@Virtio: dev status=0x%x' % v)
     if v == 0:
       print('@Virtio: resetting device')
-      self._reset()
+      for lock in self._queueLocks:
+        lock.acquire()
+      try:
+        self._waitIdle()
+        self._reset()
+      finally:
+        for lock in self._queueLocks:
+          lock.release()
 
   @comQueueLen.getter
   def _(self):
@@ -166,6 +301,33 @@ class VirtioScsiBar0(PciBar):
 
     self._queueLens[queueNo] = min(v, self._maxQueueLens[queueNo])
 
+  # A vector which cannot be used reads back as VIRTIO_MSI_NO_VECTOR, so that
+  # the driver can tell that the mapping failed.
+  def _checkMsixVector(self, v):
+    if v >= self._device.msix.numVectors:
+      return VIRTIO_MSI_NO_VECTOR
+    return v
+
+  @comMsixCfg.setter
+  def _(self, v):
+    self._msixConfigVector = self._checkMsixVector(v)
+
+  @comQueueMsixVector.getter
+  def _(self):
+    queueNo = self.comQueueSel.value
+    if queueNo >= len(self._queueMsixVectors):
+      return VIRTIO_MSI_NO_VECTOR
+
+    return self._queueMsixVectors[queueNo]
+
+  @comQueueMsixVector.setter
+  def _(self, v):
+    queueNo = self.comQueueSel.value
+    if queueNo >= len(self._queueMsixVectors):
+      return
+
+    self._queueMsixVectors[queueNo] = self._checkMsixVector(v)
+
   @comQueueEnable.getter
   def _(self):
     queueNo = self.comQueueSel.value
@@ -232,23 +394,138 @@ class VirtioScsiBar0(PciBar):
 
   @isrStatus.getter
   def _(self):
-    v = self.isrStatus.value
-    self.isrStatus.value = 0
-    self._updateIntr()
+    with self._intrLock:
+      v = self.isrStatus.value
+      self.isrStatus.value = 0
+      self._updateIntr()
     return v
 
-  def _assertQueueIntr(self):
-    self.isrStatus.value = self.isrStatus.value | (1<<0)
-    self._updateIntr()
+  # Signals that the used rings of the given queues have been updated, except
+  # for queues on which the driver has suppressed interrupts. If MSI-X is
+  # enabled, the vector of each queue is fired; otherwise the queue interrupt
+  # bit of the ISR is set and INTx is asserted.
+  def _assertQueueIntr(self, queueNos):
+    with self._intrLock:
+      queueNos = [queueNo for queueNo in queueNos if self._needQueueIntr(queueNo)]
+    if not queueNos:
+      return
 
-  def _updateIntr(self):
-    self._device.pciSubsystem._vm.setIrqLine(self._device.config.intrLine.value, bool(self.isrStatus.value))
+    msix = self._device.msix
+    if all([msix.fire(self._queueMsixVectors[queueNo]) for queueNo in queueNos]):
+      return
+
+    with self._intrLock:
+      self.isrStatus.value = self.isrStatus.value | (1<<0)
+      self._updateIntr()
+
+  # Returns True if the driver wants an interrupt for the buffers used on the
+  # queue since the last time this was called. With VIRTIO_F_RING_EVENT_IDX,
+  # that is when the used index has passed the index the driver last asked to
+  # be interrupted at; otherwise it is unless the driver has disabled
+  # interrupts with a flag. The driver updates its event index before
+  # rechecking the used index, so the used index must be visible to it before
+  # the event index is read. Must be called with _intrLock held.
+  def _needQueueIntr(self, queueNo):
+    mm        = self._device._memoryManager
+    eventIdx  = self._getDrvFeature(VIRTIO_F_RING_EVENT_IDX)
+    pDrvArea  = self._queueDriverAreas[queueNo]
+    oldIdx    = self._queueSignalledUsedIdx[queueNo]
+    newIdx    = self._queueSignalledUsedIdx[queueNo] = self._queueUsedIdx[queueNo]
+
+    memoryBarrier()
+    if self._getDrvFeature(VIRTIO_F_RING_PACKED):
+      event = mm.read(pDrvArea, 4)
+      if event is None:
+        return True
+
+      offWrap, flags = struct.unpack('<HH', event)
+      if flags == RING_EVENT_FLAGS_DISABLE:
+        return False
+      if flags != RING_EVENT_FLAGS_DESC or not eventIdx or oldIdx is None:
+        return True
+
+      off = offWrap & 0x7FFF
+      if bool(offWrap >> 15) != self._queueUsedWrap[queueNo]:
+        off -= self._queueLens[queueNo]
+      return vringNeedEvent(off, newIdx, oldIdx)
+
+    if eventIdx:
+      usedEvent = mm.read(pDrvArea+4+2*self._queueLens[queueNo], 2)
+      if usedEvent is None or oldIdx is None:
+        return True
+      return vringNeedEvent(struct.unpack('<H', usedEvent)[0], newIdx, oldIdx)
+
+    availFlags = mm.read(pDrvArea, 2)
+    return availFlags is None or not struct.unpack('<H', availFlags)[0] & VIRTQ_AVAIL_F_NO_INTERRUPT
 
-  def _onNotify(self, queueIdx):
+  def _updateIntr(self):
+    level = bool(self.isrStatus.value)
+    gsi   = self._device.config.intrLine.value
+    if self._irq is None or self._irq.gsi != gsi:
+      if not level:
+        return
+      if self._irq is not None:
+        self._irq.set(False)
+        self._irq.teardown()
+      self._irq = self._device.pciSubsystem._vm.createIrqLine(gsi, level=True)
+
+    self._irq.set(level)
+
+  # Notifications received while the device is paused are dropped; resume()
+  # processes every queue afterwards instead. resetCount is the value of
+  # _resetCount when a deferred notification was made, which is dropped if the
+  # device has been reset since. The queue state is checked with the queue lock
+  # held, as a reset holds every queue lock.
+  def _onNotify(self, queueIdx, resetCount=None):
     if queueIdx >= len(self._queueLens):
       return
 
-    self._syncProcessAvail(queueIdx)
+    with self._queueLocks[queueIdx]:
+      if not self._running.is_set() or (resetCount is not None and resetCount != self._resetCount):
+        return
+      if not self._queueEnables[queueIdx] or not self._queueDescriptorAreas[queueIdx] or not self._queueDriverAreas[queueIdx] or not self._queueDeviceAreas[queueIdx]:
+        return
+      self._syncProcessAvail(queueIdx)
+
+  # Called when the guest moves the BAR. Rebinds the queue notification
+  # eventfds, if in use, to the new notification addresses.
+  # Queue notifications are only bound to ioeventfds while the BAR is decoded
+  # at an assigned address; see PciFunction.barDecoded.
+  def onBarUpdate(self):
+    if not self._useIoeventfd:
+      return
+
+    if not self._device.barDecoded(self):
+      for w in self._ioeventfdWorkers or ():
+        w.unbind()
+      return
+
+    if self._ioeventfdWorkers is None:
+      vm = self._device.pciSubsystem._vm
+      self._ioeventfdWorkers = [VirtioIoeventfdWorker(vm, i, self._onNotify) for i in range(self.numQueues)]
+
+    for i, w in enumerate(self._ioeventfdWorkers):
+      w.bind(self.base + VIRTIO_NOTIFY_OFFSET + VIRTIO_NOTIFY_MUL*i)
+
+  def onCommandUpdate(self):
+    self.onBarUpdate()
+
+  def teardown(self):
+    if self._executor is not None:
+      self._stopping = True
+      self._executor.shutdown(wait=True)
+
+    with self._intrLock:
+      if self._irq is not None:
+        self._irq.teardown()
+        self._irq = None
+
+    if self._ioeventfdWorkers is None:
+      return
+
+    for w in self._ioeventfdWorkers:
+      w.teardown()
+    self._ioeventfdWorkers = None
 
   def _setQueueDescriptorArea(self, queueNo, v):
     self._queueDescriptorAreas[queueNo] = v
@@ -259,66 +536,149 @@ class VirtioScsiBar0(PciBar):
   def _setQueueDeviceArea(self, queueNo, v):
     self._queueDeviceAreas[queueNo] = v
 
+  # Processes the buffers made available on the queue. With
+  # VIRTIO_F_RING_EVENT_IDX, once the device has caught up with the driver it
+  # publishes the avail index it has reached as avail_event, so that the driver
+  # only kicks for buffers made available after that, and then checks for
+  # buffers which were made available before the driver could see it.
   def _syncProcessAvail(self, queueNo):
+    if self._getDrvFeature(VIRTIO_F_RING_PACKED):
+      return self._syncProcessAvailPacked(queueNo)
+
     queueLen    = self._queueLens[queueNo]
     pAvailRing  = self._queueDriverAreas[queueNo]
-
-    avails = self._device._memoryManager.read(pAvailRing, 2+2+2*queueLen+2)
-    if avails is None:
-      print('@Virtio: cannot get buffer for avail ring 0x%x' % pAvailRing)
-      return
-
-    availFlags, availIdx = struct.unpack('<HH', avails[0:4])
+    pUsedRing   = self._queueDeviceAreas[queueNo]
+    eventIdx    = self._getDrvFeature(VIRTIO_F_RING_EVENT_IDX)
+    mm          = self._device._memoryManager
 
     curAvailIdx = self._queueAvailIdx[queueNo]
-    while curAvailIdx != availIdx:
-      headDescIdx = struct.unpack('<H', avails[4+2*(curAvailIdx%queueLen):4+2*(curAvailIdx%queueLen)+2])[0]
-      curAvailIdx = (curAvailIdx+1) & 0xFFFF
-      self._syncProcessDescriptor(queueNo, headDescIdx)
+    published   = False
+    while True:
+      avails = mm.read(pAvailRing, 2+2+2*queueLen+2)
+      if avails is None:
+        print('@Virtio: cannot get buffer for avail ring 0x%x' % pAvailRing)
+        return
 
-    self._queueAvailIdx[queueNo] = curAvailIdx
+      availFlags, availIdx = struct.unpack('<HH', avails[0:4])
+      if curAvailIdx == availIdx:
+        if published or not eventIdx:
+          return
+
+        mm.write(pUsedRing+2+2+8*queueLen, struct.pack('<H', curAvailIdx))
+        memoryBarrier()
+        published = True
+        continue
+
+      published = False
+      while curAvailIdx != availIdx:
+        if self._executor is not None and not self._reserveInFlight(queueNo):
+          return
+        headDescIdx = struct.unpack('<H', avails[4+2*(curAvailIdx%queueLen):4+2*(curAvailIdx%queueLen)+2])[0]
+        curAvailIdx = (curAvailIdx+1) & 0xFFFF
+        self._queueAvailIdx[queueNo] = curAvailIdx
+        self._syncProcessDescriptor(queueNo, headDescIdx)
 
   def _syncProcessDescriptor(self, queueNo, headDescIdx):
+    self._dispatchBuffers(queueNo, self._readDescriptorChain(queueNo, headDescIdx), headDescIdx)
+
+  # Executes the request in bufs, which is (MultiReadBuffer, MultiWriteBuffer)
+  # or None if the descriptors could not be read, and returns the buffer to
+  # the used ring. headDescIdx is the head descriptor index of a split ring
+  # buffer, or the buffer ID of a packed ring buffer, and numDescs is the
+  # number of ring entries the buffer occupies (packed rings only).
+  def _dispatchBuffers(self, queueNo, bufs, headDescIdx, numDescs=1):
+    if bufs is None:
+      if self._executor is not None:
+        self._releaseInFlight()
+      return
+
+    rbuf, wbuf = bufs
+    if self._executor is not None:
+      self._executor.submit(self._asyncProcessBuffers, queueNo, headDescIdx, numDescs, rbuf, wbuf)
+      return
+
+    wbufLen = wbuf.remaining
+    self._syncProcessBuffers(queueNo, rbuf, wbuf)
+    self._syncProcessUsed(queueNo, headDescIdx, wbufLen - wbuf.remaining, numDescs)
+
+  # Returns (MultiReadBuffer, MultiWriteBuffer) for the chain starting at the
+  # given descriptor, or None if the chain is invalid.
+  #
+  # A descriptor with VIRTQ_DESC_F_INDIRECT refers to a table of descriptors
+  # in guest memory, which is read in one go and holds the rest of the chain.
+  # Tables are limited to the size of the queue, as seg_max is derived from
+  # it, and are rejected before being read if they are longer. Chains longer
+  # than the table they are in must contain a loop, and are rejected.
+  def _readDescriptorChain(self, queueNo, headDescIdx):
     queueLen      = self._queueLens[queueNo]
     pDescriptors  = self._queueDescriptorAreas[queueNo]
+    mm            = self._device._memoryManager
 
     curDescIdx  = headDescIdx
+    table       = None      # contents of the indirect table, once in one
+    numDescs    = queueLen  # number of descriptors in the current table
+    count       = 0
     readBufs    = []
     writeBufs   = []
 
     while True:
-      if curDescIdx >= queueLen:
+      if curDescIdx >= numDescs or count >= numDescs:
         print('@Virtio: invalid descriptor index 0x%x' % headDescIdx)
         return
+      count += 1
 
-      descBuf = self._device._memoryManager.read(pDescriptors + 16*(curDescIdx%queueLen), 16)
-      if descBuf is None:
-        print('@Virtio: cannot get buffer for desc 0x%x' % headDescIdx)
-        return
+      if table is None:
+        descBuf = mm.read(pDescriptors + 16*curDescIdx, 16)
+        if descBuf is None:
+          print('@Virtio: cannot get buffer for desc 0x%x' % headDescIdx)
+          return
+      else:
+        descBuf = table[16*curDescIdx:16*curDescIdx+16]
 
       dAddr, dLen, dFlags, dNext = struct.unpack('<QIHH', descBuf)
-      print('@Virtio: DESC 0x%04x: a=0x%x L=0x%x flags=0x%x next=0x%x' % (curDescIdx, dAddr, dLen, dFlags, dNext))
-      if dFlags & 4: # INDIRECT
-        raise Exception("indirect descriptors not supported")
+      if vmtrace.mask & vmtrace.VIRTIO:
+        vmtrace.emit(vmtrace.EV_VIRTIO_DESC, dAddr, dLen, dFlags)
+
+      if dFlags & VIRTQ_DESC_F_INDIRECT:
+        if table is not None or dLen == 0 or dLen % 16 or dLen > 16*queueLen or not self._getDrvFeature(VIRTIO_F_INDIRECT_DESC):
+          print('@Virtio: invalid indirect desc 0x%x' % curDescIdx)
+          return
+
+        table = mm.read(dAddr, dLen)
+        if table is None:
+          print('@Virtio: cannot get buffer for indirect table 0x%x' % dAddr)
+          return
 
-      isWrite = bool(dFlags & 2)
+        numDescs    = dLen // 16
+        curDescIdx  = 0
+        count       = 0
+        continue
+
+      isWrite = bool(dFlags & VIRTQ_DESC_F_WRITE)
       extents = self._device._memoryManager.resolveExtents(dAddr, dLen)
+      if extents is None:
+        print('@Virtio: cannot get buffer for desc 0x%x data 0x%x' % (curDescIdx, dAddr))
+        return
+
       if isWrite:
         writeBufs += extents
       else:
         readBufs += extents
 
       curDescIdx = dNext
-      if (dFlags & 1) == 0:
+      if (dFlags & VIRTQ_DESC_F_NEXT) == 0:
         break
 
-    rbuf = MultiReadBuffer(readBufs)
-    wbuf = MultiWriteBuffer(writeBufs)
-    wbufLen = wbuf.remaining
-    self._syncProcessBuffers(queueNo, rbuf, wbuf)
-    self._syncProcessUsed(queueNo, headDescIdx, wbufLen - wbuf.remaining)
+    return MultiReadBuffer(readBufs), MultiWriteBuffer(writeBufs)
+
+  def _syncProcessUsed(self, queueNo, headDescIdx, totalWritten, numDescs=1):
+    self._publishUsed(queueNo, headDescIdx, totalWritten, numDescs)
+    self._assertQueueIntr((queueNo,))
+
+  def _publishUsed(self, queueNo, headDescIdx, totalWritten, numDescs=1):
+    if self._getDrvFeature(VIRTIO_F_RING_PACKED):
+      return self._publishUsedPacked(queueNo, headDescIdx, totalWritten, numDescs)
 
-  def _syncProcessUsed(self, queueNo, headDescIdx, totalWritten):
     queueLen  = self._queueLens[queueNo]
     pUsedRing = self._queueDeviceAreas[queueNo]
     curUsedIdx = self._queueUsedIdx[queueNo]
@@ -333,10 +693,262 @@ class VirtioScsiBar0(PciBar):
     #copyToRam(usedAddr+2+2+2*curUsedIdx, struct.pack('<II', headDescIdx, totalWritten))
     #copyToRam(usedAddr+2, struct.pack('<H', curUsedIdx+1))
     self._queueUsedIdx[queueNo] = (curUsedIdx+1) & 0xFFFF
-    self._assertQueueIntr()
-    print('@Virtio: DONE 0x%x (q %s, written %s bytes) cuidx=0x%x ql=%s' % (headDescIdx, queueNo, totalWritten, curUsedIdx, queueLen))
+    if vmtrace.mask & vmtrace.VIRTIO:
+      vmtrace.emit(vmtrace.EV_VIRTIO_USED, queueNo, headDescIdx, totalWritten)
+
+  # Packed rings. The descriptor area holds a single ring of descriptors which
+  # the driver makes available and the device marks used in place, in ring
+  # order, so that each kick is processed by walking one contiguous area of
+  # guest memory. The ring is accessed through a view of the host mapping of
+  # guest RAM, which is obtained once per kick or completion.
+  #
+  # A descriptor is available when its AVAIL flag matches the device's avail
+  # wrap counter and its USED flag does not, and used when both flags match the
+  # used wrap counter. The counters start at 1 and flip each time the
+  # respective position wraps around the ring. The flags of a descriptor are
+  # always read before, and written after, the rest of it, as the driver relies
+  # on that ordering.
+
+  # Returns a view of the packed ring of the queue, or None if the ring is not
+  # in RAM.
+  def _packedRing(self, queueNo):
+    pRing = self._queueDescriptorAreas[queueNo]
+    ringLen = 16*self._queueLens[queueNo]
+    addr, L = self._device._memoryManager.resolveAddr(pRing)
+    if addr is None or L < ringLen:
+      print('@Virtio: cannot get buffer for packed ring 0x%x' % pRing)
+      return None
+
+    return ramView(addr, ringLen)
+
+  # As for split rings, with VIRTIO_F_RING_EVENT_IDX the device publishes the
+  # position it has reached in its event suppression structure once it has
+  # caught up, and then checks the ring again.
+  def _syncProcessAvailPacked(self, queueNo):
+    ring = self._packedRing(queueNo)
+    if ring is None:
+      return
+
+    queueLen  = self._queueLens[queueNo]
+    eventIdx  = self._getDrvFeature(VIRTIO_F_RING_EVENT_IDX)
+    published = False
+    while True:
+      idx   = self._queueAvailIdx[queueNo]
+      wrap  = self._queueAvailWrap[queueNo]
+      flags = struct.unpack_from('<H', ring, 16*idx+14)[0]
+      if bool(flags & VIRTQ_DESC_F_AVAIL) != wrap or bool(flags & VIRTQ_DESC_F_USED) == wrap:
+        if published or not eventIdx:
+          break
+
+        self._device._memoryManager.write(self._queueDeviceAreas[queueNo], struct.pack('<HH', idx | (wrap << 15), RING_EVENT_FLAGS_DESC))
+        memoryBarrier()
+        published = True
+        continue
+
+      published = False
+      if self._executor is not None and not self._reserveInFlight(queueNo):
+        break
+
+      res = self._readPackedChain(queueNo, ring, idx)
+      if res is None:
+        # The number of entries taken by the buffer is unknown, so the ring
+        # cannot be processed further.
+        if self._executor is not None:
+          self._releaseInFlight()
+        return
+
+      bufs, bufId, numDescs = res
+      idx += numDescs
+      if idx >= queueLen:
+        idx -= queueLen
+        self._queueAvailWrap[queueNo] = not wrap
+      self._queueAvailIdx[queueNo] = idx
+      self._dispatchBuffers(queueNo, bufs, bufId, numDescs)
+
+  # Returns ((MultiReadBuffer, MultiWriteBuffer), bufId, numDescs) for the
+  # buffer whose first descriptor is at position idx of the ring, or None if
+  # the buffer is invalid. The buffer ID is taken from the last descriptor of
+  # the buffer. An indirect descriptor refers to a table holding the whole
+  # buffer, which takes one entry of the ring; as for split rings, tables
+  # longer than the queue are rejected before being read.
+  def _readPackedChain(self, queueNo, ring, idx):
+    queueLen  = self._queueLens[queueNo]
+    mm        = self._device._memoryManager
+    descs     = []  # (addr, len, flags)
+    numDescs  = 0
+
+    while True:
+      if numDescs >= queueLen:
+        print('@Virtio: invalid packed desc chain at 0x%x' % idx)
+        return
 
+      dAddr, dLen, bufId, dFlags = struct.unpack_from('<QIHH', ring, 16*((idx+numDescs) % queueLen))
+      numDescs += 1
+
+      if dFlags & VIRTQ_DESC_F_INDIRECT:
+        if numDescs != 1 or dFlags & VIRTQ_DESC_F_NEXT or dLen == 0 or dLen % 16 or dLen > 16*queueLen or not self._getDrvFeature(VIRTIO_F_INDIRECT_DESC):
+          print('@Virtio: invalid indirect desc at 0x%x' % idx)
+          return
+
+        table = mm.read(dAddr, dLen)
+        if table is None:
+          print('@Virtio: cannot get buffer for indirect table 0x%x' % dAddr)
+          return
+
+        descs = [(a, L, f) for a, L, i, f in struct.iter_unpack('<QIHH', table)]
+        break
+
+      descs.append((dAddr, dLen, dFlags))
+      if (dFlags & VIRTQ_DESC_F_NEXT) == 0:
+        break
+
+    readBufs  = []
+    writeBufs = []
+    for dAddr, dLen, dFlags in descs:
+      if vmtrace.mask & vmtrace.VIRTIO:
+        vmtrace.emit(vmtrace.EV_VIRTIO_DESC, dAddr, dLen, dFlags)
+
+      extents = mm.resolveExtents(dAddr, dLen)
+      if extents is None:
+        print('@Virtio: cannot get buffer for desc at 0x%x data 0x%x' % (idx, dAddr))
+        return
+
+      if dFlags & VIRTQ_DESC_F_WRITE:
+        writeBufs += extents
+      else:
+        readBufs += extents
+
+    return (MultiReadBuffer(readBufs), MultiWriteBuffer(writeBufs)), bufId, numDescs
+
+  def _publishUsedPacked(self, queueNo, bufId, totalWritten, numDescs):
+    ring = self._packedRing(queueNo)
+    if ring is None:
+      return
+
+    idx   = self._queueUsedIdx[queueNo]
+    wrap  = self._queueUsedWrap[queueNo]
+    struct.pack_into('<IH', ring, 16*idx+8, totalWritten, bufId)
+    struct.pack_into('<H', ring, 16*idx+14, (VIRTQ_DESC_F_AVAIL | VIRTQ_DESC_F_USED) if wrap else 0)
+
+    idx += numDescs
+    if idx >= self._queueLens[queueNo]:
+      idx -= self._queueLens[queueNo]
+      self._queueUsedWrap[queueNo] = not wrap
+    self._queueUsedIdx[queueNo] = idx
+    if vmtrace.mask & vmtrace.VIRTIO:
+      vmtrace.emit(vmtrace.EV_VIRTIO_USED, queueNo, bufId, totalWritten)
+
+  # Asynchronous mode. Requests are dispatched from the avail ring to a pool of
+  # worker threads, with at most scsiCmdPerLun requests in flight across all
+  # queues. Completed requests are queued and published to the used ring in
+  # the order in which they completed. Once a slot becomes free, any queue whose
+  # avail ring processing was deferred because the limit was reached is
+  # processed again.
+  def _reserveInFlight(self, queueNo):
+    with self._completionCond:
+      if self._inFlight >= self.scsiCmdPerLun.value:
+        self._deferredQueues.add(queueNo)
+        return False
+
+      self._inFlight += 1
+      return True
+
+  def _releaseInFlight(self):
+    with self._completionCond:
+      self._inFlight -= 1
+      self._completionCond.notify_all()
+
+  # Waits until there are no requests in flight.
+  def _waitIdle(self):
+    with self._completionCond:
+      while self._inFlight:
+        self._completionCond.wait()
+
+      self._deferredQueues.clear()
+
+  # Called with the vCPUs paused before a snapshot is taken. Completes any
+  # requests in flight, so that the queue state is consistent with guest
+  # memory, and stops processing queues until resume() is called, as the
+  # ioeventfd workers and completing requests can still notify the queues.
+  def quiesce(self):
+    for lock in self._queueLocks:
+      lock.acquire()
+    try:
+      self._running.clear()
+      self._waitIdle()
+    finally:
+      for lock in self._queueLocks:
+        lock.release()
+
+  # Called once the snapshot has been captured. Any notifications dropped
+  # while paused are made up for by processing every queue.
+  def resume(self):
+    self._running.set()
+    self._kickQueues()
+
+  # Called once a snapshot has been restored. The snapshot may have been taken
+  # with notifications dropped by quiesce(), so every queue is processed.
+  def onRestore(self):
+    self._kickQueues()
+
+  def _kickQueues(self):
+    for i in range(self.numQueues):
+      self._onNotify(i)
+
+  def _asyncProcessBuffers(self, queueNo, headDescIdx, numDescs, rbuf, wbuf):
+    wbufLen = wbuf.remaining
+    try:
+      self._syncProcessBuffers(queueNo, rbuf, wbuf)
+    except Exception as e:
+      # Nothing checks the future of this call, so this must not be lost.
+      print('@Virtio: exception while completing request on queue %s: %s' % (queueNo, e))
+      traceback.print_exc()
+    finally:
+      with self._completionCond:
+        self._completions.append((queueNo, headDescIdx, wbufLen - wbuf.remaining, numDescs))
+
+      self._publishCompletions()
+
+  def _publishCompletions(self):
+    with self._completionCond:
+      if not self._completions:
+        return
+
+      queueNos = set()
+      while self._completions:
+        queueNo, headDescIdx, totalWritten, numDescs = self._completions.popleft()
+        self._publishUsed(queueNo, headDescIdx, totalWritten, numDescs)
+        self._inFlight -= 1
+        queueNos.add(queueNo)
+
+      deferredQueues = self._deferredQueues
+      self._deferredQueues = set()
+      resetCount = self._resetCount
+      self._assertQueueIntr(sorted(queueNos))
+      self._completionCond.notify_all()
+
+    for queueNo in deferredQueues:
+      if not self._stopping:
+        self._onNotify(queueNo, resetCount)
+
+  # Executes the request in rbuf and writes the response at the start of wbuf.
+  # A response is always written: if the request cannot be executed, it has
+  # response code VIRTIO_SCSI_S_FAILURE, so that the guest does not take the
+  # previous contents of the response buffer as the outcome.
   def _syncProcessBuffers(self, queueNo, rbuf, wbuf):
+    respBuf = wbuf.take(4+4+2+1+1+self.scsiSenseLen.value)
+    try:
+      resp = self._executeRequest(rbuf, wbuf)
+    except Exception as e:
+      print('@Virtio: exception while processing request on queue %s: %s' % (queueNo, e))
+      traceback.print_exc()
+      resp = struct.pack('<IIHBB', 0, 0, 0, 0, VIRTIO_SCSI_S_FAILURE)
+
+    respBuf.write(resp.ljust(4+4+2+1+1+self.scsiSenseLen.value, b'\0'))
+
+  # Executes the request in rbuf, with wbuf positioned after the response, and
+  # returns the response.
+  def _executeRequest(self, rbuf, wbuf):
     reqL = 8+8+1+1+1+self.scsiCdbLen.value
     req = rbuf.read(reqL)
     if len(req) < reqL:
@@ -344,9 +956,10 @@ class VirtioScsiBar0(PciBar):
 
     lun = struct.unpack('>Q', req[0:8])[0]
     id, taskAttr, priority, crn = struct.unpack('<QBBB', req[8:19])
-    print('@Virtio: SCSI request: LUN=0x%x, ID=%s, cdb.opcode=0x%x' % (lun, id, req[19]))
     cdb = req[19:19+self.scsiCdbLen.value]
 
+    # The data-out and data-in buffers are the parts of the request and response
+    # buffers following the headers, and refer directly to guest memory.
     dataOutBuf = None
     if rbuf.remaining:
       dataOutBuf      = rbuf
@@ -354,7 +967,7 @@ class VirtioScsiBar0(PciBar):
 
     dataInBuf = None
     if wbuf.remaining:
-      dataInBuf     = io.BytesIO()
+      dataInBuf     = wbuf
       dataInBuf.len = wbuf.remaining
 
     cmd = ScsiCmd(lun=lun, id=id, cdb=cdb, taskAttr=taskAttr, crn=crn, priority=priority,
@@ -365,36 +978,58 @@ class VirtioScsiBar0(PciBar):
       senseLen = 0
       if res.senseData is not None:
         senseLen = len(res.senseData)
-      wbuf.write(struct.pack('<IIHBB', senseLen, residual, res.statusQualifier or 0, res.status, VIRTIO_SCSI_S_OK))
-      wbuf.write((res.senseData or b'').ljust(self.scsiSenseLen.value, b'\0'))
-      if dataInBuf is not None:
-        L = 0
-        dataInBuf.seek(0)
-        while True:
-          if L >= dataInBuf.len:
-            break
-          d = dataInBuf.read(min(8192, dataInBuf.len - L))
-          if d == b'':
-            break
-          wbuf.write(d)
-          L += len(d)
-          #print('@Virtio: writing %s bytes to data-in: %s (rem 0x%x)' % (len(d),d, wbuf.remaining))
+      return struct.pack('<IIHBB', senseLen, residual, res.statusQualifier or 0, res.status, VIRTIO_SCSI_S_OK) + (res.senseData or b'')
     except Exception as e:
       print('@Virtio: SCSI exception: %s' % e)
-      wbuf.write(struct.pack('<IIHBB', 0, 0, 0, 0, VIRTIO_SCSI_S_TARGET_FAILURE))
+      return struct.pack('<IIHBB', 0, 0, 0, 0, VIRTIO_SCSI_S_TARGET_FAILURE)
 
   def _reset(self):
+    n = self.numQueues
+    self._resetCount  += 1
+    self._drvFeatures  = 0
     self._queueLens    = list(self._maxQueueLens)
-    self._queueEnables = [False]*3
-    self._queueDescriptorAreas = [0]*3
-    self._queueDriverAreas = [0]*3
-    self._queueDeviceAreas = [0]*3
-    self._queueAvailIdx = [0]*3
-    self._queueUsedIdx = [0]*3
-
-  def __init__(self, device):
+    self._queueEnables = [False]*n
+    self._queueDescriptorAreas = [0]*n
+    self._queueDriverAreas = [0]*n
+    self._queueDeviceAreas = [0]*n
+    self._queueAvailIdx = [0]*n
+    self._queueUsedIdx = [0]*n
+    self._queueAvailWrap = [True]*n  # packed rings only
+    self._queueUsedWrap = [True]*n   # packed rings only
+    self._queueSignalledUsedIdx = [None]*n # used index when last deciding whether to interrupt
+    self._queueMsixVectors = [VIRTIO_MSI_NO_VECTOR]*n
+    self._msixConfigVector = VIRTIO_MSI_NO_VECTOR
+
+  # The device has numRequestQueues request queues, in addition to the control
+  # and event queues. Each queue has its own ring state, lock and notification
+  # register, so that queues can be serviced concurrently.
+  #
+  # If workers is nonzero, SCSI commands are executed asynchronously on a pool
+  # of that many threads. Otherwise they are executed synchronously in the
+  # context of the queue notification: on the notifying vCPU, or with
+  # ioeventfd, on the backend thread of the queue.
+  def __init__(self, device, ioeventfd=False, workers=0, numRequestQueues=1):
     self._device  = device
-    self._maxQueueLens = (16,)*3
+    self.numQueues = VIRTIO_SCSI_Q_REQUEST + numRequestQueues
+    self._maxQueueLens = (VIRTIO_SCSI_CTRL_QUEUE_LEN,)*VIRTIO_SCSI_Q_REQUEST + (VIRTIO_SCSI_REQUEST_QUEUE_LEN,)*numRequestQueues
+    self._queueLocks = [threading.Lock() for i in range(len(self._maxQueueLens))]
+    self._intrLock = threading.Lock()
+    self._irq = None
+    self._useIoeventfd = ioeventfd
+    self._ioeventfdWorkers = None
+
+    self._executor        = None
+    self._stopping        = False
+    self._running         = threading.Event()   # cleared by quiesce()
+    self._running.set()
+    self._completionCond  = threading.Condition()
+    self._completions     = collections.deque()   # (queueNo, headDescIdx, totalWritten, numDescs)
+    self._deferredQueues  = set()
+    self._inFlight        = 0
+    self._resetCount      = 0   # deferred notifications from before a reset are dropped
+    if workers:
+      self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='VirtioScsi')
+
     self._reset()
 
 class VirtioScsi(PciFunction):
@@ -409,8 +1044,21 @@ class VirtioScsi(PciFunction):
   subsystemVendorID = 0x1af4
   subsystemID       = 0x0048
 
-  def __init__(self, memoryManager, scsiSubsystem):
+  # If ioeventfd is set, queue notifications are delivered via KVM_IOEVENTFD
+  # and processed on per-queue backend threads rather than on the vCPU thread.
+  # If workers is nonzero, SCSI commands are executed on a pool of that many
+  # threads. numRequestQueues is the number of request queues offered to the
+  # guest.
+  #
+  # Each queue can be given its own MSI-X vector, with one more for
+  # configuration changes. INTx is used while MSI-X is disabled.
+  def __init__(self, memoryManager, scsiSubsystem, ioeventfd=False, workers=0, numRequestQueues=1):
     super().__init__()
     self._memoryManager = memoryManager
     self.scsiSubsystem = scsiSubsystem
-    self.b0h = self.addBarM32(0, VirtioScsiBar0(self))
+    self.b0h = self.addBarM32(0, VirtioScsiBar0(self, ioeventfd=ioeventfd, workers=workers, numRequestQueues=numRequestQueues))
+    self.msix = self.b1h = self.addBarM32(1, MsixTable(self, self.b0h.numQueues + 1))
+
+  def teardown(self):
+    self.b0h.teardown()
+    self.msix.teardown()
@@ -1,10 +1,22 @@
 #!/usr/bin/env python3
-import sys, argparse, os, fcntl, enum, mmap, struct, signal
-import kvmo, kvmapi
+import sys, argparse, os, fcntl, enum, mmap, struct, signal, threading
+import kvmo, kvmapi, vmtrace, display
 from x86 import *
 from iodev_qemu import *
 from vmm import *
 
+SCREENSHOT_SIGNAL = signal.SIGRTMIN+1
+
+# Parses a memory size such as 512M or 8G. Sizes without a suffix are in MiB.
+def parseMemSize(s):
+  units = {'K': 1<<10, 'M': 1<<20, 'G': 1<<30, 'T': 1<<40}
+  try:
+    if s[-1:].upper() in units:
+      return int(float(s[:-1])*units[s[-1].upper()])
+    return int(s)*units['M']
+  except ValueError:
+    raise argparse.ArgumentTypeError("invalid memory size: %s" % s)
+
 def run():
   sys.stdout.reconfigure(line_buffering=True)
   sys.stderr.reconfigure(line_buffering=True)
@@ -14,15 +26,75 @@ def run():
   ap.add_argument('-fwvars', metavar='OVMF_VARS.fd')
   ap.add_argument('-disk', metavar='path.bin')
   ap.add_argument('-optical', metavar='path.iso')
+  ap.add_argument('-m', metavar='SIZE', type=parseMemSize, default=1<<30, help='guest RAM size, e.g. 512M or 8G (default 1G); RAM which does not fit below the PCI hole is placed above 4 GiB')
+  ap.add_argument('-disk-cache', choices=CACHE_MODES, default='writethrough', help='block cache mode for -disk and -optical (default writethrough)')
+  ap.add_argument('-disk-cache-size', metavar='SIZE', type=parseMemSize, default=64<<20, help='block cache size per device (default 64M)')
+  ap.add_argument('-smp', metavar='N', type=int, default=1, help='number of vCPUs')
+  ap.add_argument('-virtio-ioeventfd', action='store_true', help='process virtio queue notifications on backend threads via KVM_IOEVENTFD')
+  ap.add_argument('-scsi-workers', metavar='N', type=int, default=0, help='execute virtio-scsi commands asynchronously on N worker threads')
+  ap.add_argument('-scsi-queues', metavar='N', type=int, help='number of virtio-scsi request queues (default: one per vCPU)')
+  ap.add_argument('-trace', metavar='CATEGORIES', help='record trace events for a comma-separated list of categories (%s, or all)' % ', '.join(vmtrace.categoryNames))
+  ap.add_argument('-trace-file', metavar='path.trace', default='kvmtest.trace', help='file to dump the trace ring to on SIGUSR2 and at exit')
+  ap.add_argument('-trace-records', metavar='N', type=int, default=1<<20, help='size of the trace ring in records')
+  ap.add_argument('-mem-backing', choices=MEMORY_BACKINGS, default='anon', help='backing for guest RAM: anon, thp (transparent huge pages), hugetlb (requires vm.nr_hugepages), memfd or shm (a file under /dev/shm)')
+  ap.add_argument('-no-irqfd', action='store_true', help='inject device interrupts with KVM_IRQ_LINE instead of KVM_IRQFD')
+  ap.add_argument('-display', choices=sorted(display.displayBackends), default='headless', help='display backend (sdl requires PySDL2)')
+  ap.add_argument('-screenshot-file', metavar='path.png', default='kvmtest.png', help='file to write a screenshot to on SIGRTMIN+1 (PNG if the name ends in .png, else PPM)')
+  ap.add_argument('-control', metavar='path.sock', help='accept control commands on a Unix socket')
+  ap.add_argument('-restore', metavar='path.snap', help='restore a snapshot taken with the snapshot control command before running')
   args = vars(ap.parse_args())
 
   if args['fwcode'] is None or args['fwvars'] is None:
     print('Must provide -fwcode and -fwvars with paths to OVMF_CODE.fd and OVMF_VARS.fd')
     return 1
 
+  if args['trace']:
+    vmtrace.enable(vmtrace.parseCategories(args['trace']), args['trace_records'])
+    signal.signal(signal.SIGUSR2, lambda signo, frame: vmtrace.dump(args['trace_file']))
+
+  disp = display.displayBackends[args['display']]()
+
+  def screenshot(path=args['screenshot_file']):
+    disp.screenshot(path)
+    return path
+
+  # The screenshot is taken on another thread, as the handler runs on the vCPU
+  # 0 thread, which may be holding the framebuffer lock.
+  def onScreenshotSignal(signo, frame):
+    def f():
+      try:
+        print('Screenshot written to %s' % screenshot())
+      except Exception as e:
+        print('Warning: failed to take screenshot: %s' % e)
+    threading.Thread(target=f, name='Screenshot', daemon=True).start()
+
+  signal.signal(SCREENSHOT_SIGNAL, onScreenshotSignal)
+
   vmm = VMM(platformFunc=Q35Platform, firmwarePath=args['fwcode'],
-    firmwareVarsPath=args['fwvars'], opticalPath=args['optical'], diskPath=args['disk'])
-  vmm.run()
+    firmwareVarsPath=args['fwvars'], opticalPath=args['optical'], diskPath=args['disk'],
+    diskCache=args['disk_cache'], diskCacheSize=args['disk_cache_size'],
+    numCpus=args['smp'], memSize=args['m'], irqfd=not args['no_irqfd'], virtioIoeventfd=args['virtio_ioeventfd'],
+    scsiWorkers=args['scsi_workers'], scsiQueues=args['scsi_queues'], display=disp, memBacking=args['mem_backing'])
+
+  control = None
+  if args['control']:
+    control = display.ControlServer(args['control'], {
+      'screenshot': screenshot,
+      'snapshot':   lambda path: vmm.snapshot(path),
+      'restore':    lambda path: vmm.restore(path),
+    })
+
+  if args['restore']:
+    vmm.restore(args['restore'])
+
+  try:
+    vmm.run()
+  finally:
+    vmm.shutdown()
+    if control:
+      control.teardown()
+    if args['trace']:
+      vmtrace.dump(args['trace_file'])
   return 0
 
 if __name__ == '__main__':
@@ -1,4 +1,4 @@
-import ctypes, ctypes.util, enum
+import ctypes, ctypes.util, enum, struct
 from ioctl_opt import IO, IOR, IOW, IOWR
 from ctypes import c_uint8, c_uint16, c_uint32, c_uint64, c_char_p
 
@@ -7,9 +7,15 @@ libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_i
 libc.mmap.restype = ctypes.c_void_p
 libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
 libc.munmap.restype = ctypes.c_int
+libc.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+libc.madvise.restype = ctypes.c_int
+libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+libc.mincore.restype = ctypes.c_int
 
 mmap = libc.mmap
 munmap = libc.munmap
+madvise = libc.madvise
+mincore = libc.mincore
 
 class KvmUserSpaceMemoryRegion(ctypes.Structure):
   _fields_ = [
@@ -20,6 +26,7 @@ class KvmUserSpaceMemoryRegion(ctypes.Structure):
     ('userspaceAddr', c_uint64),
   ]
 
+KVM_MEM_LOG_DIRTY_PAGES = (1<<0)
 KVM_MEM_READONLY = (1<<1)
 
 class KvmRegs(ctypes.Structure):
@@ -179,7 +186,8 @@ class KvmRunExitReasons(ctypes.Union):
 class KvmRun(ctypes.Structure):
   _fields_ = [
     ('requestIntrWindow', c_uint8),
-    ('padding1', c_uint8*7),
+    ('immediateExit', c_uint8),
+    ('padding1', c_uint8*6),
     ('exitReason', c_uint32),
     ('readyForIntrInjection', c_uint8),
     ('ifFlag', c_uint8),
@@ -189,6 +197,20 @@ class KvmRun(ctypes.Structure):
     ('exitReasons', KvmRunExitReasons),
   ]
 
+# Precompiled layouts for decoding exits directly from the kvm_run mapping
+# without constructing ctypes objects. Offsets are into struct kvm_run.
+KVM_RUN_EXIT_REASON_OFFSET  = KvmRun.exitReason.offset
+KVM_RUN_EXIT_OFFSET         = KvmRun.exitReasons.offset
+KVM_RUN_EXIT_REASON         = struct.Struct('<I')
+KVM_RUN_EXIT_IO             = struct.Struct('<BBHIQ')   # direction, size, port, count, dataOffset
+KVM_RUN_EXIT_MMIO           = struct.Struct('<Q8xIB')   # physAddr, len, isWrite
+KVM_RUN_EXIT_MMIO_DATA_OFFSET = KVM_RUN_EXIT_OFFSET + KvmRunExitMmio.data.offset
+
+# Little-endian integer structs for each access width in bytes.
+UINT_STRUCTS = {1: struct.Struct('<B'), 2: struct.Struct('<H'), 4: struct.Struct('<I'), 8: struct.Struct('<Q')}
+
+KVM_CPUID_FLAG_SIGNIFCANT_INDEX = 1 # the entry applies only to its subleaf (index)
+
 class KvmCpuidEntry2(ctypes.Structure):
   _fields_ = [
     ('function', c_uint32),
@@ -277,10 +299,21 @@ class KvmCapability(enum.IntEnum):
   KVM_CAP_USER_MEMORY         =  3
   KVM_CAP_SET_TSS_ADDR        =  4
   KVM_CAP_EXT_CPUID           =  7
+  KVM_CAP_NR_VCPUS            =  9
+  KVM_CAP_MP_STATE            = 14
   KVM_CAP_COALESCED_MMIO      = 15
   KVM_CAP_IRQ_ROUTING         = 25
   KVM_CAP_IRQ_INJECT_STATUS   = 26
+  KVM_CAP_IRQFD               = 32
   KVM_CAP_PIT2                = 33
+  KVM_CAP_IOEVENTFD           = 36
+  KVM_CAP_XSAVE               = 55
+  KVM_CAP_XCRS                = 56
+  KVM_CAP_MAX_VCPUS           = 66
+  KVM_CAP_SIGNAL_MSI          = 77
+  KVM_CAP_IRQFD_RESAMPLE      = 82
+  KVM_CAP_IMMEDIATE_EXIT      = 136
+  KVM_CAP_COALESCED_PIO       = 162
 
 KVM_API_VERSION = 12
 
@@ -395,3 +428,234 @@ class KvmIrqLevel(ctypes.Structure):
   ]
 
 KVM_IRQ_LINE = IOW(KVMIO, 0x61, KvmIrqLevel)
+
+class KvmCoalescedMmioZone(ctypes.Structure):
+  _fields_ = [
+    ('addr',  c_uint64),
+    ('size',  c_uint32),
+    ('pio',   c_uint32),
+  ]
+
+class KvmCoalescedMmio(ctypes.Structure):
+  _fields_ = [
+    ('physAddr',  c_uint64),
+    ('len',       c_uint32),
+    ('pio',       c_uint32),
+    ('data',      c_uint8*8),
+  ]
+
+KVM_COALESCED_MMIO_PAGE_SIZE = 4096
+KVM_COALESCED_MMIO_MAX = (KVM_COALESCED_MMIO_PAGE_SIZE - 8)//ctypes.sizeof(KvmCoalescedMmio)
+
+class KvmCoalescedMmioRing(ctypes.Structure):
+  _fields_ = [
+    ('first',   c_uint32),
+    ('last',    c_uint32),
+    ('entries', KvmCoalescedMmio*KVM_COALESCED_MMIO_MAX),
+  ]
+
+KVM_REGISTER_COALESCED_MMIO   = IOW(KVMIO, 0x67, KvmCoalescedMmioZone)
+KVM_UNREGISTER_COALESCED_MMIO = IOW(KVMIO, 0x68, KvmCoalescedMmioZone)
+
+KVM_IOEVENTFD_FLAG_DATAMATCH  = (1<<0)
+KVM_IOEVENTFD_FLAG_PIO        = (1<<1)
+KVM_IOEVENTFD_FLAG_DEASSIGN   = (1<<2)
+
+class KvmIoeventfd(ctypes.Structure):
+  _fields_ = [
+    ('datamatch', c_uint64),
+    ('addr',      c_uint64),
+    ('len',       c_uint32),
+    ('fd',        ctypes.c_int32),
+    ('flags',     c_uint32),
+    ('pad',       c_uint8*36),
+  ]
+
+KVM_IOEVENTFD = IOW(KVMIO, 0x79, KvmIoeventfd)
+
+KVM_IRQFD_FLAG_DEASSIGN = (1<<0)
+KVM_IRQFD_FLAG_RESAMPLE = (1<<1)
+
+class KvmIrqfd(ctypes.Structure):
+  _fields_ = [
+    ('fd',          c_uint32),
+    ('gsi',         c_uint32),
+    ('flags',       c_uint32),
+    ('resamplefd',  c_uint32),
+    ('pad',         c_uint8*16),
+  ]
+
+KVM_IRQFD = IOW(KVMIO, 0x76, KvmIrqfd)
+
+class KvmMsi(ctypes.Structure):
+  _fields_ = [
+    ('addressLo', c_uint32),
+    ('addressHi', c_uint32),
+    ('data',      c_uint32),
+    ('flags',     c_uint32),
+    ('devid',     c_uint32),
+    ('pad',       c_uint8*12),
+  ]
+
+KVM_SIGNAL_MSI = IOW(KVMIO, 0xA5, KvmMsi)
+
+KVM_IRQ_ROUTING_IRQCHIP = 1
+KVM_IRQ_ROUTING_MSI     = 2
+
+class KvmIrqRoutingIrqchip(ctypes.Structure):
+  _fields_ = [
+    ('irqchip', c_uint32),
+    ('pin',     c_uint32),
+  ]
+
+class KvmIrqRoutingMsi(ctypes.Structure):
+  _fields_ = [
+    ('addressLo', c_uint32),
+    ('addressHi', c_uint32),
+    ('data',      c_uint32),
+    ('devid',     c_uint32),
+  ]
+
+class KvmIrqRoutingEntryU(ctypes.Union):
+  _fields_ = [
+    ('irqchip', KvmIrqRoutingIrqchip),
+    ('msi',     KvmIrqRoutingMsi),
+    ('pad',     c_uint32*8),
+  ]
+
+class KvmIrqRoutingEntry(ctypes.Structure):
+  _fields_ = [
+    ('gsi',   c_uint32),
+    ('type',  c_uint32),
+    ('flags', c_uint32),
+    ('pad',   c_uint32),
+    ('u',     KvmIrqRoutingEntryU),
+  ]
+
+class KvmIrqRouting(ctypes.Structure):
+  _fields_ = [
+    ('nr',    c_uint32),
+    ('flags', c_uint32),
+  ]
+
+_kvmIrqRouting = {}
+def makeKvmIrqRouting(n):
+  if n in _kvmIrqRouting:
+    return _kvmIrqRouting[n]
+
+  class KvmIrqRoutingN(ctypes.Structure):
+    _fields_ = [
+      ('nr',      c_uint32),
+      ('flags',   c_uint32),
+      ('entries', KvmIrqRoutingEntry*n),
+    ]
+
+  _kvmIrqRouting[n] = KvmIrqRoutingN
+  return KvmIrqRoutingN
+
+KVM_SET_GSI_ROUTING = IOW(KVMIO, 0x6A, KvmIrqRouting)
+
+KVM_MP_STATE_RUNNABLE       = 0
+KVM_MP_STATE_UNINITIALIZED  = 1
+KVM_MP_STATE_INIT_RECEIVED  = 2
+KVM_MP_STATE_HALTED         = 3
+KVM_MP_STATE_SIPI_RECEIVED  = 4
+
+class KvmMpState(ctypes.Structure):
+  _fields_ = [
+    ('mpState', c_uint32),
+  ]
+
+KVM_GET_MP_STATE = IOR(KVMIO, 0x98, KvmMpState)
+KVM_SET_MP_STATE = IOW(KVMIO, 0x99, KvmMpState)
+
+# The dirty bitmap has one bit per page of the slot, least significant bit
+# first, and must be sized in whole 64-bit words.
+class KvmDirtyLog(ctypes.Structure):
+  _fields_ = [
+    ('slot',        c_uint32),
+    ('padding',     c_uint32),
+    ('dirtyBitmap', c_uint64),
+  ]
+
+KVM_GET_DIRTY_LOG = IOW(KVMIO, 0x42, KvmDirtyLog)
+
+# The following state is only saved and restored as a whole, so the structures
+# which the kernel defines for it are treated as opaque here.
+
+KVM_IRQCHIP_PIC_MASTER  = 0
+KVM_IRQCHIP_PIC_SLAVE   = 1
+KVM_IRQCHIP_IOAPIC      = 2
+
+class KvmIrqchip(ctypes.Structure):
+  _fields_ = [
+    ('chipId',  c_uint32),
+    ('pad',     c_uint32),
+    ('chip',    c_uint8*512),
+  ]
+
+KVM_GET_IRQCHIP = IOWR(KVMIO, 0x62, KvmIrqchip)
+KVM_SET_IRQCHIP = IOR(KVMIO, 0x63, KvmIrqchip)
+
+class KvmPitState2(ctypes.Structure):
+  _fields_ = [
+    ('channels',  c_uint8*72), # struct kvm_pit_channel_state[3]
+    ('flags',     c_uint32),
+    ('reserved',  c_uint32*9),
+  ]
+
+KVM_GET_PIT2 = IOR(KVMIO, 0x9f, KvmPitState2)
+KVM_SET_PIT2 = IOW(KVMIO, 0xa0, KvmPitState2)
+
+class KvmClockData(ctypes.Structure):
+  _fields_ = [
+    ('clock',     c_uint64),
+    ('flags',     c_uint32),
+    ('pad0',      c_uint32),
+    ('realtime',  c_uint64),
+    ('hostTsc',   c_uint64),
+    ('pad',       c_uint32*4),
+  ]
+
+KVM_SET_CLOCK = IOW(KVMIO, 0x7b, KvmClockData)
+KVM_GET_CLOCK = IOR(KVMIO, 0x7c, KvmClockData)
+
+# Pending exceptions, interrupts and NMIs, and interrupt shadow state.
+class KvmVcpuEvents(ctypes.Structure):
+  _fields_ = [
+    ('data',  c_uint8*64),
+  ]
+
+KVM_GET_VCPU_EVENTS = IOR(KVMIO, 0x9f, KvmVcpuEvents)
+KVM_SET_VCPU_EVENTS = IOW(KVMIO, 0xa0, KvmVcpuEvents)
+
+# XSAVE area, in the format of the XSAVE instruction. A superset of the state
+# in KvmFpu.
+class KvmXsave(ctypes.Structure):
+  _fields_ = [
+    ('region',  c_uint32*1024),
+  ]
+
+KVM_GET_XSAVE = IOR(KVMIO, 0xa4, KvmXsave)
+KVM_SET_XSAVE = IOW(KVMIO, 0xa5, KvmXsave)
+
+KVM_MAX_XCRS = 16
+
+class KvmXcr(ctypes.Structure):
+  _fields_ = [
+    ('xcr',       c_uint32),
+    ('reserved',  c_uint32),
+    ('value',     c_uint64),
+  ]
+
+# Extended control registers (XCR0).
+class KvmXcrs(ctypes.Structure):
+  _fields_ = [
+    ('nrXcrs',  c_uint32),
+    ('flags',   c_uint32),
+    ('xcrs',    KvmXcr*KVM_MAX_XCRS),
+    ('padding', c_uint64*16),
+  ]
+
+KVM_GET_XCRS = IOR(KVMIO, 0xa6, KvmXcrs)
+KVM_SET_XCRS = IOW(KVMIO, 0xa7, KvmXcrs)
@@ -1,4 +1,8 @@
-import kvmapi, os, fcntl, mmap, errno, struct, ctypes
+import kvmapi, os, fcntl, mmap, errno, struct, ctypes, threading, signal
+
+# Number of GSIs routed to the in-kernel irqchip (the IOAPIC pins, the first 16
+# of which are also routed to the PICs).
+NUM_IRQCHIP_GSIS = 24
 
 class Kvm:
   def __init__(self):
@@ -14,7 +18,12 @@ class Kvm:
     return VM(self)
 
   def checkExtension(self, ext):
-    return bool(fcntl.ioctl(self._fd, kvmapi.KVM_CHECK_EXTENSION, int(ext)) >= 0)
+    return self.getExtension(ext) > 0
+
+  # Returns the raw value KVM reports for an extension. Zero means the
+  # extension is unsupported; some extensions return additional information.
+  def getExtension(self, ext):
+    return fcntl.ioctl(self._fd, kvmapi.KVM_CHECK_EXTENSION, int(ext))
 
   def getSupportedCpuid(self):
     n = 128
@@ -72,6 +81,15 @@ class VM:
 
     self._kvm = kvm
     self._fd = fcntl.ioctl(self._kvm._fd, kvmapi.KVM_CREATE_VM, 0)
+    self._coalescedZones = set()
+    self.useIrqfd = False
+
+    # GSIs routed to MSIs, as {gsi: (addr, data)}. GSIs below
+    # NUM_IRQCHIP_GSIS are those routed to the in-kernel irqchip by default.
+    self._routingLock = threading.Lock()
+    self._msiRoutes   = {}
+    self._freeMsiGsis = []
+    self._nextMsiGsi  = NUM_IRQCHIP_GSIS
 
   def createVcpu(self, *args, **kwargs):
     return Vcpu(self, *args, **kwargs)
@@ -80,6 +98,48 @@ class VM:
     assert isinstance(rgn, kvmapi.KvmUserSpaceMemoryRegion)
     fcntl.ioctl(self._fd, kvmapi.KVM_SET_USER_MEMORY_REGION, rgn)
 
+  # Returns the dirty bitmap for a slot which has KVM_MEM_LOG_DIRTY_PAGES set,
+  # one bit per 4 KiB page, and atomically clears it. Pages become dirty again
+  # on their next write by the guest.
+  #
+  # (slotNo: int, numPages: int) → bytes
+  def getDirtyLog(self, slotNo, numPages):
+    bitmap = (ctypes.c_uint64 * ((numPages+63)//64))()
+    fcntl.ioctl(self._fd, kvmapi.KVM_GET_DIRTY_LOG, kvmapi.KvmDirtyLog(slotNo, 0, ctypes.addressof(bitmap)))
+    return bytes(bitmap)
+
+  # (chipId: int) → KvmIrqchip
+  def getIrqchip(self, chipId):
+    chip = kvmapi.KvmIrqchip(chipId)
+    fcntl.ioctl(self._fd, kvmapi.KVM_GET_IRQCHIP, chip)
+    return chip
+
+  def setIrqchip(self, chip):
+    assert isinstance(chip, kvmapi.KvmIrqchip)
+    fcntl.ioctl(self._fd, kvmapi.KVM_SET_IRQCHIP, chip)
+
+  @property
+  def pit2(self):
+    pit = kvmapi.KvmPitState2()
+    fcntl.ioctl(self._fd, kvmapi.KVM_GET_PIT2, pit)
+    return pit
+
+  @pit2.setter
+  def pit2(self, pit):
+    assert isinstance(pit, kvmapi.KvmPitState2)
+    fcntl.ioctl(self._fd, kvmapi.KVM_SET_PIT2, pit)
+
+  @property
+  def clock(self):
+    clock = kvmapi.KvmClockData()
+    fcntl.ioctl(self._fd, kvmapi.KVM_GET_CLOCK, clock)
+    return clock
+
+  @clock.setter
+  def clock(self, clock):
+    assert isinstance(clock, kvmapi.KvmClockData)
+    fcntl.ioctl(self._fd, kvmapi.KVM_SET_CLOCK, clock)
+
   def setTssAddr(self, addr):
     addr = struct.unpack('i', struct.pack('I', addr))[0]
     fcntl.ioctl(self._fd, kvmapi.KVM_SET_TSS_ADDR, addr)
@@ -95,6 +155,130 @@ class VM:
     args = kvmapi.KvmIrqLevel(irq, int(level))
     fcntl.ioctl(self._fd, kvmapi.KVM_IRQ_LINE, args)
 
+  # Registers a range of guest physical (or, if pio is set, I/O port) addresses
+  # for which writes are buffered by the kernel in the coalesced MMIO ring
+  # rather than causing an exit. Registering the same zone twice is a no-op.
+  def registerCoalescedZone(self, addr, size, pio=False):
+    k = (addr, size, bool(pio))
+    if k in self._coalescedZones:
+      return
+
+    fcntl.ioctl(self._fd, kvmapi.KVM_REGISTER_COALESCED_MMIO, kvmapi.KvmCoalescedMmioZone(addr, size, int(pio)))
+    self._coalescedZones.add(k)
+
+  def unregisterCoalescedZone(self, addr, size, pio=False):
+    k = (addr, size, bool(pio))
+    if k not in self._coalescedZones:
+      return
+
+    fcntl.ioctl(self._fd, kvmapi.KVM_UNREGISTER_COALESCED_MMIO, kvmapi.KvmCoalescedMmioZone(addr, size, int(pio)))
+    self._coalescedZones.remove(k)
+
+  # Returns an object with a .set(level) method which device models can use to
+  # drive the given GSI. If level is set the line is level-triggered and
+  # remains asserted until set(False); otherwise set(True) generates an edge.
+  # If irqfds are in use, the line may be driven from any thread.
+  def createIrqLine(self, gsi, level=False):
+    if self.useIrqfd:
+      return IrqfdLine(self, gsi, resample=level)
+    return IrqLine(self, gsi, level=level)
+
+  # Returns an object with a .set(addr, data) method to retarget it and a
+  # .fire() method which device models can use to send an MSI with the given
+  # address and data. If irqfds are in use, the MSI is routed via a GSI and
+  # injected with an irqfd; otherwise it is injected with KVM_SIGNAL_MSI. In
+  # either case it may be fired from any thread.
+  def createMsiLine(self, addr, data):
+    if self.useIrqfd:
+      return IrqfdMsiLine(self, addr, data)
+    return MsiLine(self, addr, data)
+
+  def signalMsi(self, addr, data):
+    fcntl.ioctl(self._fd, kvmapi.KVM_SIGNAL_MSI, kvmapi.KvmMsi(addr & 0xFFFF_FFFF, addr >> 32, data, 0, 0))
+
+  # Allocates a GSI and routes it to an MSI. Returns the GSI.
+  def addMsiRoute(self, addr, data):
+    with self._routingLock:
+      if self._freeMsiGsis:
+        gsi = self._freeMsiGsis.pop()
+      else:
+        gsi = self._nextMsiGsi
+        self._nextMsiGsi += 1
+      self._msiRoutes[gsi] = (addr, data)
+      self._commitRouting()
+    return gsi
+
+  def updateMsiRoute(self, gsi, addr, data):
+    with self._routingLock:
+      self._msiRoutes[gsi] = (addr, data)
+      self._commitRouting()
+
+  def removeMsiRoute(self, gsi):
+    with self._routingLock:
+      del self._msiRoutes[gsi]
+      self._freeMsiGsis.append(gsi)
+      self._commitRouting()
+
+  # KVM_SET_GSI_ROUTING replaces the whole routing table, so the default
+  # routes of the irqchip GSIs to the PIC and IOAPIC must be included. Must be
+  # called with _routingLock held.
+  def _commitRouting(self):
+    entries = []
+    for gsi in range(NUM_IRQCHIP_GSIS):
+      if gsi < 16:
+        entries.append((gsi, kvmapi.KVM_IRQ_ROUTING_IRQCHIP, (kvmapi.KVM_IRQCHIP_PIC_MASTER if gsi < 8 else kvmapi.KVM_IRQCHIP_PIC_SLAVE, gsi % 8)))
+      entries.append((gsi, kvmapi.KVM_IRQ_ROUTING_IRQCHIP, (kvmapi.KVM_IRQCHIP_IOAPIC, gsi)))
+    for gsi, (addr, data) in sorted(self._msiRoutes.items()):
+      entries.append((gsi, kvmapi.KVM_IRQ_ROUTING_MSI, (addr & 0xFFFF_FFFF, addr >> 32, data, 0)))
+
+    routing = kvmapi.makeKvmIrqRouting(len(entries))()
+    routing.nr = len(entries)
+    for e, (gsi, type, args) in zip(routing.entries, entries):
+      e.gsi   = gsi
+      e.type  = type
+      if type == kvmapi.KVM_IRQ_ROUTING_MSI:
+        e.u.msi = kvmapi.KvmIrqRoutingMsi(*args)
+      else:
+        e.u.irqchip = kvmapi.KvmIrqRoutingIrqchip(*args)
+
+    fcntl.ioctl(self._fd, kvmapi.KVM_SET_GSI_ROUTING, routing)
+
+  # Causes writes to the eventfd fd to inject an interrupt on the given GSI. If
+  # resampleFd is given, the GSI is treated as level-triggered: it stays
+  # asserted until the guest acknowledges it, at which point it is deasserted
+  # and resampleFd is signalled.
+  def assignIrqfd(self, fd, gsi, resampleFd=None):
+    args = kvmapi.KvmIrqfd(fd, gsi, 0, 0)
+    if resampleFd is not None:
+      args.flags      = kvmapi.KVM_IRQFD_FLAG_RESAMPLE
+      args.resamplefd = resampleFd
+    fcntl.ioctl(self._fd, kvmapi.KVM_IRQFD, args)
+
+  def deassignIrqfd(self, fd, gsi):
+    fcntl.ioctl(self._fd, kvmapi.KVM_IRQFD, kvmapi.KvmIrqfd(fd, gsi, kvmapi.KVM_IRQFD_FLAG_DEASSIGN, 0))
+
+  # Causes guest writes of len bytes to addr (optionally only those writing the
+  # value datamatch) to signal the eventfd fd in the kernel instead of causing
+  # an exit.
+  def assignIoeventfd(self, fd, addr, len, datamatch=None, pio=False):
+    fcntl.ioctl(self._fd, kvmapi.KVM_IOEVENTFD, self._makeIoeventfd(fd, addr, len, datamatch, pio, 0))
+
+  def deassignIoeventfd(self, fd, addr, len, datamatch=None, pio=False):
+    fcntl.ioctl(self._fd, kvmapi.KVM_IOEVENTFD, self._makeIoeventfd(fd, addr, len, datamatch, pio, kvmapi.KVM_IOEVENTFD_FLAG_DEASSIGN))
+
+  def _makeIoeventfd(self, fd, addr, len, datamatch, pio, flags):
+    args = kvmapi.KvmIoeventfd()
+    args.addr   = addr
+    args.len    = len
+    args.fd     = fd
+    args.flags  = flags
+    if datamatch is not None:
+      args.datamatch = datamatch
+      args.flags |= kvmapi.KVM_IOEVENTFD_FLAG_DATAMATCH
+    if pio:
+      args.flags |= kvmapi.KVM_IOEVENTFD_FLAG_PIO
+    return args
+
   @property
   def kvm(self):
     return self._kvm
@@ -103,20 +287,136 @@ class VM:
   def fd(self):
     return self._fd
 
+# An interrupt line driven using KVM_IRQ_LINE. Each change costs one or two
+# ioctls.
+class IrqLine:
+  def __init__(self, vm, gsi, level=False):
+    self._vm    = vm
+    self.gsi    = gsi
+    self._level = level
+
+  def set(self, level):
+    if self._level:
+      self._vm.setIrqLine(self.gsi, level)
+    else:
+      self._vm.setIrqLine(self.gsi, False)
+      if level:
+        self._vm.setIrqLine(self.gsi, True)
+
+  def teardown(self):
+    pass
+
+# An interrupt line driven by writing to an eventfd registered with KVM_IRQFD.
+# For level-triggered lines a resample eventfd is used: KVM deasserts the line
+# when the guest acknowledges the interrupt and signals the resample eventfd, at
+# which point the line is reasserted if the device still wants it asserted.
+class IrqfdLine:
+  def __init__(self, vm, gsi, resample=False):
+    self._vm        = vm
+    self.gsi        = gsi
+    self._fd        = os.eventfd(0, os.EFD_CLOEXEC)
+    self._resampleFd = None
+    self._asserted  = False
+    self._thread    = None
+
+    if resample:
+      self._resampleFd = os.eventfd(0, os.EFD_CLOEXEC)
+      self._run = True
+      self._thread = threading.Thread(target=self._resampleLoop, name='Irqfd%s' % gsi, daemon=True)
+      self._thread.start()
+
+    vm.assignIrqfd(self._fd, gsi, self._resampleFd)
+
+  def set(self, level):
+    self._asserted = level
+    if level:
+      os.eventfd_write(self._fd, 1)
+
+  def teardown(self):
+    self._vm.deassignIrqfd(self._fd, self.gsi)
+    if self._thread is not None:
+      self._run = False
+      os.eventfd_write(self._resampleFd, 1)
+      self._thread.join()
+      os.close(self._resampleFd)
+    os.close(self._fd)
+
+  def _resampleLoop(self):
+    while True:
+      os.eventfd_read(self._resampleFd)
+      if not self._run:
+        break
+
+      if self._asserted:
+        os.eventfd_write(self._fd, 1)
+
+# An MSI injected using KVM_SIGNAL_MSI. Each injection costs one ioctl.
+class MsiLine:
+  def __init__(self, vm, addr, data):
+    self._vm  = vm
+    self.addr = addr
+    self.data = data
+
+  def set(self, addr, data):
+    self.addr = addr
+    self.data = data
+
+  def fire(self):
+    self._vm.signalMsi(self.addr, self.data)
+
+  def teardown(self):
+    pass
+
+# An MSI injected by writing to an eventfd registered with KVM_IRQFD on a GSI
+# which is routed to the MSI. Retargeting the MSI rewrites the routing table,
+# but injection is just an eventfd write.
+class IrqfdMsiLine:
+  def __init__(self, vm, addr, data):
+    self._vm  = vm
+    self.addr = addr
+    self.data = data
+    self._fd  = os.eventfd(0, os.EFD_CLOEXEC)
+    self.gsi  = vm.addMsiRoute(addr, data)
+    vm.assignIrqfd(self._fd, self.gsi)
+
+  def set(self, addr, data):
+    if (addr, data) != (self.addr, self.data):
+      self.addr = addr
+      self.data = data
+      self._vm.updateMsiRoute(self.gsi, addr, data)
+
+  def fire(self):
+    os.eventfd_write(self._fd, 1)
+
+  def teardown(self):
+    self._vm.deassignIrqfd(self._fd, self.gsi)
+    self._vm.removeMsiRoute(self.gsi)
+    os.close(self._fd)
+
 class Vcpu:
   def __init__(self, vm, cpuNum=0):
     assert isinstance(vm, VM)
     self._vm = vm
+    self.cpuNum = cpuNum
     self._fd = fcntl.ioctl(self._vm._fd, kvmapi.KVM_CREATE_VCPU, cpuNum)
     self._runBase = kvmapi.mmap(-1, self._vm._kvm._mapLen, mmap.PROT_READ | mmap.PROT_WRITE, mmap.MAP_SHARED, self._fd, 0)
     self._run = kvmapi.KvmRun.from_address(self._runBase)
     self._runBuf = (ctypes.c_uint8 * self._vm._kvm._mapLen).from_address(self._runBase)
+    self._runView = memoryview(self._runBuf).cast('B')
+
+    self._coalescedRing = None
+    ringPageNo = self._vm._kvm.getExtension(kvmapi.KvmCapability.KVM_CAP_COALESCED_MMIO)
+    if ringPageNo > 0:
+      self._coalescedRing = kvmapi.KvmCoalescedMmioRing.from_address(self._runBase + ringPageNo*mmap.PAGESIZE)
     #self._runBase = mmap.mmap(self._fd, self._vm._kvm._mapLen)
     #self._run = kvmapi.KvmRun.from_buffer(self._runBase)
 
   def teardown(self):
     self._run    = None
+    self._runView.release()
+    self._runView = None
     self._runBuf = None
+    self._coalescedRing = None
     kvmapi.munmap(self._runBase, self._vm._kvm._mapLen)
     #self._runBase.close()
     os.close(self._fd)
@@ -165,6 +465,49 @@ class Vcpu:
     assert isinstance(lapic, kvmapi.LocalApic)
     fcntl.ioctl(self._fd, kvmapi.KVM_SET_LAPIC, lapic)
 
+  @property
+  def mpState(self):
+    mpState = kvmapi.KvmMpState()
+    fcntl.ioctl(self._fd, kvmapi.KVM_GET_MP_STATE, mpState)
+    return mpState.mpState
+
+  @mpState.setter
+  def mpState(self, v):
+    fcntl.ioctl(self._fd, kvmapi.KVM_SET_MP_STATE, kvmapi.KvmMpState(v))
+
+  @property
+  def events(self):
+    events = kvmapi.KvmVcpuEvents()
+    fcntl.ioctl(self._fd, kvmapi.KVM_GET_VCPU_EVENTS, events)
+    return events
+
+  @events.setter
+  def events(self, events):
+    assert isinstance(events, kvmapi.KvmVcpuEvents)
+    fcntl.ioctl(self._fd, kvmapi.KVM_SET_VCPU_EVENTS, events)
+
+  @property
+  def xsave(self):
+    xsave = kvmapi.KvmXsave()
+    fcntl.ioctl(self._fd, kvmapi.KVM_GET_XSAVE, xsave)
+    return xsave
+
+  @xsave.setter
+  def xsave(self, xsave):
+    assert isinstance(xsave, kvmapi.KvmXsave)
+    fcntl.ioctl(self._fd, kvmapi.KVM_SET_XSAVE, xsave)
+
+  @property
+  def xcrs(self):
+    xcrs = kvmapi.KvmXcrs()
+    fcntl.ioctl(self._fd, kvmapi.KVM_GET_XCRS, xcrs)
+    return xcrs
+
+  @xcrs.setter
+  def xcrs(self, xcrs):
+    assert isinstance(xcrs, kvmapi.KvmXcrs)
+    fcntl.ioctl(self._fd, kvmapi.KVM_SET_XCRS, xcrs)
+
   def setCpuid2(self, cpuid):
     if isinstance(cpuid, list):
       cpuid2 = kvmapi.makeKvmCpuid2(len(cpuid))()
@@ -194,8 +537,10 @@ class Vcpu:
         msrs2.entries[i] = msrs[i]
       msrs = msrs2
 
+    # Returns the number of MSRs set, which is less than requested if setting
+    # one fails.
     assert isinstance(msrs.entries[0], kvmapi.KvmMsrEntry)
-    fcntl.ioctl(self._fd, kvmapi.KVM_SET_MSRS, msrs)
+    return fcntl.ioctl(self._fd, kvmapi.KVM_SET_MSRS, msrs)
 
   def setDebug(self, debugs):
     assert isinstance(debugs, kvmapi.KvmGuestDebug)
@@ -204,6 +549,36 @@ class Vcpu:
   def runOnce(self):
     fcntl.ioctl(self._fd, kvmapi.KVM_RUN, 0)
 
+  # Completes the exit last returned by runOnce without running the guest.
+  # KVM only finishes a PIO or MMIO read (storing the data in the guest's
+  # registers and advancing RIP) on the next KVM_RUN, so this must be done
+  # before the vCPU's state is saved or replaced. Requires
+  # KVM_CAP_IMMEDIATE_EXIT. Clears any pending kick.
+  def completePendingIo(self):
+    self._run.immediateExit = 1
+    try:
+      fcntl.ioctl(self._fd, kvmapi.KVM_RUN, 0)
+    except InterruptedError:
+      pass
+    finally:
+      self._run.immediateExit = 0
+
+  # Causes the vCPU to return from KVM_RUN (with EINTR) as soon as possible,
+  # or immediately on the next call if it is not currently running. thread is
+  # the thread running the vCPU, which must have a handler installed for
+  # signo. The caller of runOnce must clear kickPending afterwards.
+  def kick(self, thread, signo):
+    self._run.immediateExit = 1
+    signal.pthread_kill(thread.ident, signo)
+
+  @property
+  def kickPending(self):
+    return bool(self._run.immediateExit)
+
+  @kickPending.setter
+  def kickPending(self, v):
+    self._run.immediateExit = int(v)
+
   @property
   def reason(self):
     return kvmapi.KvmExitReason(self._run.exitReason)
@@ -220,6 +595,17 @@ class Vcpu:
   def runBuf(self):
     return self._runBuf
 
+  # A memoryview over the kvm_run mapping, for decoding exits with struct.
+  @property
+  def runView(self):
+    return self._runView
+
+  # The coalesced MMIO ring shared by all vCPUs of the VM, or None if
+  # unsupported.
+  @property
+  def coalescedRing(self):
+    return self._coalescedRing
+
   @property
   def vm(self):
     return self._vm
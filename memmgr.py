@@ -1,13 +1,68 @@
-import kvmapi, mmap, ctypes
+import kvmapi, mmap, ctypes, bisect, os, atexit, threading
 
 MAP_NORESERVE = 0x4000
+MAP_HUGETLB   = 0x40000
+MAP_FAILED    = 0xFFFFFFFF_FFFFFFFF
+PAGE_SIZE     = 4096
+HUGE_PAGE_SIZE = 2*1024*1024
+MADV_DONTNEED = 4
+MADV_REMOVE   = 9
+MADV_HUGEPAGE = 14
+
+# Backing policies for RAM allocated by MemoryManager.mapNew:
+#
+#   anon      private anonymous memory with 4 KiB pages (the default)
+#   thp       private anonymous memory aligned to 2 MiB and marked with
+#             MADV_HUGEPAGE, so that it is backed by transparent huge pages
+#   hugetlb   private anonymous memory from the hugetlbfs pool (MAP_HUGETLB),
+#             which must have enough pages reserved (vm.nr_hugepages); slots
+#             which are not a multiple of 2 MiB fall back to anon
+#   memfd     a memfd mapped MAP_SHARED, which other processes can map via
+#             the slot's fd (e.g. /proc/<pid>/fd/<fd>)
+#   shm       a file under /dev/shm mapped MAP_SHARED, whose path is given by
+#             the slot's path and which is removed when the slot is torn down
+MEMORY_BACKINGS = ('anon', 'thp', 'hugetlb', 'memfd', 'shm')
+
+# Paths of shm backing files which have not yet been removed. Slots are not
+# necessarily torn down before the process exits, so any remaining files are
+# removed at exit.
+_shmPaths = set()
+
+@atexit.register
+def _removeShmFiles():
+  for path in list(_shmPaths):
+    _unlinkShm(path)
+
+def _unlinkShm(path):
+  _shmPaths.discard(path)
+  try:
+    os.unlink(path)
+  except FileNotFoundError:
+    pass
 
 def copyToRam(base, data):
-  buf = (ctypes.c_ubyte*len(data)).from_address(base)
-  for i, x in enumerate(data):
-    buf[i] = x
+  ramView(base, len(data))[:] = data
+
+# Returns a writable memoryview over L bytes of host memory at base, which is
+# usually guest RAM. The view must not be used after the memory is unmapped,
+# so it should not be retained beyond the request it was obtained for.
+def ramView(base, L):
+  return memoryview((ctypes.c_ubyte*L).from_address(base)).cast('B')
+
+# Orders the calling thread's earlier accesses to guest RAM before its later
+# ones, as observed by vCPUs. Needed where a device stores to guest memory and
+# then loads a value which the guest stores before loading the device's value,
+# as with virtio event indexes. Acquiring a lock executes a locked instruction,
+# which is a full barrier on x86.
+_barrierLock = threading.Lock()
+
+def memoryBarrier():
+  with _barrierLock:
+    pass
 
 class MemoryExtent:
+  __slots__ = ('base', 'len')
+
   def __init__(self, base, len):
     self.base = base
     self.len  = len
@@ -39,30 +94,39 @@ class MemoryExtent:
     else:
       raise NotImplementedError()
 
+  # Returns a writable memoryview over the extent. See ramView.
+  def view(self):
+    return ramView(self.base, self.len)
+
   def copyFrom(self, buf=None):
     if buf is None:
       assert self.len < 16*1024*1024
       buf = bytearray(self.len)
 
-    rbuf = (ctypes.c_ubyte*self.len).from_address(self.base)
-    for i in range(min(len(buf), self.len)):
-      buf[i] = rbuf[i]
-
+    n = min(len(buf), self.len)
+    memoryview(buf).cast('B')[:n] = ramView(self.base, n)
     return buf
 
   def copyTo(self, srcBuf):
-    dstBuf = (ctypes.c_ubyte*self.len).from_address(self.base)
-    for i, x in enumerate(srcBuf):
-      dstBuf[i] = x
+    srcBuf = memoryview(srcBuf).cast('B')
+    n = min(len(srcBuf), self.len)
+    ramView(self.base, n)[:] = srcBuf[:n]
 
 class MemorySlot:
-  def __init__(self, mgr, slotNo, guestPhysAddr, userspaceAddr, len, ro):
+  __slots__ = ('_mgr', 'slotNo', 'guestPhysAddr', 'userspaceAddr', 'len', 'ro', 'logDirty', 'backing', 'fd', 'path', 'mapped', '_wasAllocated', '_destroyed')
+
+  def __init__(self, mgr, slotNo, guestPhysAddr, userspaceAddr, len, ro, logDirty=False):
     self._mgr           = mgr
     self.slotNo         = slotNo
     self.guestPhysAddr  = guestPhysAddr
     self.userspaceAddr  = userspaceAddr
     self.len            = len
     self.ro             = ro
+    self.logDirty       = logDirty
+    self.backing        = None  # one of MEMORY_BACKINGS if allocated by mapNew
+    self.fd             = None  # for memfd and shm backings
+    self.path           = None  # for shm backing
+    self.mapped         = False # KVM accepted the last update; only mapped slots are resolved
     self._wasAllocated  = False
     self._destroyed     = False
 
@@ -72,14 +136,22 @@ class MemorySlot:
 
     oldLen = self.len
     self.len = 0
-    self.update()
+    if self.mapped:
+      self.update()
 
     if self._wasAllocated:
       print('@MemMgr: UNMAP (0x%x, 0x%x)' % (self.userspaceAddr, oldLen))
       kvmapi.munmap(self.userspaceAddr, oldLen)
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+    if self.path is not None:
+      _unlinkShm(self.path)
+      self.path = None
 
     del self._mgr._slots[self.slotNo]
     self._mgr._freeSlots.add(self.slotNo)
+    self._mgr._rebuildIndex()
     self._destroyed = True
 
   def update(self):
@@ -88,39 +160,162 @@ class MemorySlot:
     flags = 0
     if self.ro:
       flags = kvmapi.KVM_MEM_READONLY
+    if self.logDirty:
+      flags |= kvmapi.KVM_MEM_LOG_DIRTY_PAGES
 
     try:
       self._mgr._vmm.vm.setUserMemoryRegion(kvmapi.KvmUserSpaceMemoryRegion(self.slotNo, flags, self.guestPhysAddr, self.len, self.userspaceAddr))
       print('@MemMgr: MAPPED (0x%x, 0x%x)' % (self.userspaceAddr, self.len))
+      self.mapped = True
     except Exception as e:
       print('Warning: failed to update memory region: %s' % e)
+      self.mapped = False
+
+    self._mgr._rebuildIndex()
+
+  # Returns the bitmap of pages written by the guest since the last call (or
+  # since dirty logging was enabled) and clears it. Bit i, counting from the
+  # least significant bit of byte 0, covers bytes [i*4096, (i+1)*4096) of the
+  # slot. Writes made by the VMM itself through the userspace mapping are not
+  # tracked. Dirty logging must have been enabled with logDirty.
+  #
+  # () → bytes
+  def getDirtyLog(self):
+    assert self.logDirty and not self._destroyed
+    return self._mgr._vmm.vm.getDirtyLog(self.slotNo, (self.len + PAGE_SIZE - 1)//PAGE_SIZE)
+
+  # Returns a bytes object with one entry per page of [offset, offset+L),
+  # whose low bit is set if the page is resident. Anonymous pages which have
+  # never been touched are not resident and read as zero.
+  #
+  # (offset: int, L: int) → bytes
+  def residentPages(self, offset, L):
+    vec = (ctypes.c_ubyte * ((L + PAGE_SIZE - 1)//PAGE_SIZE))()
+    if kvmapi.mincore(self.userspaceAddr + offset, L, vec) != 0:
+      raise Exception("mincore failed")
+    return bytes(vec)
+
+  # Zeroes [offset, offset+L). If the slot was allocated by mapNew, its pages
+  # are discarded rather than written, which costs nothing for pages which are
+  # not resident. offset must be page-aligned.
+  def zero(self, offset, L):
+    advice = MADV_REMOVE if self.fd is not None else MADV_DONTNEED
+    if self._wasAllocated and kvmapi.madvise(self.userspaceAddr + offset, L, advice) == 0:
+      return
+
+    ramView(self.userspaceAddr + offset, L)[:] = bytes(L)
 
   def toExtent(self):
     return MemoryExtent(self.userspaceAddr, self.len)
 
 class MemoryManager:
-  def __init__(self, vmm):
+  # backing is the default backing policy for mapNew; see MEMORY_BACKINGS.
+  def __init__(self, vmm, backing='anon'):
+    if backing not in MEMORY_BACKINGS:
+      raise Exception("unknown memory backing: %s" % backing)
+
     self._vmm         = vmm
+    self.backing      = backing
     self._nextSlotNo  = 0
+    self._nextShmNo   = 0
     self._freeSlots   = set()
     self._slots       = {}
 
-  def mapExisting(self, guestPhysAddr, userspaceAddr, len, ro=False):
+    # Slots sorted by guest physical address, as ([guestPhysAddr...],
+    # [slot...]). Always replaced as a whole rather than mutated, so that it
+    # can be read without locking from any thread.
+    self._index       = ([], [])
+    self._lastHit     = (None, None)    # (slot, index)
+
+  def mapExisting(self, guestPhysAddr, userspaceAddr, len, ro=False, logDirty=False):
     slotNo = self._allocateSlotNo()
-    slot = MemorySlot(self, slotNo, guestPhysAddr, userspaceAddr, len, ro)
-    slot.update()
+    slot = MemorySlot(self, slotNo, guestPhysAddr, userspaceAddr, len, ro, logDirty)
     self._slots[slotNo] = slot
+    slot.update()
     return slot
 
-  def mapNew(self, guestPhysAddr, len, ro=False):
-    p = kvmapi.mmap(-1, len, mmap.PROT_READ | mmap.PROT_WRITE, mmap.MAP_ANON | mmap.MAP_PRIVATE | MAP_NORESERVE, -1, 0)
-    if p == 0xFFFFFFFF_FFFFFFFF:
-      raise Exception("failed to map RAM")
+  # Allocates len bytes of RAM and maps it at guestPhysAddr. backing overrides
+  # the default backing policy for this slot.
+  def mapNew(self, guestPhysAddr, len, ro=False, logDirty=False, backing=None):
+    backing = backing or self.backing
+    if backing == 'hugetlb' and len % HUGE_PAGE_SIZE != 0:
+      print('@MemMgr: slot of 0x%x bytes is not a multiple of the huge page size, using anon backing' % len)
+      backing = 'anon'
+
+    p, fd, path = self._allocate(len, backing)
+    try:
+      slot = self.mapExisting(guestPhysAddr, p, len, ro, logDirty)
+    except:
+      kvmapi.munmap(p, len)
+      if fd is not None:
+        os.close(fd)
+      if path is not None:
+        _unlinkShm(path)
+      raise
 
-    slot = self.mapExisting(guestPhysAddr, p, len, ro)
     slot._wasAllocated = True
+    slot.backing  = backing
+    slot.fd       = fd
+    slot.path     = path
     return slot
 
+  # Returns (userspaceAddr, fd, path) for a new mapping of len bytes with the
+  # given backing policy.
+  def _allocate(self, len, backing):
+    prot  = mmap.PROT_READ | mmap.PROT_WRITE
+    fd    = None
+    path  = None
+    if backing == 'anon':
+      p = kvmapi.mmap(-1, len, prot, mmap.MAP_ANON | mmap.MAP_PRIVATE | MAP_NORESERVE, -1, 0)
+
+    elif backing == 'thp':
+      # Over-allocate so that the mapping can be aligned to a huge page, and
+      # trim the excess.
+      p = kvmapi.mmap(-1, len + HUGE_PAGE_SIZE, prot, mmap.MAP_ANON | mmap.MAP_PRIVATE | MAP_NORESERVE, -1, 0)
+      if p != MAP_FAILED:
+        aligned = (p + HUGE_PAGE_SIZE - 1) & ~(HUGE_PAGE_SIZE - 1)
+        if aligned > p:
+          kvmapi.munmap(p, aligned - p)
+        kvmapi.munmap(aligned + len, p + HUGE_PAGE_SIZE - aligned)
+        p = aligned
+        if kvmapi.madvise(p, len, MADV_HUGEPAGE) != 0:
+          print('@MemMgr: warning: MADV_HUGEPAGE failed; transparent huge pages may be disabled')
+
+    elif backing == 'hugetlb':
+      # Without MAP_NORESERVE, so that a shortage of huge pages is reported
+      # here rather than as SIGBUS on first touch.
+      p = kvmapi.mmap(-1, len, prot, mmap.MAP_ANON | mmap.MAP_PRIVATE | MAP_HUGETLB, -1, 0)
+      if p == MAP_FAILED:
+        raise Exception("failed to map 0x%x bytes of hugetlb RAM: are enough huge pages reserved (vm.nr_hugepages)?" % len)
+
+    elif backing in ('memfd', 'shm'):
+      if backing == 'memfd':
+        fd = os.memfd_create('kvmtest-ram', os.MFD_CLOEXEC)
+      else:
+        path = '/dev/shm/kvmtest-%d-%d' % (os.getpid(), self._nextShmNo)
+        self._nextShmNo += 1
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600)
+        _shmPaths.add(path)
+
+      try:
+        os.ftruncate(fd, len)
+        p = kvmapi.mmap(-1, len, prot, mmap.MAP_SHARED, fd, 0)
+        if p == MAP_FAILED:
+          raise Exception("failed to map RAM")
+      except:
+        os.close(fd)
+        if path is not None:
+          _unlinkShm(path)
+        raise
+
+    else:
+      raise Exception("unknown memory backing: %s" % backing)
+
+    if p == MAP_FAILED:
+      raise Exception("failed to map RAM")
+
+    return p, fd, path
+
   def clear(self):
     for s in list(self._slots.values()):
       s.teardown()
@@ -128,25 +323,62 @@ class MemoryManager:
     assert len(self._slots) == 0
     self._nextSlotNo = 0
     self._freeSlots = set()
-
+    self._rebuildIndex()
+
+  # Must be called whenever a slot is added or removed, or its guest address or
+  # length changes. Slots which KVM refused to map, such as ones overlapping
+  # another slot, are left out, so that slots in the index never overlap.
+  def _rebuildIndex(self):
+    slots = sorted((s for s in self._slots.values() if s.len > 0 and s.mapped), key=lambda s: s.guestPhysAddr)
+    self._index   = ([s.guestPhysAddr for s in slots], slots)
+    self._lastHit = (None, None)
+
+  # May be called from vCPU and device backend threads while slots are being
+  # changed on another thread. The most recently hit slot is only used while
+  # the index it was found in is current.
   def resolveSlot(self, guestPhysAddr):
-    for slot in self._slots.values():
-      if guestPhysAddr >= slot.guestPhysAddr and guestPhysAddr < slot.guestPhysAddr + slot.len:
-        return slot
+    slot, hitIndex = self._lastHit
+    index = self._index
+    if hitIndex is index and guestPhysAddr >= slot.guestPhysAddr and guestPhysAddr < slot.guestPhysAddr + slot.len:
+      return slot
+
+    starts, slots = index
+    i = bisect.bisect_right(starts, guestPhysAddr) - 1
+    if i < 0:
+      return None
 
-    return None
+    slot = slots[i]
+    if guestPhysAddr >= slot.guestPhysAddr + slot.len:
+      return None
 
-  def resolveExtent(self, guestPhysAddr):
+    self._lastHit = (slot, index)
+    return slot
+
+  # (guestPhysAddr: u64) → (userspaceAddr, len)
+  #
+  # Translates a guest physical address to the host address it is mapped at
+  # and the number of contiguous bytes mapped from there. Returns (None, 0) if
+  # the address is not mapped.
+  def resolveAddr(self, guestPhysAddr):
     slot = self.resolveSlot(guestPhysAddr)
     if slot is None:
+      return (None, 0)
+
+    offset = guestPhysAddr - slot.guestPhysAddr
+    return (slot.userspaceAddr + offset, slot.len - offset)
+
+  def resolveExtent(self, guestPhysAddr):
+    addr, L = self.resolveAddr(guestPhysAddr)
+    if addr is None:
       return None
 
-    ex = slot.toExtent()[guestPhysAddr - slot.guestPhysAddr:]
-    assert ex.base >= slot.userspaceAddr
-    assert ex.base + ex.len <= slot.userspaceAddr + slot.len
-    return ex
+    return MemoryExtent(addr, L)
 
   def resolveExtents(self, guestPhysAddr, len):
+    addr, L = self.resolveAddr(guestPhysAddr)
+    if addr is not None and L >= len > 0:
+      return [MemoryExtent(addr, len)]
+
     bufs = []
     while len:
       extent = self.resolveExtent(guestPhysAddr)
@@ -160,18 +392,45 @@ class MemoryManager:
 
     return bufs
 
-  def read(self, guestPhysAddr, bufLen):
-    extents = self.resolveExtents(guestPhysAddr, bufLen)
+  # Returns a list of writable memoryviews covering [guestPhysAddr,
+  # guestPhysAddr+len), suitable for use as an iovec list (e.g. with
+  # os.preadv), or None if the range is not entirely backed by RAM. See
+  # ramView for restrictions on the lifetime of the views.
+  def views(self, guestPhysAddr, len):
+    extents = self.resolveExtents(guestPhysAddr, len)
     if extents is None:
       return None
 
-    b = b''
-    while len(b) < bufLen:
-      b += MultiReadBuffer(extents).read(bufLen - len(b))
+    return [extent.view() for extent in extents]
 
-    return b
+  def read(self, guestPhysAddr, bufLen):
+    buf = bytearray(bufLen)
+    if self.readinto(guestPhysAddr, buf) is None:
+      return None
+
+    return bytes(buf)
+
+  # Fills buf from guest memory starting at guestPhysAddr. Returns the number of
+  # bytes read, or None if the range is not entirely backed by RAM.
+  def readinto(self, guestPhysAddr, buf):
+    addr, L = self.resolveAddr(guestPhysAddr)
+    if addr is not None and L >= len(buf):
+      memoryview(buf).cast('B')[:] = ramView(addr, len(buf))
+      return len(buf)
+
+    extents = self.resolveExtents(guestPhysAddr, len(buf))
+    if extents is None:
+      return None
+
+    return MultiReadBuffer(extents).readinto(buf)
 
   def write(self, guestPhysAddr, buf):
+    addr, L = self.resolveAddr(guestPhysAddr)
+    if addr is not None and L >= len(buf):
+      buf = memoryview(buf).cast('B')
+      ramView(addr, len(buf))[:] = buf
+      return len(buf)
+
     extents = self.resolveExtents(guestPhysAddr, len(buf))
     if extents is None:
       return None
@@ -185,7 +444,9 @@ class MemoryManager:
     self._nextSlotNo += 1
     return slotNo
 
-class MultiReadBuffer:
+# A cursor over a scatter-gather list of guest memory extents, which are
+# consumed from the front as data is transferred.
+class MultiBuffer:
   # (bufs: [MemoryExtent...])
   def __init__(self, extents):
     self._extents = extents
@@ -197,47 +458,75 @@ class MultiReadBuffer:
       L += extent.len
     return L
 
-  def read(self, n):
-    if len(self._extents) == 0:
-      return b''
-
-    extent = self._extents[0]
-    n = min(n, extent.len)
-    b = bytes(extent[:n].copyFrom())
-    if extent.len - n == 0:
-      self._extents = self._extents[1:]
-    else:
-      self._extents[0] = self._extents[0][n:]
-
-    return b
-
-class MultiWriteBuffer:
-  # (bufs: [MemoryExtent...])
-  def __init__(self, extents):
-    self._extents = extents
+  # Returns writable memoryviews over the next n bytes of the buffer (or all
+  # remaining bytes if n is None), suitable for use as an iovec list, without
+  # consuming them. See ramView for restrictions on the lifetime of the views.
+  def views(self, n=None):
+    views = []
+    for extent in self._extents:
+      if n is not None and n <= 0:
+        break
+      L = extent.len if n is None else min(n, extent.len)
+      views.append(ramView(extent.base, L))
+      if n is not None:
+        n -= L
+
+    return views
+
+  # Consumes n bytes from the front of the buffer.
+  def advance(self, n):
+    while n > 0 and len(self._extents):
+      extent = self._extents[0]
+      if n >= extent.len:
+        n -= extent.len
+        self._extents = self._extents[1:]
+      else:
+        self._extents[0] = extent[n:]
+        n = 0
 
-  @property
-  def remaining(self):
-    L = 0
+  # Splits off the first n bytes of the buffer as a new buffer of the same
+  # type, consuming them from this one.
+  def take(self, n):
+    extents = []
     for extent in self._extents:
-      L += extent.len
-    return L
+      if n <= 0:
+        break
+      L = min(n, extent.len)
+      extents.append(extent[0:L])
+      n -= L
 
-  def write(self, b):
+    self.advance(sum(extent.len for extent in extents))
+    return type(self)(extents)
+
+class MultiReadBuffer(MultiBuffer):
+  # Reads up to n bytes, fewer only if the buffer is exhausted.
+  def read(self, n):
+    buf = bytearray(min(n, self.remaining))
+    n = self.readinto(buf)
+    del buf[n:]
+    return bytes(buf)
+
+  # Fills the writable buffer b with as many bytes as are available and returns
+  # the number of bytes read.
+  def readinto(self, b):
+    b = memoryview(b).cast('B')
     c = 0
-    while len(b):
-      if len(self._extents) == 0:
-        return c
+    for v in self.views(len(b)):
+      b[c:c+len(v)] = v
+      c += len(v)
 
-      extent = self._extents[0]
-      n = min(len(b), extent.len)
-      extent.copyTo(b[:n])
-      c += n
-      b = b[n:]
+    self.advance(c)
+    return c
 
-      if extent.len - n == 0:
-        self._extents = self._extents[1:]
-      else:
-        self._extents[0] = self._extents[0][n:]
+class MultiWriteBuffer(MultiBuffer):
+  # Writes as much of the bytes-like object b as fits and returns the number of
+  # bytes written.
+  def write(self, b):
+    b = memoryview(b).cast('B')
+    c = 0
+    for v in self.views(len(b)):
+      v[:] = b[c:c+len(v)]
+      c += len(v)
 
+    self.advance(c)
     return c
@@ -1,4 +1,6 @@
-import struct
+import struct, os
+import vmtrace
+from blockcache import *
 
 SCSI_TASK_ATTR__SIMPLE         = 0
 SCSI_TASK_ATTR__ORDERED        = 1
@@ -20,6 +22,7 @@ SCSI_TMF_RES__FUNCTION_REJECTED    = 2
 SCSI_TMF_RES__INCORRECT_LUN        = 3
 
 SCSI_SENSE_KEY__NO_SENSE    = 0x0
+SCSI_SENSE_KEY__MEDIUM_ERROR = 0x3
 SCSI_SENSE_KEY__HW_ERROR    = 0x4
 SCSI_SENSE_KEY__ILLEGAL_REQ = 0x5
 
@@ -39,6 +42,11 @@ class ScsiCmd:
   # It must also have a special attribute .len indicating the total
   # amount which can be written to it in bytes.
   #
+  # Either buffer may also support scatter-gather access, by providing
+  # .views(n), which returns a list of memoryviews over the next n bytes, and
+  # .advance(n), which consumes them (see memmgr.MultiBuffer). Devices can then
+  # transfer data directly to or from the buffer's memory.
+  #
   # (lun: u64, id: u64, cdb: bytes, taskAttr: TASk_ATTR__*, crn: u8?,
   #  priority: u4?, dataOutBuf: buffer?, dataInBuf: buffer?) → ScsiCmd
   def __init__(self, *, lun, id, cdb, taskAttr=SCSI_TASK_ATTR__SIMPLE, crn=None, priority=0, dataOutBuf=None, dataInBuf=None):
@@ -49,7 +57,8 @@ class ScsiCmd:
     self.lun        = lun
     self.id         = id
     self.cdb        = cdb
-    print('@Virtio: new cmd, cdb=%s' % self.cdb)
+    if vmtrace.mask & vmtrace.SCSI:
+      vmtrace.emit(vmtrace.EV_SCSI_CMD, lun, id, cdb[0])
     self.taskAttr   = taskAttr
     self.crn        = crn
     self.priority   = priority
@@ -80,6 +89,8 @@ class ScsiSenseTemplate:
       0,                # Sense Key Specific 1
       0)                # Sense Key Specific 2
 
+SCSI_ST__WRITE_ERROR                    = ScsiSenseTemplate(SCSI_SENSE_KEY__MEDIUM_ERROR, 0x0C, 0x00)
+SCSI_ST__UNRECOVERED_READ_ERROR         = ScsiSenseTemplate(SCSI_SENSE_KEY__MEDIUM_ERROR, 0x11, 0x00)
 SCSI_ST__INVALID_COMMAND_OPERATION_CODE = ScsiSenseTemplate(SCSI_SENSE_KEY__ILLEGAL_REQ, 0x20, 0x00)
 SCSI_ST__LBA_OUT_OF_RANGE               = ScsiSenseTemplate(SCSI_SENSE_KEY__ILLEGAL_REQ, 0x21, 0x00)
 SCSI_ST__INVALID_FIELD_IN_CDB           = ScsiSenseTemplate(SCSI_SENSE_KEY__ILLEGAL_REQ, 0x24, 0x00)
@@ -194,7 +205,6 @@ class ScsiDevice(IScsiSubsystem):
     elif opcode == 0x03: # REQUEST SENSE
       return self._handleREQUEST_SENSE(req)
     elif opcode == 0x12: # INQUIRY
-      print('@Virtio: as inquiry')
       return self._handleINQUIRY(req)
     else:
       print('@Virtio: as unhandled 0x%x' % req.cdb[0])
@@ -333,7 +343,6 @@ class ScsiDevice(IScsiSubsystem):
     if len(inquiryData) > req.dataInBuf.len:
       inquiryData = inquiryData[0:req.dataInBuf.len]
 
-    print('@Virtio: inquiry handled normally')
     req.dataInBuf.write(inquiryData)
     return ScsiResult.good()
 
@@ -349,11 +358,27 @@ class ScsiBlockDeviceBase(ScsiDevice):
   blockSize           = 512
   _openMode           = 'rb'
 
-  def __init__(self, subsystem, fn):
+  # Commands may be executed concurrently from multiple threads, so the backing
+  # file is only accessed with positioned I/O and never via the file offset.
+  #
+  # cacheMode is one of CACHE_MODES; if it is not 'none', the file is accessed
+  # through a BlockCache of at most cacheSize bytes. Read-only devices treat
+  # 'writeback' as 'writethrough'.
+  def __init__(self, subsystem, fn, cacheMode='none', cacheSize=64*1024*1024):
     super().__init__(subsystem)
     self._f = open(fn, self._openMode)
-    self._f.seek(0, 2)
-    self._capacity = self._f.tell()
+    self._fd = self._f.fileno()
+    self._capacity = os.fstat(self._fd).st_size
+    self._cache = None
+    if cacheMode != 'none':
+      self._cache = BlockCache(self._fd, self._capacity, maxSize=cacheSize, writeBack=(cacheMode == 'writeback' and self._openMode == 'r+b'))
+
+  # Writes back any cached writes and closes the backing file.
+  def teardown(self):
+    if self._cache:
+      self._cache.teardown()
+      print('@Scsi: %s cache: %s' % (type(self).__name__, self._cache.stats))
+    self._f.close()
 
   def _executeCommand(self, req):
     opcode = req.cdb[0]
@@ -390,11 +415,31 @@ class ScsiBlockDeviceBase(ScsiDevice):
       return ScsiResult.checkCondition(SCSI_ST__INVALID_FIELD_IN_CDB)
 
     lba, groupNo, xferLen = struct.unpack('>IBH', req.cdb[2:9])
-    print('@Virtio: reading LBA %s, count %s' % (lba, xferLen))
-    self._f.seek(lba*self.blockSize)
-    for i in range(xferLen):
-      d = self._f.read(self.blockSize)
-      req.dataInBuf.write(d)
+    if vmtrace.mask & vmtrace.SCSI:
+      vmtrace.emit(vmtrace.EV_SCSI_READ, lba, xferLen)
+    if xferLen == 0:
+      return ScsiResult.good()
+    if (lba + xferLen)*self.blockSize > self._capacity:
+      return ScsiResult.checkCondition(SCSI_ST__LBA_OUT_OF_RANGE)
+
+    L = min(xferLen*self.blockSize, req.dataInBuf.len)
+    try:
+      if self._cache:
+        n = self._cache.read(lba*self.blockSize, L, req.dataInBuf.write)
+      elif hasattr(req.dataInBuf, 'views'):
+        n = os.preadv(self._fd, req.dataInBuf.views(L), lba*self.blockSize)
+        req.dataInBuf.advance(n)
+      else:
+        d = os.pread(self._fd, L, lba*self.blockSize)
+        req.dataInBuf.write(d)
+        n = len(d)
+    except OSError as e:
+      print('@Scsi: read error at LBA %d: %s' % (lba, e))
+      return ScsiResult.checkCondition(SCSI_ST__UNRECOVERED_READ_ERROR)
+
+    if n != L:
+      print('@Scsi: short read at LBA %d: %d of %d bytes' % (lba, n, L))
+      return ScsiResult.checkCondition(SCSI_ST__UNRECOVERED_READ_ERROR)
     return ScsiResult.good()
 
   def _handleMODE_SENSE_6(self, req):
@@ -402,6 +447,15 @@ class ScsiBlockDeviceBase(ScsiDevice):
     pc            = pageCode>>6
     pageCode      = pageCode & 0x3F
     subPageCode   = req.cdb[3]
+    if pageCode in (0x08, 0x3F) and subPageCode == 0 and pc != 1: # Caching, All Pages
+      # Reporting the write cache lets the guest know to issue SYNCHRONIZE
+      # CACHE when the cache is write-back.
+      wce   = self._cache is not None and self._cache.writeBack
+      page  = bytes([0x08, 0x12, (1<<2) if wce else 0]).ljust(0x14, b'\0')
+      hdr   = struct.pack('>BBBB', 3 + len(page), 0, 0 if self._openMode == 'r+b' else 0x80, 0) # no block descriptors; WP if read-only
+      req.dataInBuf.write((hdr + page)[:req.cdb[4]])
+      return ScsiResult.good()
+
     print('@Virtio: unhandled MODE SENSE (6) pc=0x%x pageCode=0x%x subPageCode=0x%x' % (pc, pageCode, subPageCode))
     return ScsiResult.checkCondition(SCSI_ST__INVALID_COMMAND_OPERATION_CODE)
 
@@ -415,6 +469,8 @@ class ScsiBlockDevice(ScsiBlockDeviceBase):
       return self._handleWRITE_10(req)
     elif opcode == 0x41: # WRITE SAME (10)
       return self._handleWRITE_SAME_10(req)
+    elif opcode == 0x35: # SYNCHRONIZE CACHE (10)
+      return self._handleSYNCHRONIZE_CACHE_10(req)
     else:
       return super()._executeCommand(req)
 
@@ -423,13 +479,38 @@ class ScsiBlockDevice(ScsiBlockDeviceBase):
       return ScsiResult.checkCondition(SCSI_ST__INVALID_FIELD_IN_CDB)
 
     lba, groupNo, xferLen = struct.unpack('>IBH', req.cdb[2:9])
-    print('@Virtio: writing LBA %s, count %s' % (lba, xferLen))
-    self._f.seek(lba*self.blockSize)
-    for i in range(xferLen):
-      d = req.dataOutBuf.read(self.blockSize)
-      assert len(d) == self.blockSize
-      self._f.write(d)
-
+    if vmtrace.mask & vmtrace.SCSI:
+      vmtrace.emit(vmtrace.EV_SCSI_WRITE, lba, xferLen)
+    if xferLen == 0:
+      return ScsiResult.good()
+    if (lba + xferLen)*self.blockSize > self._capacity:
+      return ScsiResult.checkCondition(SCSI_ST__LBA_OUT_OF_RANGE)
+
+    L = xferLen*self.blockSize
+    try:
+      if self._cache:
+        views = req.dataOutBuf.views(L) if hasattr(req.dataOutBuf, 'views') else [req.dataOutBuf.read(L)]
+        assert sum(len(v) for v in views) == L
+        self._cache.write(lba*self.blockSize, views)
+        if hasattr(req.dataOutBuf, 'views'):
+          req.dataOutBuf.advance(L)
+        n = L
+      elif hasattr(req.dataOutBuf, 'views'):
+        views = req.dataOutBuf.views(L)
+        assert sum(len(v) for v in views) == L
+        n = os.pwritev(self._fd, views, lba*self.blockSize)
+        req.dataOutBuf.advance(n)
+      else:
+        d = req.dataOutBuf.read(L)
+        assert len(d) == L
+        n = os.pwrite(self._fd, d, lba*self.blockSize)
+    except OSError as e:
+      print('@Scsi: write error at LBA %d: %s' % (lba, e))
+      return ScsiResult.checkCondition(SCSI_ST__WRITE_ERROR)
+
+    if n != L:
+      print('@Scsi: short write at LBA %d: %d of %d bytes' % (lba, n, L))
+      return ScsiResult.checkCondition(SCSI_ST__WRITE_ERROR)
     return ScsiResult.good()
 
   def _handleWRITE_SAME_10(self, req):
@@ -437,20 +518,44 @@ class ScsiBlockDevice(ScsiBlockDeviceBase):
       return ScsiResult.checkCondition(SCSI_ST__INVALID_FIELD_IN_CDB)
 
     lba, groupNo, xferLen = struct.unpack('>IBH', req.cdb[2:9])
-    print('@Virtio: writing-same LBA %s, count %s' % (lba, xferLen))
+    if vmtrace.mask & vmtrace.SCSI:
+      vmtrace.emit(vmtrace.EV_SCSI_WRITE, lba, xferLen)
 
     lbdata = req.cdb[1] & (1<<1)
     pbdata = req.cdb[1] & (1<<2)
     if lbdata or pbdata:
       return ScsiResult.checkCondition(SCSI_ST__INVALID_FIELD_IN_CDB)
 
+    if (lba + xferLen)*self.blockSize > self._capacity:
+      return ScsiResult.checkCondition(SCSI_ST__LBA_OUT_OF_RANGE)
+
     d = req.dataOutBuf.read(self.blockSize)
     assert len(d) == self.blockSize
 
-    self._f.seek(lba*self.blockSize)
-    for i in range(xferLen):
-      self._f.write(d)
+    try:
+      if self._cache:
+        self._cache.write(lba*self.blockSize, [d]*xferLen)
+      else:
+        for i in range(xferLen):
+          n = os.pwrite(self._fd, d, (lba+i)*self.blockSize)
+          if n != self.blockSize:
+            print('@Scsi: short write at LBA %d: %d of %d bytes' % (lba+i, n, self.blockSize))
+            return ScsiResult.checkCondition(SCSI_ST__WRITE_ERROR)
+    except OSError as e:
+      print('@Scsi: write error at LBA %d: %s' % (lba, e))
+      return ScsiResult.checkCondition(SCSI_ST__WRITE_ERROR)
+
+    return ScsiResult.good()
 
+  def _handleSYNCHRONIZE_CACHE_10(self, req):
+    try:
+      if self._cache:
+        self._cache.flush()
+      else:
+        os.fdatasync(self._fd)
+    except OSError as e:
+      print('@Scsi: flush error: %s' % e)
+      return ScsiResult.checkCondition(SCSI_ST__WRITE_ERROR)
     return ScsiResult.good()
 
 class ScsiOpticalDevice(ScsiBlockDeviceBase):
@@ -589,13 +694,20 @@ class ScsiReportLunsLU(IScsiSubsystem):
 
 # A SCSI subsystem which routes via LUN.
 class ScsiSubsystem(IScsiSubsystem):
-  def __init__(self, *, diskPath=None, opticalPath=None):
+  # cacheMode and cacheSize configure the block cache of each device; see
+  # ScsiBlockDeviceBase.
+  def __init__(self, *, diskPath=None, opticalPath=None, cacheMode='none', cacheSize=64*1024*1024):
     self._luns = {}
     #self.registerLun(0xC101_0000_0000_0000, ScsiReportLunsLU(self))
     if opticalPath:
-      self.blk0 = self.registerLun(0x0100_4000_0000_0000, ScsiOpticalDevice(self, fn=opticalPath))
+      self.blk0 = self.registerLun(0x0100_4000_0000_0000, ScsiOpticalDevice(self, fn=opticalPath, cacheMode=cacheMode, cacheSize=cacheSize))
     if diskPath:
-      self.blk1 = self.registerLun(0x0100_4001_0000_0000, ScsiBlockDevice(self, fn=diskPath))
+      self.blk1 = self.registerLun(0x0100_4001_0000_0000, ScsiBlockDevice(self, fn=diskPath, cacheMode=cacheMode, cacheSize=cacheSize))
+
+  def teardown(self):
+    for lun in self._luns.values():
+      if hasattr(lun, 'teardown'):
+        lun.teardown()
 
   def registerLun(self, id, lun):
     self._luns[id] = lun
@@ -0,0 +1,382 @@
+import os, copy, collections, base64, json, struct, zlib, concurrent.futures
+import kvmapi
+from iodev import *
+from iodev_pci import *
+from memmgr import *
+
+# VM snapshots. A snapshot file contains:
+#
+#   header      (magic, version, length of metadata)
+#   metadata    JSON dict with vCPU, VM and device state and the RAM layout
+#   RAM chunks  zlib-compressed, concatenated in the order of the chunk table
+#
+# RAM is stored sparsely in chunks of RAM_CHUNK_SIZE bytes; chunks which are
+# entirely zero are omitted. Chunks are compressed and decompressed in
+# parallel, as zlib releases the GIL.
+#
+# Snapshots are only valid for a VMM constructed with the same platform and
+# arguments as the one which took them, as devices are matched up by the order
+# in which they are found. The metadata only ever decodes to plain data, so
+# reading a snapshot file cannot run code; see _decodeMeta.
+
+SNAPSHOT_MAGIC    = b'KVMSNAP\0'
+SNAPSHOT_VERSION  = 2
+RAM_CHUNK_SIZE    = 1<<20
+
+_header = struct.Struct('<8sIQ')  # magic, version, metadata length
+
+# vCPU and VM state ----------------------------------------------------------
+
+# (vcpu: Vcpu, msrIndices: [int], xsave: bool, xcrs: bool) → dict
+# xsave and xcrs say whether KVM supports KVM_CAP_XSAVE and KVM_CAP_XCRS. The
+# XSAVE area is saved in place of the legacy FPU state where supported, as it
+# also holds the AVX and later registers.
+def captureVcpu(vcpu, msrIndices, xsave=False, xcrs=False):
+  state = {
+    'regs':     bytes(vcpu.regs),
+    'sregs':    bytes(vcpu.sregs),
+    'lapic':    bytes(vcpu.lapic),
+    'events':   bytes(vcpu.events),
+    'mpState':  vcpu.mpState,
+    'msrs':     _getAllMsrs(vcpu, msrIndices),
+  }
+  if xsave:
+    state['xsave'] = bytes(vcpu.xsave)
+  else:
+    state['fpu'] = bytes(vcpu.fpu)
+  if xcrs:
+    state['xcrs'] = bytes(vcpu.xcrs)
+  return state
+
+# State is restored in the same order as QEMU does. The LAPIC is restored after
+# the APIC base in sregs, which sets its mode, and before the MSRs, as the TSC
+# deadline MSR is ignored unless the LAPIC is in TSC deadline mode.
+def restoreVcpu(vcpu, state):
+  vcpu.regs   = kvmapi.KvmRegs.from_buffer_copy(state['regs'])
+  if 'xsave' in state:
+    vcpu.xsave  = kvmapi.KvmXsave.from_buffer_copy(state['xsave'])
+  else:
+    vcpu.fpu    = kvmapi.KvmFpu.from_buffer_copy(state['fpu'])
+  if 'xcrs' in state:
+    vcpu.xcrs   = kvmapi.KvmXcrs.from_buffer_copy(state['xcrs'])
+  vcpu.sregs  = kvmapi.KvmSregs.from_buffer_copy(state['sregs'])
+  vcpu.lapic  = kvmapi.LocalApic.from_buffer_copy(state['lapic'])
+  _setAllMsrs(vcpu, state['msrs'])
+  vcpu.events = kvmapi.KvmVcpuEvents.from_buffer_copy(state['events'])
+  vcpu.mpState = state['mpState']
+
+# KVM_GET_MSRS stops at the first MSR which cannot be read, so MSRs are read in
+# as large batches as possible, skipping any which fail.
+def _getAllMsrs(vcpu, msrIndices):
+  msrs = []
+  i = 0
+  while i < len(msrIndices):
+    entries = vcpu.getMsrs(msrIndices[i:])
+    msrs.extend((e.index, e.data) for e in entries)
+    i += len(entries) + 1
+
+  return msrs
+
+def _setAllMsrs(vcpu, msrs):
+  i = 0
+  while i < len(msrs):
+    n = vcpu.setMsrs([kvmapi.KvmMsrEntry(index, 0, data) for index, data in msrs[i:]])
+    if i + n < len(msrs):
+      print('Warning: cannot restore MSR 0x%08x' % msrs[i+n][0])
+    i += n + 1
+
+# (vm: VM) → dict
+def captureVm(vm):
+  return {
+    'irqchips': [bytes(vm.getIrqchip(chipId)) for chipId in (kvmapi.KVM_IRQCHIP_PIC_MASTER, kvmapi.KVM_IRQCHIP_PIC_SLAVE, kvmapi.KVM_IRQCHIP_IOAPIC)],
+    'pit2':     bytes(vm.pit2),
+    'clock':    bytes(vm.clock),
+  }
+
+def restoreVm(vm, state):
+  for chip in state['irqchips']:
+    vm.setIrqchip(kvmapi.KvmIrqchip.from_buffer_copy(chip))
+  vm.pit2 = kvmapi.KvmPitState2.from_buffer_copy(state['pit2'])
+
+  clock = kvmapi.KvmClockData.from_buffer_copy(state['clock'])
+  clock.flags = 0
+  vm.clock = clock
+
+# Devices --------------------------------------------------------------------
+
+# Returns [(key, device)] for all devices reachable from the platform's PCI
+# subsystem and address spaces, in a deterministic order. A device is a
+# MemoryHandler, a PCI function, or any other object set up by registerDevice
+# (such as a PCI configuration space); devices are discovered by following
+# their attributes. The key is the class name and the ordinal of the device
+# among devices of the same class.
+def enumerateDevices(platform):
+  devices = []
+  seen    = set()
+  counts  = collections.Counter()
+
+  def isDevice(v):
+    return isinstance(v, (MemoryHandler, PciFunctionBase)) or hasattr(v, '__registerInitDone__')
+
+  def visit(obj):
+    if id(obj) in seen:
+      return
+    seen.add(id(obj))
+
+    if isinstance(obj, AddressSpace):
+      for h in obj.mappings:
+        visit(h)
+      return
+
+    name = type(obj).__name__
+    devices.append(('%s.%d' % (name, counts[name]), obj))
+    counts[name] += 1
+
+    for k in sorted(vars(obj)):
+      v = getattr(obj, k)
+      if isDevice(v):
+        visit(v)
+      elif isinstance(v, (list, tuple)):
+        for x in v:
+          if isDevice(x):
+            visit(x)
+
+  pci = platform.pciSubsystem
+  for bdf in sorted(pci.bdfs):
+    visit(pci.bdfs[bdf])
+  visit(platform.iospace)
+  visit(platform.mspace)
+  return devices
+
+_plainScalars = (type(None), bool, int, float, str, bytes, bytearray)
+
+def _isPlain(v):
+  if isinstance(v, _plainScalars):
+    return True
+  if isinstance(v, (list, tuple, set, frozenset, collections.deque)):
+    return all(_isPlain(x) for x in v)
+  if isinstance(v, dict):
+    return all(_isPlain(k) and _isPlain(x) for k, x in v.items())
+  return False
+
+# Attributes which are never captured: the position of a device is set up by
+# its construction and by its PCI BARs, which are restored separately.
+_skipAttrs = frozenset(('base', 'len'))
+
+# Captures the state of every device as {key: (registers, attributes)}, where
+# registers maps the names of RegisterInstances to their values, and attributes
+# holds every other instance attribute whose value is plain data (numbers,
+# strings, bytes and containers of them). Other attributes, such as locks,
+# threads and references to other objects, are assumed to be set up by the
+# device's construction.
+#
+# Devices with a quiesce() method have it called first, so that they can
+# complete any work in progress. Must be called with the vCPUs paused.
+def captureDevices(platform):
+  devices = enumerateDevices(platform)
+  for key, dev in devices:
+    if hasattr(dev, 'quiesce'):
+      dev.quiesce()
+
+  state = {}
+  for key, dev in devices:
+    regs  = {}
+    attrs = {}
+    for k, v in vars(dev).items():
+      if isinstance(v, RegisterInstance):
+        regs[k] = v.value
+      elif k not in _skipAttrs and not k.startswith('__') and _isPlain(v):
+        attrs[k] = copy.deepcopy(v)
+
+    state[key] = (regs, attrs)
+
+  return state
+
+# Undoes the quiesce() performed by captureDevices once the snapshot has been
+# captured, by calling resume() on devices which have it. Must be called with
+# the vCPUs still paused, whether or not the capture succeeded.
+def resumeDevices(platform):
+  for key, dev in enumerateDevices(platform):
+    if hasattr(dev, 'resume'):
+      dev.resume()
+
+# Restores state captured by captureDevices onto a freshly reset platform. PCI
+# BARs are then remapped, and devices with an onRestore() method have it
+# called once all state has been restored.
+def restoreDevices(platform, state):
+  devices = enumerateDevices(platform)
+  if set(key for key, dev in devices) != set(state):
+    raise Exception("snapshot does not match platform devices")
+
+  for key, dev in devices:
+    regs, attrs = state[key]
+    for k, v in regs.items():
+      getattr(dev, k).value = v
+    for k, v in attrs.items():
+      setattr(dev, k, copy.deepcopy(v))
+
+  for key, dev in devices:
+    if isinstance(dev, PciFunction):
+      _restoreBars(dev)
+
+  for key, dev in devices:
+    if hasattr(dev, 'onRestore'):
+      dev.onRestore()
+
+def _restoreBars(dev):
+  for barNo, bar in enumerate(dev.bars):
+    if bar is None:
+      continue
+
+    L, kind = bar
+    v = getattr(dev.config, 'bar%s' % barNo).value
+    if kind == 'io':
+      v = v & 0xFFFF_FFFC
+    else:
+      v = v & 0xFFFF_FFF0
+
+    if v != 0:
+      dev.cfgBarChanged(barNo, v)
+
+# RAM ------------------------------------------------------------------------
+
+_zeroChunk = bytes(RAM_CHUNK_SIZE)
+
+# Returns ([(guestPhysAddr, len)], [(slotIdx, offset, compressed)]) for all
+# memory slots. Must be called with the vCPUs paused.
+def captureRam(memoryManager, executor):
+  slots = sorted((s for s in memoryManager._slots.values() if s.len > 0), key=lambda s: s.guestPhysAddr)
+
+  def compress(job):
+    slotIdx, slot, offset = job
+    L = min(RAM_CHUNK_SIZE, slot.len - offset)
+    if not any(slot.residentPages(offset, L)):
+      return None
+
+    data = bytes(ramView(slot.userspaceAddr + offset, L))
+    if data == _zeroChunk[:L]:
+      return None
+    return (slotIdx, offset, zlib.compress(data, 1))
+
+  jobs = [(i, s, offset) for i, s in enumerate(slots) for offset in range(0, s.len, RAM_CHUNK_SIZE)]
+  chunks = [c for c in executor.map(compress, jobs) if c is not None]
+  return [(s.guestPhysAddr, s.len) for s in slots], chunks
+
+# Restores RAM captured by captureRam. Each slot must exist with the same
+# address and length. Chunks absent from the snapshot are zeroed.
+def restoreRam(memoryManager, layout, chunkTable, data, executor):
+  slotsByAddr = {(s.guestPhysAddr, s.len): s for s in memoryManager._slots.values()}
+  slots = []
+  for guestPhysAddr, L in layout:
+    slot = slotsByAddr.get((guestPhysAddr, L))
+    if slot is None:
+      raise Exception("snapshot memory slot 0x%x+0x%x does not exist" % (guestPhysAddr, L))
+    slots.append(slot)
+
+  present = set()
+  jobs    = []
+  pos     = 0
+  for slotIdx, offset, compressedLen in chunkTable:
+    jobs.append((slots[slotIdx], offset, data[pos:pos+compressedLen]))
+    present.add((slotIdx, offset))
+    pos += compressedLen
+
+  def decompress(job):
+    slot, offset, compressed = job
+    ramView(slot.userspaceAddr + offset, min(RAM_CHUNK_SIZE, slot.len - offset))[:] = zlib.decompress(compressed)
+
+  for x in executor.map(decompress, jobs):
+    pass
+
+  # Zero the absent chunks, in runs.
+  for slotIdx, slot in enumerate(slots):
+    start = None
+    for offset in range(0, slot.len + RAM_CHUNK_SIZE, RAM_CHUNK_SIZE):
+      absent = offset < slot.len and (slotIdx, offset) not in present
+      if absent and start is None:
+        start = offset
+      elif not absent and start is not None:
+        slot.zero(start, min(offset, slot.len) - start)
+        start = None
+
+# Files ----------------------------------------------------------------------
+
+# The metadata is plain data (see _isPlain) encoded as JSON. Values which JSON
+# cannot hold are encoded as an object with a single key naming their type,
+# such as {"bytes": "<base64>"}. Dicts are always encoded as {"dict": [[k, v],
+# ...]}, as their keys need not be strings.
+def _encodeMeta(v):
+  if v is None or isinstance(v, (bool, int, float, str)):
+    return v
+  if isinstance(v, list):
+    return [_encodeMeta(x) for x in v]
+  if isinstance(v, dict):
+    return {'dict': [[_encodeMeta(k), _encodeMeta(x)] for k, x in v.items()]}
+  if isinstance(v, bytes):
+    return {'bytes': base64.b64encode(v).decode('ascii')}
+  if isinstance(v, bytearray):
+    return {'bytearray': base64.b64encode(v).decode('ascii')}
+  if isinstance(v, collections.deque):
+    return {'deque': [_encodeMeta(x) for x in v], 'maxlen': v.maxlen}
+  for T in (tuple, set, frozenset):
+    if isinstance(v, T):
+      return {T.__name__: [_encodeMeta(x) for x in v]}
+  raise Exception("cannot encode %s in snapshot" % type(v).__name__)
+
+def _decodeMeta(v):
+  if v is None or isinstance(v, (bool, int, float, str)):
+    return v
+  if isinstance(v, list):
+    return [_decodeMeta(x) for x in v]
+
+  if isinstance(v, dict):
+    if set(v) == {'deque', 'maxlen'}:
+      return collections.deque((_decodeMeta(x) for x in v['deque']), v['maxlen'])
+    if len(v) == 1:
+      tag, x = next(iter(v.items()))
+      if tag == 'dict':
+        return {_decodeMeta(k): _decodeMeta(y) for k, y in x}
+      if tag == 'bytes':
+        return base64.b64decode(x)
+      if tag == 'bytearray':
+        return bytearray(base64.b64decode(x))
+      for T in (tuple, set, frozenset):
+        if tag == T.__name__:
+          return T(_decodeMeta(y) for y in x)
+
+  raise Exception("invalid snapshot metadata")
+
+# Writes a snapshot. chunks is as returned by captureRam; the chunk table is
+# added to meta.
+def writeSnapshot(path, meta, chunks):
+  meta = dict(meta, chunkTable=[(slotIdx, offset, len(c)) for slotIdx, offset, c in chunks])
+  metaBytes = json.dumps(_encodeMeta(meta), separators=(',', ':')).encode('utf-8')
+
+  tmpPath = path + '.tmp'
+  with open(tmpPath, 'wb') as f:
+    f.write(_header.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(metaBytes)))
+    f.write(metaBytes)
+    for slotIdx, offset, c in chunks:
+      f.write(c)
+  os.replace(tmpPath, path)
+
+# Returns (meta, data), where data is a memoryview of the RAM chunks.
+def readSnapshot(path):
+  with open(path, 'rb') as f:
+    buf = f.read()
+
+  magic, version, metaLen = _header.unpack_from(buf, 0)
+  if magic != SNAPSHOT_MAGIC:
+    raise Exception("not a snapshot file: %s" % path)
+  if version != SNAPSHOT_VERSION:
+    raise Exception("unsupported snapshot version: %s" % version)
+
+  start = _header.size
+  try:
+    meta = _decodeMeta(json.loads(buf[start:start+metaLen]))
+  except (ValueError, TypeError, RecursionError) as e:
+    raise Exception("invalid snapshot metadata: %s" % e)
+  return meta, memoryview(buf)[start+metaLen:]
+
+def newExecutor():
+  return concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='Snapshot')
@@ -0,0 +1,155 @@
+import sys, threading, time
+import kvmapi
+
+# Low-overhead statistics collection for the VMM. Latencies are recorded in
+# per-thread tables, so that recording never takes a lock, and are merged only
+# when a report is produced. Each key maps to a Histogram with log2 buckets of
+# nanoseconds.
+#
+# Keys are tuples whose first element is the category:
+#   ('exit', reason)        time spent handling an exit with the given raw reason
+#   ('port', port)          time spent handling an access to an I/O port
+#   ('mmio', page)          time spent handling an access to a 4 KiB MMIO page
+#   ('device', handler)     time spent in a device model's access handler
+
+NUM_BUCKETS = 64
+
+class Histogram:
+  __slots__ = ('count', 'totalNs', 'maxNs', 'buckets')
+
+  def __init__(self):
+    self.count    = 0
+    self.totalNs  = 0
+    self.maxNs    = 0
+    self.buckets  = [0]*NUM_BUCKETS # bucket i counts latencies in [2**(i-1), 2**i) ns
+
+  def record(self, ns):
+    self.count   += 1
+    self.totalNs += ns
+    if ns > self.maxNs:
+      self.maxNs = ns
+    self.buckets[min(ns.bit_length(), NUM_BUCKETS-1)] += 1
+
+  def merge(self, other):
+    self.count   += other.count
+    self.totalNs += other.totalNs
+    self.maxNs    = max(self.maxNs, other.maxNs)
+    for i, n in enumerate(other.buckets):
+      self.buckets[i] += n
+
+  # Returns the upper bound of the bucket containing the given quantile (0..1).
+  def quantileNs(self, q):
+    target = q*self.count
+    n = 0
+    for i, c in enumerate(self.buckets):
+      n += c
+      if n >= target and n > 0:
+        return 1<<i
+
+    return 0
+
+class StatsTable:
+  def __init__(self, name):
+    self.name   = name
+    self.hists  = {}
+
+  def record(self, key, ns):
+    h = self.hists.get(key)
+    if h is None:
+      h = self.hists[key] = Histogram()
+    h.record(ns)
+
+class Stats:
+  def __init__(self):
+    self._lock    = threading.Lock()
+    self._tables  = []
+    self._local   = threading.local()
+    self._startNs = time.perf_counter_ns()
+
+  # Returns the table for the calling thread.
+  def table(self):
+    t = getattr(self._local, 'table', None)
+    if t is None:
+      t = self._local.table = StatsTable(threading.current_thread().name)
+      with self._lock:
+        self._tables.append(t)
+    return t
+
+  # (key: tuple, ns: int) → ()
+  def record(self, key, ns):
+    self.table().record(key, ns)
+
+  def reset(self):
+    with self._lock:
+      for t in self._tables:
+        t.hists = {}
+      self._startNs = time.perf_counter_ns()
+
+  # Returns ({key: Histogram}, {threadName: {key: Histogram}}). Tables may be
+  # updated concurrently, so the result is only approximately consistent.
+  def merged(self):
+    with self._lock:
+      tables = list(self._tables)
+
+    total     = {}
+    perThread = {}
+    for t in tables:
+      hists = perThread.setdefault(t.name, {})
+      for k, h in list(t.hists.items()):
+        for d in (total, hists):
+          m = d.get(k)
+          if m is None:
+            m = d[k] = Histogram()
+          m.merge(h)
+
+    return total, perThread
+
+  def report(self, f=None, top=10):
+    f = f or sys.stderr
+    total, perThread = self.merged()
+    elapsedNs = time.perf_counter_ns() - self._startNs
+
+    def describe(key):
+      cat, k = key
+      if cat == 'exit':
+        try:
+          return kvmapi.KvmExitReason(k).name
+        except ValueError:
+          return 'exit %s' % k
+      elif cat == 'port':
+        return 'port 0x%04x' % k
+      elif cat == 'mmio':
+        return 'mmio 0x%x' % (k<<12)
+      elif cat == 'device':
+        return '%s@0x%x' % (type(k).__name__, getattr(k, 'base', 0))
+      return str(k)
+
+    def line(key, h):
+      f.write('  %-36s %10d %12.3f %10.2f %10.2f %10.2f\n' % (describe(key)[:36],
+        h.count, h.totalNs/1e6, h.totalNs/h.count/1e3, h.quantileNs(0.99)/1e3, h.maxNs/1e3))
+
+    def header(title):
+      f.write('%s\n  %-36s %10s %12s %10s %10s %10s\n' % (title, 'key', 'count', 'total ms', 'mean us', 'p99 us', 'max us'))
+
+    f.write('=== VMM statistics (%.3f s elapsed) ===\n' % (elapsedNs/1e9))
+    for cat, title in (('exit', 'Exits by reason'), ('port', 'I/O ports'), ('mmio', 'MMIO pages'), ('device', 'Devices')):
+      items = sorted(((k, h) for k, h in total.items() if k[0] == cat), key=lambda x: -x[1].totalNs)
+      if not items:
+        continue
+      header(title)
+      for k, h in items:
+        line(k, h)
+
+    f.write('Exits by thread\n')
+    for name, hists in sorted(perThread.items()):
+      n = sum(h.count for k, h in hists.items() if k[0] == 'exit')
+      t = sum(h.totalNs for k, h in hists.items() if k[0] == 'exit')
+      f.write('  %-36s %10d %12.3f\n' % (name, n, t/1e6))
+
+    offenders = sorted(((k, h) for k, h in total.items() if k[0] != 'exit'), key=lambda x: -x[1].totalNs)[:top]
+    if offenders:
+      header('Top offenders by total handling time')
+      for k, h in offenders:
+        line(k, h)
+
+    f.flush()
@@ -1,4 +1,5 @@
-import mmap, ctypes, struct
+import mmap, ctypes, struct, signal, threading, time
+import stats, vmtrace, snapshot
 import kvmo, kvmapi
 from cpuid import *
 from x86 import *
@@ -7,8 +8,21 @@ from memmgr import *
 
 MAP_NORESERVE = 0x4000
 
+# Signal used to force a vCPU thread out of KVM_RUN.
+VCPU_KICK_SIGNAL = signal.SIGRTMIN
+
+_EXIT_REASON  = kvmapi.KVM_RUN_EXIT_REASON
+_EXIT_IO      = kvmapi.KVM_RUN_EXIT_IO
+_EXIT_MMIO    = kvmapi.KVM_RUN_EXIT_MMIO
+_UINT         = kvmapi.UINT_STRUCTS
+
 class VMM:
-  def __init__(self, platformFunc, firmwarePath, firmwareVarsPath, opticalPath=None, diskPath=None):
+  # Any keyword arguments not consumed by the VMM are passed through to
+  # platformFunc. If irqfd is set, device interrupts are injected via
+  # KVM_IRQFD where supported. numCpus vCPUs are created, each of which is run
+  # on its own host thread. memBacking is the backing policy for guest RAM (see
+  # memmgr.MEMORY_BACKINGS).
+  def __init__(self, platformFunc, firmwarePath, firmwareVarsPath, numCpus=1, irqfd=True, memBacking='anon', **platformArgs):
     self.kvm = kvmo.Kvm()
 
     for e in (
@@ -23,25 +37,58 @@ class VMM:
         kvmapi.KvmCapability.KVM_CAP_EXT_CPUID):
       self.kvm.checkExtension(e)
 
+    # Needed to kick vCPUs out of KVM_RUN, and to complete their last exit
+    # without running the guest before their state is saved or replaced.
+    self._immediateExit = bool(self.kvm.checkExtension(kvmapi.KvmCapability.KVM_CAP_IMMEDIATE_EXIT))
+    if numCpus > 1:
+      if not self.kvm.checkExtension(kvmapi.KvmCapability.KVM_CAP_MP_STATE) or not self._immediateExit:
+        raise Exception("KVM does not support SMP guests")
+      maxCpus = self.kvm.getExtension(kvmapi.KvmCapability.KVM_CAP_MAX_VCPUS) or self.kvm.getExtension(kvmapi.KvmCapability.KVM_CAP_NR_VCPUS)
+      if numCpus > maxCpus:
+        raise Exception("too many vCPUs: %s (max %s)" % (numCpus, maxCpus))
+
     self.cpuids = self.kvm.getSupportedCpuid()
 
     self._firmwarePath = firmwarePath
     self._firmwareVarsPath = firmwareVarsPath
-    self._initVM()
-    self._initVcpu()
-    self._resetVcpu()
+    self._initVM(irqfd)
+    self._initVcpus(numCpus)
+    for vcpu in self.vcpus:
+      self._resetVcpu(vcpu)
     self.i = 0
-    self._memMgr = MemoryManager(self)
-    self._platform = platformFunc(memoryManager=self._memMgr, firmwarePath=self._firmwarePath, firmwareVarsPath=self._firmwareVarsPath, vm=self.vm, sysResetFunc=self.onSysReset, opticalPath=opticalPath, diskPath=diskPath)
-
-  def _initVM(self):
+    self.stats = stats.Stats()
+    self._initExitHandlers()
+
+    # State for running vCPUs on multiple threads. _vcpuCond protects all of
+    # these. _pauser is the vCPU (or True, for a non-vCPU thread) which has
+    # asked all other vCPUs to park at a safe point outside of KVM_RUN.
+    self._vcpuCond        = threading.Condition()
+    self._vcpuThreads     = {}
+    self._activeVcpus     = set()
+    self._parkedCount     = 0
+    self._pauser          = None
+    self._resetRequested  = False
+    self._stopping        = False
+    self._coalescedLock   = threading.Lock()
+
+    self._memMgr = MemoryManager(self, backing=memBacking)
+    self._platform = platformFunc(memoryManager=self._memMgr, firmwarePath=self._firmwarePath, firmwareVarsPath=self._firmwareVarsPath, vm=self.vm, sysResetFunc=self.onSysReset, numCpus=numCpus, **platformArgs)
+    self._registerCoalescedZones()
+
+  def _initVM(self, irqfd):
     self.vm = self.kvm.createVM()
     #self.vm.setTssAddr(0xFFFBD000)
     self.vm.createPit2(kvmapi.KvmPitConfig())
     self.vm.createIrqChip()
-
-  def _initVcpu(self):
-    self.vcpu = self.vm.createVcpu()
+    self.vm.useIrqfd = (irqfd
+      and self.kvm.checkExtension(kvmapi.KvmCapability.KVM_CAP_IRQFD)
+      and self.kvm.checkExtension(kvmapi.KvmCapability.KVM_CAP_IRQFD_RESAMPLE))
+
+  # Creates the vCPUs. vCPU 0 is the bootstrap processor and is also available
+  # as .vcpu; the others start in the wait-for-SIPI state.
+  def _initVcpus(self, numCpus):
+    self.vcpus = [self.vm.createVcpu(i) for i in range(numCpus)]
+    self.vcpu = self.vcpus[0]
     self._vcpuOrigRegs = self.vcpu.regs
     self._vcpuOrigSregs = self.vcpu.sregs
     self._vcpuOrigFpu = self.vcpu.fpu
@@ -101,7 +148,8 @@ class VMM:
     ebx, ecx, edx = struct.unpack('<III', cpuid[0:12])
     self.virtCpuids.append(kvmapi.KvmCpuidEntry2(0x4000_0000, 0, 0, 0x4000_0001 | 0x4000_0000, ebx, ecx, edx))
     #self.virtCpuids.append(kvmapi.KvmCpuidEntry2(0x4000_0001, 0, 0, 0, 0, 0, 0))
-    self.vcpu.setCpuid2(self.virtCpuids)
+    for vcpu in self.vcpus:
+      vcpu.setCpuid2(self._makeVcpuCpuids(vcpu.cpuNum, numCpus))
     self._initVcpuLapic(self.vcpu)
 
     filterMsrs = (MSR_TSC, 0x4000_0020)
@@ -112,29 +160,174 @@ class VMM:
     for e in self.vcpu.getMsrs(mil):
       self._initialMsrState[e.index] = e.data
 
+  # Returns a copy of virtCpuids with the topology fields filled in for the
+  # given vCPU, so that each vCPU reports its own APIC ID. The vCPUs are the
+  # cores of a single package, with one thread each, so that their APIC IDs
+  # are 0 to numCpus-1; the host's topology is never passed through.
+  def _makeVcpuCpuids(self, cpuNum, numCpus):
+    coreBits = (numCpus - 1).bit_length() # APIC ID bits holding the core number
+    cpuids = []
+    for c in self.virtCpuids:
+      c = kvmapi.KvmCpuidEntry2.from_buffer_copy(c)
+      if c.function == 1:
+        c.ebx = (c.ebx & 0xFFFF) | (min(numCpus, 0xFF)<<16) | ((cpuNum & 0xFF)<<24)
+        if numCpus > 1:
+          c.edx |= (1<<28) # HTT
+      elif c.function == 4 and c.eax & 0x1F:
+        # Deterministic cache parameters: cores per package, and threads
+        # sharing the cache, both minus one. Caches below L3 are per core.
+        sharing = (1<<coreBits) if (c.eax>>5) & 7 >= 3 else 1
+        c.eax = (c.eax & 0x3FFF) | (((sharing - 1) & 0xFFF)<<14) | ((((1<<coreBits) - 1) & 0x3F)<<26)
+      elif c.function == 0xB or c.function == 0x1F:
+        if c.index == 0:
+          cpuids.extend(self._makeTopologyLeaf(c.function, cpuNum, numCpus))
+        continue
+      cpuids.append(c)
+
+    return cpuids
+
+  # Returns the subleaves of the extended topology leaf 0xB or 0x1F: an SMT
+  # level of one thread, a core level of numCpus cores, and the invalid level
+  # which ends the list. Each reports the vCPU's x2APIC ID in EDX.
+  def _makeTopologyLeaf(self, function, cpuNum, numCpus):
+    coreBits  = (numCpus - 1).bit_length()
+    flags     = kvmapi.KVM_CPUID_FLAG_SIGNIFCANT_INDEX
+    return [
+      #                      function  index  flags  eax       ebx      ecx        edx
+      kvmapi.KvmCpuidEntry2(function, 0,     flags, 0,        1,       (1<<8)|0,  cpuNum), # SMT
+      kvmapi.KvmCpuidEntry2(function, 1,     flags, coreBits, numCpus, (2<<8)|1,  cpuNum), # core
+      kvmapi.KvmCpuidEntry2(function, 2,     flags, 0,        0,       2,         cpuNum),
+    ]
+
+  # Registers the ranges device models have declared as coalescible with KVM.
+  # The zones are at fixed addresses, so this need not be repeated when the
+  # platform is reset.
+  def _registerCoalescedZones(self):
+    if self.vcpu.coalescedRing is None:
+      return
+
+    for addr, L in self._platform.mspace.coalescedZones():
+      self.vm.registerCoalescedZone(addr, L)
+
+    if not self.kvm.checkExtension(kvmapi.KvmCapability.KVM_CAP_COALESCED_PIO):
+      return
+
+    for addr, L in self._platform.iospace.coalescedZones():
+      self.vm.registerCoalescedZone(addr, L, pio=True)
+
+  # Replays any writes buffered in the coalesced MMIO ring. Must be done before
+  # handling any exit so that devices observe accesses in guest order. The ring
+  # is shared by all vCPUs.
+  def _drainCoalesced(self, vcpu):
+    ring = vcpu.coalescedRing
+    if ring is None or ring.first == ring.last:
+      return
+
+    with self._coalescedLock:
+      first = ring.first
+      while first != ring.last:
+        e = ring.entries[first]
+        v = int.from_bytes(bytes(e.data)[0:e.len], 'little')
+        if e.pio:
+          self._handleIoWrite(e.physAddr, v, e.len)
+        else:
+          self._handleMmioWrite(e.physAddr, v, e.len)
+
+        first = (first + 1) % kvmapi.KVM_COALESCED_MMIO_MAX
+        ring.first = first
+
+  # Called by the platform, usually from device emulation on a vCPU thread, to
+  # request a system reset. The reset is carried out by the next vCPU thread
+  # to reach a safe point, once all other vCPUs have been parked.
   def onSysReset(self):
-    self._memMgr.clear()
-    self._resetVcpu()
+    with self._vcpuCond:
+      self._resetRequested = True
 
-  def _resetVcpu(self):
+    self._kickVcpus()
+
+  def _doSysReset(self, current):
+    self._pauseVcpus(current)
+    try:
+      self._platform.teardown()
+      self._memMgr.clear()
+      for vcpu in self.vcpus:
+        self._resetVcpu(vcpu)
+      self._platform.reset()
+    finally:
+      self._resumeVcpus()
+
+  # Saves the state of the whole VM (vCPUs, in-kernel interrupt controllers
+  # and timers, devices and RAM) to path. The vCPUs are paused while the state
+  # is captured. Must not be called from a vCPU thread.
+  def snapshot(self, path):
+    t0 = time.perf_counter()
+    msrIndices = self.kvm.getMsrIndexList()
+    xsave = self.kvm.checkExtension(kvmapi.KvmCapability.KVM_CAP_XSAVE)
+    xcrs = self.kvm.checkExtension(kvmapi.KvmCapability.KVM_CAP_XCRS)
+    with snapshot.newExecutor() as executor:
+      self._pauseVcpus()
+      try:
+        meta = {
+          'platform': type(self._platform).__name__,
+          'numCpus':  len(self.vcpus),
+          'vcpus':    [snapshot.captureVcpu(vcpu, msrIndices, xsave, xcrs) for vcpu in self.vcpus],
+          'vm':       snapshot.captureVm(self.vm),
+          'devices':  snapshot.captureDevices(self._platform),
+        }
+        meta['ram'], chunks = snapshot.captureRam(self._memMgr, executor)
+      finally:
+        try:
+          snapshot.resumeDevices(self._platform)
+        finally:
+          self._resumeVcpus()
+
+    snapshot.writeSnapshot(path, meta, chunks)
+    print('Snapshot written to %s (%d RAM chunks, %.3f s)' % (path, len(chunks), time.perf_counter() - t0))
+
+  # Restores a snapshot taken with snapshot(). The VMM must have been
+  # constructed with the same platform and arguments. May be called before
+  # run(), or while running from a thread other than a vCPU thread.
+  def restore(self, path):
+    t0 = time.perf_counter()
+    meta, data = snapshot.readSnapshot(path)
+    if meta['platform'] != type(self._platform).__name__ or meta['numCpus'] != len(self.vcpus):
+      raise Exception("snapshot is for a different machine: %s with %s vCPUs" % (meta['platform'], meta['numCpus']))
+
+    with snapshot.newExecutor() as executor:
+      self._pauseVcpus()
+      try:
+        self._platform.teardown()
+        self._memMgr.clear()
+        self._platform.reset()
+        snapshot.restoreDevices(self._platform, meta['devices'])
+        snapshot.restoreRam(self._memMgr, meta['ram'], meta['chunkTable'], data, executor)
+        snapshot.restoreVm(self.vm, meta['vm'])
+        for vcpu, state in zip(self.vcpus, meta['vcpus']):
+          snapshot.restoreVcpu(vcpu, state)
+      finally:
+        self._resumeVcpus()
+
+    print('Snapshot restored from %s (%.3f s)' % (path, time.perf_counter() - t0))
+
+  def _resetVcpu(self, vcpu):
     sregs = self._vcpuOrigSregs
     for x in ('cs','ss','ds','es','fs','gs'):
       q = getattr(sregs,x)
       q.selector = 0xF000
       q.base     = 0xF000<<4
-    self.vcpu.sregs = sregs
+    vcpu.sregs = sregs
 
     regs = kvmapi.KvmRegs()
     regs.rflags = 2
     regs.rip    = 0xFFF0
     regs.rsp    = 0x8000
     regs.rbp    = 0x8000
-    self.vcpu.regs = regs
+    vcpu.regs = regs
 
     fpu = kvmapi.KvmFpu()
     fpu.fcw     = 0x37f
     fpu.mxcsr   = 0x1f80
-    self.vcpu.fpu = fpu
+    vcpu.fpu = fpu
 
     msrs = []
     def addMsr(k,v):
@@ -144,7 +337,7 @@ class VMM:
       msrs.append(z)
 
     initialMsrState   = list(self._initialMsrState.items())
-    curMsrValues      = self.vcpu.getMsrs(list([k for k, v in initialMsrState]))
+    curMsrValues      = vcpu.getMsrs(list([k for k, v in initialMsrState]))
     for i in range(len(initialMsrState)):
       msrNo, oldV = initialMsrState[i]
       assert curMsrValues[i].index == msrNo
@@ -163,10 +356,15 @@ class VMM:
     addMsr(MSR_LSTAR, 0)
     addMsr(MSR_IA32_TSC, 0)
     addMsr(MSR_IA32_MISC_ENABLE, MSR_IA32_MISC_ENABLE__FAST_STRING)
-    self.vcpu.setMsrs(msrs)
+    vcpu.setMsrs(msrs)
 
-    #self.vcpu.setMsrs([kvmapi.KvmMsrEntry(0x2ff, 0, 0)])
-    assert self.vcpu.getMsrs([0x2ff])[0].data == 0
+    #vcpu.setMsrs([kvmapi.KvmMsrEntry(0x2ff, 0, 0)])
+    assert vcpu.getMsrs([0x2ff])[0].data == 0
+
+    if vcpu.cpuNum == 0:
+      vcpu.mpState = kvmapi.KVM_MP_STATE_RUNNABLE
+    else:
+      vcpu.mpState = kvmapi.KVM_MP_STATE_UNINITIALIZED
 
   def _initVcpuLapic(self, vcpu):
     APIC_MODE_EXTINT = 0x7
@@ -178,13 +376,15 @@ class VMM:
     lapic.lvtLINT1 |= APIC_MODE_EXTINT<<8
     vcpu.lapic = lapic
 
-  def _dumpRegs(self):
-    regs = self.vcpu.regs
+  def _dumpRegs(self, vcpu=None):
+    vcpu = vcpu or self.vcpu
+    regs = vcpu.regs
+    print("  CPU=%d" % vcpu.cpuNum)
     print("  RAX=0x%016x" % regs.rax)
     print("  RIP=0x%016x" % regs.rip)
     print("  RFLAGS=0x%016x" % regs.rflags)
 
-    sregs = self.vcpu.sregs
+    sregs = vcpu.sregs
     print("  CR0=0x%08x CR4=0x%08x" % (sregs.cr0, sregs.cr4))
     print("  GDT=0x%08x L=0x%08x" % (sregs.gdt.base, sregs.gdt.limit))
     print("  CS=0x%04x B=0x%08x L=0x%08x " % (sregs.cs.selector, sregs.cs.base, sregs.cs.limit))
@@ -202,157 +402,318 @@ class VMM:
     busNo  = (cf8>>16)&0xFF
     return '(%s:%s.%s) + 0x%02x' % (busNo,devNo,funcNo,regNo)
 
+  # Accesses are dispatched directly to the device handling the address, with
+  # that device's lock held, so that vCPUs accessing different devices do not
+  # serialise against one another. The time taken is recorded against the port
+  # or MMIO page and the device.
   def _handleIoRead(self, addr, width):
-    if width == 1:
-      return self._platform.iospace.read8(addr)
-    elif width == 2:
-      return self._platform.iospace.read16(addr)
-    elif width == 4:
-      return self._platform.iospace.read32(addr)
-    else:
+    t0 = time.perf_counter_ns()
+    handler = self._platform.iospace.resolveLeaf(addr)
+    f = handler.readers.get(width)
+    if f is None:
       raise Exception("invalid width")
+    with handler.deviceLock:
+      v = f(addr)
+
+    self._recordAccess(('port', addr), handler, t0)
+    if vmtrace.mask & vmtrace.PIO:
+      vmtrace.emit(vmtrace.EV_PIO_READ, addr, v, width)
+    return v
 
   def _handleIoWrite(self, addr, v, width):
-    if width == 1:
-      self._platform.iospace.write8(addr, v)
-    elif width == 2:
-      self._platform.iospace.write16(addr, v)
-    elif width == 4:
-      self._platform.iospace.write32(addr, v)
-    else:
+    t0 = time.perf_counter_ns()
+    handler = self._platform.iospace.resolveLeaf(addr)
+    f = handler.writers.get(width)
+    if f is None:
       raise Exception("invalid width")
+    with handler.deviceLock:
+      f(addr, v)
+
+    self._recordAccess(('port', addr), handler, t0)
+    if vmtrace.mask & vmtrace.PIO:
+      vmtrace.emit(vmtrace.EV_PIO_WRITE, addr, v, width)
+
+  def _handleIoReadBlock(self, addr, width, count):
+    t0 = time.perf_counter_ns()
+    handler = self._platform.iospace.resolveLeaf(addr)
+    with handler.deviceLock:
+      data = handler.readBlock(addr, width, count)
+    if len(data) != count*width:
+      raise Exception("%s: readBlock returned %d bytes, expected %d" % (handler, len(data), count*width))
+
+    self._recordAccess(('port', addr), handler, t0)
+    if vmtrace.mask & vmtrace.PIO:
+      vmtrace.emit(vmtrace.EV_PIO_READ_BLOCK, addr, count, width)
+    return data
+
+  def _handleIoWriteBlock(self, addr, data, width):
+    t0 = time.perf_counter_ns()
+    handler = self._platform.iospace.resolveLeaf(addr)
+    with handler.deviceLock:
+      handler.writeBlock(addr, width, data)
+
+    self._recordAccess(('port', addr), handler, t0)
+    if vmtrace.mask & vmtrace.PIO:
+      vmtrace.emit(vmtrace.EV_PIO_WRITE_BLOCK, addr, len(data)//width, width)
 
   def _handleMmioRead(self, addr, width):
-    if width == 1:
-      return self._platform.mspace.read8(addr)
-    elif width == 2:
-      return self._platform.mspace.read16(addr)
-    elif width == 4:
-      return self._platform.mspace.read32(addr)
-    elif width == 8:
-      return self._platform.mspace.read64(addr)
-    else:
+    t0 = time.perf_counter_ns()
+    handler = self._platform.mspace.resolveLeaf(addr)
+    f = handler.readers.get(width)
+    if f is None:
       raise Exception("invalid width")
+    with handler.deviceLock:
+      v = f(addr)
+
+    self._recordAccess(('mmio', addr>>12), handler, t0)
+    if vmtrace.mask & vmtrace.MMIO:
+      vmtrace.emit(vmtrace.EV_MMIO_READ, addr, v, width)
+    return v
 
   def _handleMmioWrite(self, addr, v, width):
-    if width == 1:
-      self._platform.mspace.write8(addr, v)
-    elif width == 2:
-      self._platform.mspace.write16(addr, v)
-    elif width == 4:
-      self._platform.mspace.write32(addr, v)
-    elif width == 8:
-      self._platform.mspace.write64(addr, v)
-    else:
+    t0 = time.perf_counter_ns()
+    handler = self._platform.mspace.resolveLeaf(addr)
+    f = handler.writers.get(width)
+    if f is None:
       raise Exception("invalid width")
-
-  def runOnce(self):
+    with handler.deviceLock:
+      f(addr, v)
+
+    self._recordAccess(('mmio', addr>>12), handler, t0)
+    if vmtrace.mask & vmtrace.MMIO:
+      vmtrace.emit(vmtrace.EV_MMIO_WRITE, addr, v, width)
+
+  def _recordAccess(self, key, handler, t0):
+    ns = time.perf_counter_ns() - t0
+    table = self.stats.table()
+    table.record(key, ns)
+    table.record(('device', handler), ns)
+
+  # Runs the given vCPU (by default the BSP) until its next exit and handles
+  # it. Returns False if the VM should stop.
+  def runOnce(self, vcpu=None):
+    vcpu = vcpu or self.vcpu
     try:
-      self.vcpu.runOnce()
+      vcpu.runOnce()
     except InterruptedError as e:
+      if vcpu.kickPending:
+        vcpu.kickPending = False
+        return True
       print("Interrupted")
-      self._dumpRegs()
+      self._dumpRegs(vcpu)
       return True
     except KeyboardInterrupt:
       print("Keyboard Interrupt")
-      self._dumpRegs()
+      self._dumpRegs(vcpu)
       self.i += 1
       return self.i < 2
 
-    reason = self.vcpu.reason
-    if reason == kvmapi.KvmExitReason.KVM_EXIT_UNKNOWN:
-      print("unknown exit reason")
-    elif reason == kvmapi.KvmExitReason.KVM_EXIT_DEBUG:
-      dbg = self.vcpu.runData.exitReasons.debug
-      print("exit debug: exc=0x%x pc=0x%x" % (dbg.exception, dbg.pc))
-      self._dumpRegs()
-    elif reason == kvmapi.KvmExitReason.KVM_EXIT_IO:
-      io = self.vcpu.runData.exitReasons.io
-      if io.direction: # out
-        #r = self.vcpu.runBuf.seek(io.dataOffset)
-        #r = self.vcpu.runBuf.read(io.size)
-        r = bytearray(io.size)
-        for i in range(io.size):
-          r[i] = self.vcpu.runBuf[io.dataOffset+i]
-        if io.size == 1:
-          v = struct.unpack('<B', r)[0]
-        elif io.size == 2:
-          v = struct.unpack('<H', r)[0]
-        elif io.size == 4:
-          v = struct.unpack('<I', r)[0]
-        else:
-          raise Exception('...')
-        if io.port != 0x402 and io.port != 0x3f8 and io.port != 0x3fd:
-          print("exit I/O wr: 0x%x <- u%s(0x%x)" % (io.port, io.size*8, v))
-        self._handleIoWrite(io.port, v, io.size)
+    t0 = time.perf_counter_ns()
+    self._drainCoalesced(vcpu)
+
+    reason = _EXIT_REASON.unpack_from(vcpu.runView, kvmapi.KVM_RUN_EXIT_REASON_OFFSET)[0]
+    f = self._exitHandlers.get(reason)
+    if f is not None:
+      r = f(vcpu)
+    else:
+      print("other exit reason: %s" % reason)
+      r = True
+
+    ns = time.perf_counter_ns() - t0
+    self.stats.record(('exit', reason), ns)
+    if vmtrace.mask & vmtrace.EXIT:
+      vmtrace.emit(vmtrace.EV_EXIT, reason, ns)
+    return r
+
+  # Exit handlers, keyed by the raw exit reason. Each takes the vCPU and
+  # returns False if the VM should stop. Exit data is decoded directly from the
+  # kvm_run mapping with precompiled structs.
+  def _initExitHandlers(self):
+    R = kvmapi.KvmExitReason
+    self._exitHandlers = {
+      int(R.KVM_EXIT_IO):             self._handleExitIo,
+      int(R.KVM_EXIT_MMIO):           self._handleExitMmio,
+      int(R.KVM_EXIT_UNKNOWN):        self._handleExitUnknown,
+      int(R.KVM_EXIT_DEBUG):          self._handleExitDebug,
+      int(R.KVM_EXIT_INTR):           self._handleExitIntr,
+      int(R.KVM_EXIT_SHUTDOWN):       self._handleExitShutdown,
+      int(R.KVM_EXIT_SYSTEM_EVENT):   self._handleExitSystemEvent,
+      int(R.KVM_EXIT_HLT):            self._handleExitHlt,
+    }
+
+  def _handleExitIo(self, vcpu):
+    view = vcpu.runView
+    direction, size, port, count, dataOffset = _EXIT_IO.unpack_from(view, kvmapi.KVM_RUN_EXIT_OFFSET)
+    st = _UINT.get(size)
+    if st is None:
+      raise Exception("invalid width")
+
+    if count != 1:
+      # String I/O (rep ins/outs): the kernel has exited once for the whole
+      # string, whose count*size bytes are all at dataOffset.
+      end = dataOffset + count*size
+      if direction: # out
+        self._handleIoWriteBlock(port, view[dataOffset:end], size)
       else: # in
-        result = self._handleIoRead(io.port, io.size)
-        if io.size == 1:
-          buf = struct.pack('<B', result)
-        elif io.size == 2:
-          buf = struct.pack('<H', result)
-        elif io.size == 4:
-          buf = struct.pack('<I', result)
-        else:
-          raise Exception('...')
-
-        #self.vcpu.runBuf.seek(io.dataOffset)
-        #self.vcpu.runBuf.write(buf)
-        for i in range(len(buf)):
-          self.vcpu.runBuf[io.dataOffset+i] = buf[i]
-        if io.port != 0x402 and io.port != 0x3f8 and io.port != 0x3fd:
-          print("I/O rd: 0x%x -> u%s: 0x%x" % (io.port, io.size*8, result))
-
-    elif reason == kvmapi.KvmExitReason.KVM_EXIT_MMIO: #direction size port count dataOffset
-      mmio = self.vcpu.runData.exitReasons.mmio
-      if mmio.isWrite:
-        if mmio.len == 1:
-          v = mmio.data[0] #struct.unpack('<B', mmio.data)[0]
-        elif mmio.len == 2:
-          v = struct.unpack('<H', bytes(mmio.data)[0:2])[0]
-        elif mmio.len == 4:
-          v = struct.unpack('<I', bytes(mmio.data)[0:4])[0]
-        elif mmio.len == 8:
-          v = struct.unpack('<Q', mmio.data)[0]
-        else:
-          raise Exception('...')
+        view[dataOffset:end] = self._handleIoReadBlock(port, size, count)
+    elif direction: # out
+      self._handleIoWrite(port, st.unpack_from(view, dataOffset)[0], size)
+    else: # in
+      st.pack_into(view, dataOffset, self._handleIoRead(port, size))
 
-        self._handleMmioWrite(mmio.physAddr, v, mmio.len)
-        print("exit MMIO: 0x%x <- u%d(0x%x)" % (mmio.physAddr, mmio.len*8, v))
-      else:
-        result = self._handleMmioRead(mmio.physAddr, mmio.len)
-        if mmio.len == 1:
-          buf = struct.pack('<B', result)
-        elif mmio.len == 2:
-          buf = struct.pack('<H', result)
-        elif mmio.len == 4:
-          buf = struct.pack('<I', result)
-        elif mmio.len == 8:
-          buf = struct.pack('<Q', result)
-        else:
-          raise Exception('...')
-
-        for i in range(len(buf)):
-          mmio.data[i] = buf[i]
-
-        print("exit MMIO: 0x%x -> u%d" % (mmio.physAddr, mmio.len*8))
-
-    elif reason == kvmapi.KvmExitReason.KVM_EXIT_INTR:
-      print("exit INTR")
-    elif reason == kvmapi.KvmExitReason.KVM_EXIT_SHUTDOWN:
-      print("exit shutdown")
-      return False
-    elif reason == kvmapi.KvmExitReason.KVM_EXIT_SYSTEM_EVENT:
-      print("exit system event")
-    elif reason == kvmapi.KvmExitReason.KVM_EXIT_HLT:
-      print("exit halt")
-      return False
+    return True
+
+  def _handleExitMmio(self, vcpu):
+    view = vcpu.runView
+    physAddr, L, isWrite = _EXIT_MMIO.unpack_from(view, kvmapi.KVM_RUN_EXIT_OFFSET)
+    st = _UINT.get(L)
+    if st is None:
+      raise Exception("invalid width")
+
+    if isWrite:
+      self._handleMmioWrite(physAddr, st.unpack_from(view, kvmapi.KVM_RUN_EXIT_MMIO_DATA_OFFSET)[0], L)
     else:
-      print("other exit reason")
+      st.pack_into(view, kvmapi.KVM_RUN_EXIT_MMIO_DATA_OFFSET, self._handleMmioRead(physAddr, L))
+
+    return True
+
+  def _handleExitUnknown(self, vcpu):
+    print("unknown exit reason")
+    return True
 
+  def _handleExitDebug(self, vcpu):
+    dbg = vcpu.runData.exitReasons.debug
+    print("exit debug: exc=0x%x pc=0x%x" % (dbg.exception, dbg.pc))
+    self._dumpRegs(vcpu)
     return True
 
+  def _handleExitIntr(self, vcpu):
+    print("exit INTR")
+    return True
+
+  def _handleExitShutdown(self, vcpu):
+    print("exit shutdown")
+    return False
+
+  def _handleExitSystemEvent(self, vcpu):
+    print("exit system event")
+    return True
+
+  def _handleExitHlt(self, vcpu):
+    print("exit halt")
+    return False
+
+  # Runs all vCPUs until the VM stops. vCPU 0 is run on the calling thread,
+  # which must be the main thread, and the others on their own threads.
+  #
+  # Statistics are reported on SIGUSR1 and when the VM stops.
   def run(self):
-    while True:
-      if not self.runOnce():
-        break
+    signal.signal(VCPU_KICK_SIGNAL, lambda signo, frame: None)
+    signal.signal(signal.SIGUSR1, lambda signo, frame: self.stats.report())
+
+    threads = []
+    with self._vcpuCond:
+      self._stopping = False
+      self._vcpuThreads[0] = threading.current_thread()
+      for vcpu in self.vcpus[1:]:
+        t = threading.Thread(target=self._vcpuLoop, args=(vcpu,), name='vcpu%d' % vcpu.cpuNum, daemon=True)
+        self._vcpuThreads[vcpu.cpuNum] = t
+        threads.append(t)
+
+    for t in threads:
+      t.start()
+
+    try:
+      self._vcpuLoop(self.vcpu)
+    finally:
+      self._stop()
+      for t in threads:
+        t.join()
+      self.stats.report()
+
+  def _vcpuLoop(self, vcpu):
+    with self._vcpuCond:
+      self._activeVcpus.add(vcpu)
+
+    try:
+      while self._safePoint(vcpu):
+        if not self.runOnce(vcpu):
+          self._stop()
+          break
+    finally:
+      with self._vcpuCond:
+        self._activeVcpus.discard(vcpu)
+        self._vcpuCond.notify_all()
+
+  # Called by each vCPU thread between exits, when it holds no device locks.
+  # Performs any pending system reset and parks while another thread has the
+  # vCPUs paused. Returns False if the thread should exit.
+  def _safePoint(self, vcpu):
+    with self._vcpuCond:
+      self._parkWhilePaused(vcpu)
+      if self._stopping:
+        return False
+      doReset = self._resetRequested
+      self._resetRequested = False
+
+    if doReset:
+      self._doSysReset(vcpu)
+
+    return True
+
+  # Must be called with _vcpuCond held. The pauser may save or replace the
+  # vCPU's state, so any exit it has handled is completed before it parks.
+  def _parkWhilePaused(self, current):
+    if self._pauser is not None and self._pauser is not current and not self._stopping and self._immediateExit:
+      current.completePendingIo()
+    while self._pauser is not None and self._pauser is not current and not self._stopping:
+      self._parkedCount += 1
+      self._vcpuCond.notify_all()
+      self._vcpuCond.wait()
+      self._parkedCount -= 1
+
+  def _kickVcpus(self, current=None):
+    for vcpu in self.vcpus:
+      t = self._vcpuThreads.get(vcpu.cpuNum)
+      if vcpu is not current and t is not None and t.is_alive():
+        vcpu.kick(t, VCPU_KICK_SIGNAL)
+
+  # Stops all vCPUs other than current at a safe point and waits until they
+  # have parked. current is the calling vCPU, or None if the caller is not a
+  # vCPU thread. Must be paired with _resumeVcpus.
+  def _pauseVcpus(self, current=None):
+    with self._vcpuCond:
+      if current is not None:
+        self._parkWhilePaused(current)
+      else:
+        while self._pauser is not None:
+          self._vcpuCond.wait()
+
+      self._pauser = current or True
+      self._kickVcpus(current)
+      while self._parkedCount < len(self._activeVcpus - {current}) and not self._stopping:
+        self._vcpuCond.wait()
+
+      # vCPUs without a running thread (before run(), or after it has
+      # returned) cannot park, so complete their last exit here instead.
+      for vcpu in self.vcpus:
+        if vcpu is not current and vcpu not in self._activeVcpus and self._immediateExit:
+          vcpu.completePendingIo()
+
+  def _resumeVcpus(self):
+    with self._vcpuCond:
+      self._pauser = None
+      self._vcpuCond.notify_all()
+
+  # Tears down the platform once run() has returned, so that devices can
+  # release their resources and write back any cached state, such as disk
+  # writes held in a write-back cache.
+  def shutdown(self):
+    self._platform.teardown()
+
+  def _stop(self):
+    with self._vcpuCond:
+      self._stopping = True
+      self._vcpuCond.notify_all()
+
+    self._kickVcpus(None)
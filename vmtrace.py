@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+import sys, struct, itertools, threading, time, json
+
+# Binary event tracing. Events are fixed-size records written into a
+# preallocated ring buffer, so that tracing allocates nothing and formats
+# nothing at the point of emission. Call sites guard each emission with a
+# check of the category mask, so that disabled tracing costs a single branch:
+#
+#   if vmtrace.mask & vmtrace.MMIO:
+#     vmtrace.emit(vmtrace.EV_MMIO_WRITE, addr, v, width)
+#
+# The ring can be dumped to a file and converted offline into Chrome
+# trace-event JSON, which can be loaded into Perfetto or chrome://tracing:
+#
+#   python3 vmtrace.py kvmtest.trace > trace.json
+
+# Categories.
+EXIT    = 1<<0
+PIO     = 1<<1
+MMIO    = 1<<2
+VIRTIO  = 1<<3
+SCSI    = 1<<4
+FLASH   = 1<<5
+
+categoryNames = {
+  'exit':   EXIT,
+  'pio':    PIO,
+  'mmio':   MMIO,
+  'virtio': VIRTIO,
+  'scsi':   SCSI,
+  'flash':  FLASH,
+}
+
+# Enabled categories. Checked directly by call sites.
+mask = 0
+
+# Events. Each event has three integer arguments, whose meanings are given by
+# the argument names below. For events with a 'dur' argument, the event is
+# exported as a complete event of that duration in nanoseconds, ending at the
+# event's timestamp.
+EV_EXIT             = 1
+EV_PIO_READ         = 2
+EV_PIO_WRITE        = 3
+EV_MMIO_READ        = 4
+EV_MMIO_WRITE       = 5
+EV_VIRTIO_DESC      = 6
+EV_VIRTIO_USED      = 7
+EV_SCSI_CMD         = 8
+EV_SCSI_READ        = 9
+EV_SCSI_WRITE       = 10
+EV_FLASH_READ       = 11
+EV_FLASH_WRITE      = 12
+EV_PIO_READ_BLOCK   = 13
+EV_PIO_WRITE_BLOCK  = 14
+
+# {eventNo: (category, name, (argName, argName, argName))}
+events = {
+  EV_EXIT:             (EXIT,    'exit',             ('reason', 'dur', None)),
+  EV_PIO_READ:         (PIO,     'pio_read',         ('port', 'value', 'width')),
+  EV_PIO_WRITE:        (PIO,     'pio_write',        ('port', 'value', 'width')),
+  EV_MMIO_READ:        (MMIO,    'mmio_read',        ('addr', 'value', 'width')),
+  EV_MMIO_WRITE:       (MMIO,    'mmio_write',       ('addr', 'value', 'width')),
+  EV_VIRTIO_DESC:      (VIRTIO,  'virtio_desc',      ('addr', 'len', 'flags')),
+  EV_VIRTIO_USED:      (VIRTIO,  'virtio_used',      ('queue', 'head', 'written')),
+  EV_SCSI_CMD:         (SCSI,    'scsi_cmd',         ('lun', 'id', 'opcode')),
+  EV_SCSI_READ:        (SCSI,    'scsi_read',        ('lba', 'count', None)),
+  EV_SCSI_WRITE:       (SCSI,    'scsi_write',       ('lba', 'count', None)),
+  EV_FLASH_READ:       (FLASH,   'flash_read',       ('addr', 'width', None)),
+  EV_FLASH_WRITE:      (FLASH,   'flash_write',      ('addr', 'value', None)),
+  EV_PIO_READ_BLOCK:   (PIO,     'pio_read_block',   ('port', 'count', 'width')),
+  EV_PIO_WRITE_BLOCK:  (PIO,     'pio_write_block',  ('port', 'count', 'width')),
+}
+
+# (ts: u64, eventNo: u16, tid: u16, reserved: u32, a: u64, b: u64, c: u64)
+_record = struct.Struct('<QHHIQQQ')
+RECORD_SIZE = _record.size
+
+_fileHeader = struct.Struct('<8sQQ')  # magic, number of records, next position
+FILE_MAGIC  = b'KVMTRACE'
+
+class TraceRing:
+  def __init__(self, numRecords):
+    self.numRecords = numRecords
+    self.buf        = bytearray(numRecords*RECORD_SIZE)
+    self._pos       = itertools.count()
+
+  def emit(self, eventNo, a, b, c):
+    i = next(self._pos)
+    _record.pack_into(self.buf, (i % self.numRecords)*RECORD_SIZE,
+      time.perf_counter_ns(), eventNo, threading.get_native_id() & 0xFFFF, 0,
+      a & 0xFFFF_FFFF_FFFF_FFFF, b & 0xFFFF_FFFF_FFFF_FFFF, c & 0xFFFF_FFFF_FFFF_FFFF)
+
+  # Writes the ring to a file. Taking a position from the counter marks the end
+  # of the dump; records emitted while the dump is written may overwrite the
+  # oldest records.
+  def dump(self, f):
+    f.write(_fileHeader.pack(FILE_MAGIC, self.numRecords, next(self._pos)))
+    f.write(self.buf)
+
+_ring = None
+
+# Enables the given categories, allocating a ring of numRecords records if one
+# has not already been allocated.
+def enable(categories, numRecords=1<<20):
+  global _ring, mask
+  if _ring is None:
+    _ring = TraceRing(numRecords)
+  mask |= categories
+
+def disable(categories=~0):
+  global mask
+  mask &= ~categories
+
+# Parses a comma-separated list of category names, or 'all'.
+def parseCategories(s):
+  m = 0
+  for name in s.split(','):
+    name = name.strip()
+    if name == 'all':
+      m |= sum(categoryNames.values())
+    elif name in categoryNames:
+      m |= categoryNames[name]
+    elif name:
+      raise Exception("unknown trace category: %s" % name)
+  return m
+
+# (eventNo: EV_*, a: int, b: int, c: int) → ()
+def emit(eventNo, a=0, b=0, c=0):
+  _ring.emit(eventNo, a, b, c)
+
+def dump(path):
+  if _ring is None:
+    return
+  with open(path, 'wb') as f:
+    _ring.dump(f)
+
+# Returns the records in a dump file in order, as (ts, eventNo, tid, a, b, c)
+# tuples.
+def readDump(f):
+  magic, numRecords, nextPos = _fileHeader.unpack(f.read(_fileHeader.size))
+  if magic != FILE_MAGIC:
+    raise Exception("not a trace file")
+
+  buf = f.read(numRecords*RECORD_SIZE)
+  first = max(nextPos - numRecords, 0)
+  for i in range(first, nextPos):
+    ts, eventNo, tid, _, a, b, c = _record.unpack_from(buf, (i % numRecords)*RECORD_SIZE)
+    if eventNo == 0: # not yet written
+      continue
+    yield ts, eventNo, tid, a, b, c
+
+# Converts records to a Chrome trace-event JSON object.
+def toChromeTrace(records):
+  out = []
+  for ts, eventNo, tid, a, b, c in records:
+    cat, name, argNames = events.get(eventNo, (0, 'event%d' % eventNo, ('a', 'b', 'c')))
+    catName = next((k for k, v in categoryNames.items() if v == cat), 'unknown')
+    e = {'name': name, 'cat': catName, 'pid': 1, 'tid': tid, 'ts': ts/1000, 'args': {}}
+    for argName, v in zip(argNames, (a, b, c)):
+      if argName == 'dur':
+        e['dur'] = v/1000
+        e['ts'] = (ts - v)/1000
+      elif argName is not None:
+        e['args'][argName] = '0x%x' % v if argName in ('addr', 'port', 'value') else v
+
+    if 'dur' in e:
+      e['ph'] = 'X'
+    else:
+      e['ph'] = 'i'
+      e['s'] = 't'
+    out.append(e)
+
+  return {'traceEvents': out, 'displayTimeUnit': 'ns'}
+
+def run():
+  if len(sys.argv) != 2:
+    print('usage: %s <trace file>' % sys.argv[0], file=sys.stderr)
+    return 2
+
+  with open(sys.argv[1], 'rb') as f:
+    json.dump(toChromeTrace(readDump(f)), sys.stdout)
+
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(run())